@@ -12,12 +12,26 @@ import random
 import getpass
 import struct
 import typing
+import threading
+import queue
+import hashlib
+import pickle
+import copy
+import multiprocessing
+import base64
+import io
+import zipfile
+import sqlite3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from functools import reduce
 from binascii import hexlify, unhexlify
 from logging import Logger
 from ldap3 import Server, Connection, ALL, Tls, SASL, KERBEROS, EXTERNAL, AUTO_BIND_TLS_BEFORE_BIND
 from ldap3.utils.ciDict import CaseInsensitiveDict
-from impacket.ldap.ldaptypes import ACE, ACCESS_ALLOWED_OBJECT_ACE, ACCESS_MASK, LDAP_SID, SR_SECURITY_DESCRIPTOR
+from ldap3.core.exceptions import LDAPCommunicationError
+from ldap3.protocol.microsoft import dir_sync_control
+from impacket.ldap.ldaptypes import ACE, ACCESS_ALLOWED_OBJECT_ACE, ACCESS_MASK, ACE_TYPE_MAP, LDAP_SID, SR_SECURITY_DESCRIPTOR
 from datetime import datetime, timedelta
 from impacket.uuid import bin_to_string
 from OpenSSL.crypto import load_certificate, FILETYPE_ASN1
@@ -53,6 +67,96 @@ MINIMUM_ATTRIBUTES = [
     'name'
 ]
 
+# default maximum number of distinct parsed security descriptors kept in the parse cache
+SD_CACHE_SIZE = 20000
+
+# default number of records sent to each post processing worker process at a time
+PROCESS_CHUNKSIZE = 64
+
+# number of records mapped by a bloodhound worker process at a time
+BH_SHARD_SIZE = 1000
+
+# dump categories converted to bloodhound output files
+BH_PARSE_CATEGORIES = ['certauthorities', 'certenrollservices', 'certtemplates', 'containers', 'computers', 'domains', 'gpos', 'groups', 'ous', 'users']
+
+# bloodhound output files split from the certauthorities category by parent container
+BH_CA_CATEGORIES = {
+    'aiacas': 'CN=AIA,CN=PUBLIC KEY SERVICES,CN=SERVICES,CN=CONFIGURATION', 
+    'ntauthstores': 'CN=PUBLIC KEY SERVICES,CN=SERVICES,CN=CONFIGURATION', 
+    'rootcas': 'CN=CERTIFICATION AUTHORITIES,CN=PUBLIC KEY SERVICES,CN=SERVICES,CN=CONFIGURATION'
+}
+
+# categories collected by the light pre-pass of the bloodhound pipeline to build the bloodhound lookup maps
+BH_MAP_METHODS = ['users', 'computers', 'groups', 'containers', 'ous', 'gpos', 'certtemplates']
+
+# attributes collected in addition to SID_LOOKUP_ATTRIBUTES by the bloodhound pipeline pre-pass
+BH_MAP_ATTRIBUTES = [
+    'distinguishedName',
+    'objectGUID',
+    'dNSHostName',
+    'name'
+]
+
+# fields containing security descriptors
+SD_FIELDS = ['nTSecurityDescriptor', 'msDS-GroupMSAMembership', 'msDS-AllowedToActOnBehalfOfOtherIdentity']
+
+# security descriptor decoders, check decodes with both and logs any differences
+SD_PARSERS = ['impacket', 'native', 'check']
+
+# ace type names, and the ace types that have the object ace layout with optional object type guids
+ACE_TYPE_NAMES = {a: ACE_TYPE_MAP[a].__name__ for a in ACE_TYPE_MAP}
+OBJECT_ACE_TYPES = [0x05, 0x06, 0x07, 0x0B, 0x0C, 0x0F]
+
+# formats supported for the dump output file, indent matches the original json.dumps(data, indent=4) output
+JSON_DUMP_FORMATS = ['indent', 'json', 'ndjson']
+DUMP_FORMATS = JSON_DUMP_FORMATS + ['sqlite']
+
+# each line of an ndjson dump starts with this
+NDJSON_PREFIX = '{"category":'
+
+# number of bytes read from a dump file at a time when it is read incrementally
+DUMP_READ_SIZE = 1048576
+
+# sqlite dump files start with this
+SQLITE_HEADER = b'SQLite format 3\x00'
+
+# number of rows inserted into a sqlite dump in each transaction
+SQLITE_BATCH_SIZE = 10000
+
+# record fields stored in their own indexed columns of each category table of a sqlite dump
+SQLITE_INDEXED_FIELDS = ['objectSid', 'objectGUID', 'distinguishedName', 'sAMAccountName']
+
+# attributes collected by the light streaming pre-pass to build the sid lookup table
+SID_LOOKUP_ATTRIBUTES = [
+    'objectSid',
+    'sAMAccountName',
+    'objectCategory'
+]
+
+# collection steps that must complete before a dependant step can be scheduled when querying in parallel
+# post processing (domain tagging and SD sid resolution via domainLT and sidLT) always runs after all steps complete
+QUERY_DEPENDENCIES = {
+    '_certcontainers': ['certauthorities', 'certenrollservices', 'certtemplates']
+}
+
+# targets for the latency and size of each page when the page size is adapted, with the smallest page size used and the
+# server MaxPageSize assumed when it cannot be read from the default query policy
+ADAPTIVE_PAGE_SECONDS = 2.0
+ADAPTIVE_PAGE_BYTES = 4194304
+ADAPTIVE_PAGE_MIN = 50
+DEFAULT_MAX_PAGE_SIZE = 1000
+PAGED_RESULTS_CONTROL_OID = '1.2.840.113556.1.4.319'
+
+# times a paged search request is retried on a new connection after a connection error, with an increasing delay in seconds
+RECONNECT_ATTEMPTS = 3
+RECONNECT_DELAY = 5
+
+# collection methods with simple objectClass filters that can be collected together by a single search of their naming context
+FUSION_METHODS = ['certauthorities', 'certenrollservices', 'certtemplates', 'containers', 'domains', 'forests', 'gpos', 'ous', 'trusted_domains']
+
+# collection methods split into disjoint uSNCreated range partitions searched concurrently when partitioning is enabled
+PARTITION_METHODS = ['users', 'computers', 'groups']
+
 
 # https://docs.microsoft.com/en-us/openspecs/windows_protocols/ms-adts/1522b774-6464-41a3-87a5-1e5633c3fbbb
 # https://docs.microsoft.com/en-au/windows/win32/adschema/classes-all?redirectedfrom=MSDN
@@ -351,8 +455,36 @@ MANUAL_FLAGS = {
 # TODO: lDAPAdminLimits set on query policy objects
 
 # Limit the schema collection to the following
+# control to return deleted objects from the Deleted Objects container, used to find deletions in delta collection
+SHOW_DELETED_CONTROL = ('1.2.840.113556.1.4.417', True, None)
+
+# "DirSync" control, returns only objects and attributes changed since the state recorded in a cookie
+DIRSYNC_CONTROL_OID = '1.2.840.113556.1.4.841'
+DIRSYNC_MAX_BYTES = 2147483647
+
+# naming context searched by each category and the values required in each attribute for an object to belong to it,
+# mirroring the filters of the matching query methods, used to route objects from DirSync and fused searches to categories
+CATEGORY_CLASSES = [
+    ('certauthorities', 'config', {'objectClass': ['certificationAuthority']}),
+    ('certenrollservices', 'config', {'objectClass': ['pKIEnrollmentService']}),
+    ('certtemplates', 'config', {'objectClass': ['pKICertificateTemplate']}),
+    ('containers', 'root', {'objectClass': ['container']}),
+    ('computers', 'root', {'objectClass': ['computer'], 'objectCategory': ['Computer']}),
+    ('domains', 'root', {'objectClass': ['domain']}),
+    ('forests', 'config', {'objectClass': ['crossRefContainer']}),
+    ('gpos', 'root', {'objectClass': ['groupPolicyContainer']}),
+    ('groups', 'root', {'objectClass': ['group']}),
+    ('ous', 'root', {'objectClass': ['organizationalUnit']}),
+    ('trusted_domains', 'root', {'objectClass': ['trustedDomain']}),
+    ('users', 'root', {'objectClass': ['user'], 'objectCategory': ['Person', 'ms-DS-Group-Managed-Service-Account', 'ms-DS-Managed-Service-Account']})
+]
+
+# attributes of the schema naming context head used to identify the schema version for the schema cache
+SCHEMA_VERSION_ATTRIBUTES = ['objectVersion', 'modifyTimeStamp']
+
 SCHEMA_ATTRIBUTES = [
     'adminDescription',
+    'attributeSyntax',
     'defaultSecurityDescriptor',
     'description',
     'name',
@@ -360,6 +492,7 @@ SCHEMA_ATTRIBUTES = [
     'mayContain',
     'mustContain',
     'objectClass',
+    'oMSyntax',
     'schemaIDGUID',
     'systemMayContain',
     'systemMustContain'
@@ -524,16 +657,66 @@ BH_COMMON_PROPERTIES = [
     'whencreated'
 ]
 
+# rules for converting ACEs to Bloodhound edges, evaluated in order for each ACE of a matching type
+# (ace type, right name, required access mask rights, object classes, control object types, options)
+# object classes of None match any class. control object types of None match any ACE, otherwise the ACE
+# ControlObjectType must be in the list, with a None entry in the list matching ACEs with no object type
+# options - group: only the first matching rule in a group is applied, terminal: stop processing the ACE after a match, 
+# laps: requires LAPS on the entry and matches control object types case insensitively
+BH_ACL_RULES = [
+    ('ACCESS_ALLOWED_OBJECT_ACE', 'ReadLAPSPassword', ['GENERIC_ALL'], ['computer'], ['ms-mcs-admpwd', 'allproperties'], {'group': 'GenericAll', 'laps': True}),
+    ('ACCESS_ALLOWED_OBJECT_ACE', 'GenericAll', ['GENERIC_ALL'], None, None, {'group': 'GenericAll', 'terminal': True}),
+    ('ACCESS_ALLOWED_OBJECT_ACE', 'GenericWrite', ['GENERIC_WRITE'], None, None, {'group': 'GenericWrite'}),
+    ('ACCESS_ALLOWED_OBJECT_ACE', 'GenericWrite', ['ADS_RIGHT_DS_WRITE_PROP'], ['user', 'group', 'computer', 'gpo'], [None], {'group': 'GenericWrite'}),
+    ('ACCESS_ALLOWED_OBJECT_ACE', 'WriteDacl', ['WRITE_DACL'], None, None, {}),
+    ('ACCESS_ALLOWED_OBJECT_ACE', 'WriteOwner', ['WRITE_OWNER'], None, None, {}),
+    ('ACCESS_ALLOWED_OBJECT_ACE', 'AllExtendedRights', ['ADS_RIGHT_DS_CONTROL_ACCESS'], ['user', 'domain', 'computer', 'pki-certificate-template'], [None, 'AllProperties'], {}),
+    # https://github.com/BloodHoundAD/SharpHoundCommon/blob/1ccdb773d3af19718f410d9795ca9977019b5a85/src/CommonLib/Processors/ACLProcessor.cs 
+    ('ACCESS_ALLOWED_OBJECT_ACE', 'AddMember', ['ADS_RIGHT_DS_WRITE_PROP'], ['group'], ['Member', 'AllProperties'], {'group': 'WriteProperty'}),
+    ('ACCESS_ALLOWED_OBJECT_ACE', 'AddAllowedToAct', ['ADS_RIGHT_DS_WRITE_PROP'], ['computer'], ['ms-DS-Allowed-To-Act-On-Behalf-Of-Other-Identity', 'AllProperties'], {'group': 'WriteProperty'}),
+    ('ACCESS_ALLOWED_OBJECT_ACE', 'WriteAccountRestrictions', ['ADS_RIGHT_DS_WRITE_PROP'], ['computer'], ['User-Account-Restrictions', 'AllProperties'], {'group': 'WriteProperty'}),
+    ('ACCESS_ALLOWED_OBJECT_ACE', 'AddKeyCredentialLink', ['ADS_RIGHT_DS_WRITE_PROP'], ['computer', 'user', 'ms-ds-group-managed-service-account'], ['ms-DS-Key-Credential-Link', 'AllProperties'], {'group': 'WriteProperty'}),
+    ('ACCESS_ALLOWED_OBJECT_ACE', 'WriteSPN', ['ADS_RIGHT_DS_WRITE_PROP'], ['user'], ['Service-Principal-Name', 'AllProperties'], {'group': 'WriteProperty'}),
+    ('ACCESS_ALLOWED_OBJECT_ACE', 'WritePKIEnrollmentFlag', ['ADS_RIGHT_DS_WRITE_PROP'], ['pki-certificate-template'], ['ms-PKI-Enrollment-Flag', 'AllProperties'], {'group': 'WriteProperty'}),
+    ('ACCESS_ALLOWED_OBJECT_ACE', 'WritePKINameFlag', ['ADS_RIGHT_DS_WRITE_PROP'], ['pki-certificate-template'], ['ms-PKI-Certificate-Name-Flag', 'AllProperties'], {'group': 'WriteProperty'}),
+    ('ACCESS_ALLOWED_OBJECT_ACE', 'AddSelf', ['ADS_RIGHT_DS_SELF'], ['group'], ['Member', 'AllProperties'], {}),
+    ('ACCESS_ALLOWED_OBJECT_ACE', 'ReadLAPSPassword', ['ADS_RIGHT_DS_READ_PROP'], ['computer'], ['ms-mcs-admpwd', 'allproperties'], {'laps': True}),
+    ('ACCESS_ALLOWED_OBJECT_ACE', 'ForceChangePassword', ['ADS_RIGHT_DS_CONTROL_ACCESS'], ['user'], ['User-Force-Change-Password', 'AllProperties'], {}),
+    ('ACCESS_ALLOWED_OBJECT_ACE', 'GetChanges', ['ADS_RIGHT_DS_CONTROL_ACCESS'], ['domain'], ['DS-Replication-Get-Changes', 'AllProperties'], {}),
+    ('ACCESS_ALLOWED_OBJECT_ACE', 'GetChangesAll', ['ADS_RIGHT_DS_CONTROL_ACCESS'], ['domain'], ['DS-Replication-Get-Changes-All', 'AllProperties'], {}),
+    ('ACCESS_ALLOWED_OBJECT_ACE', 'GetChangesInFilteredSet', ['ADS_RIGHT_DS_CONTROL_ACCESS'], ['domain'], ['DS-Replication-Get-Changes-In-Filtered-Set', 'AllProperties'], {}),
+    ('ACCESS_ALLOWED_OBJECT_ACE', 'Enroll', ['ADS_RIGHT_DS_CONTROL_ACCESS'], ['pki-enrollment-service', 'pki-certificate-template'], ['Certificate-Enrollment', 'Certificate-AutoEnrollment', 'AllProperties'], {}),
+    ('ACCESS_ALLOWED_ACE', 'GenericAll', ['GENERIC_ALL'], None, None, {'terminal': True}),
+    ('ACCESS_ALLOWED_ACE', 'GenericWrite', ['ADS_RIGHT_DS_WRITE_PROP'], ['user', 'group', 'computer', 'gpo', 'ms-ds-group-managed-service-account'], None, {}),
+    ('ACCESS_ALLOWED_ACE', 'WriteDacl', ['WRITE_DACL'], None, None, {}),
+    ('ACCESS_ALLOWED_ACE', 'WriteOwner', ['WRITE_OWNER'], None, None, {}),
+    ('ACCESS_ALLOWED_ACE', 'AllExtendedRights', ['ADS_RIGHT_DS_CONTROL_ACCESS'], ['user', 'domain', 'ms-ds-group-managed-service-account', 'computer'], None, {}),
+    ('ACCESS_ALLOWED_ACE', 'ManageCA', ['GENERIC_WRITE'], ['pki-enrollment-service'], None, {}),
+    ('ACCESS_ALLOWED_ACE', 'ManageCertificates', ['GENERIC_WRITE', 'ADS_RIGHT_DS_DELETE_CHILD'], ['pki-enrollment-service'], None, {})
+]
+
+
+
+class LdapConnectionError(Exception):
+    '''Raised when a connection to an LDAP server cannot be established or bound'''
+
 
 
 class AdDumper:
 
     def __init__(self, host=None, target_ip=None, username=None, password=None, ssl=False, sslprotocol=None, port=None, delay=0, jitter=0, paged_size=500, logger=Logger('AdDumper'), raw=False, kerberos=False, 
-                 no_password=False, query_config=None, import_mode=False, attributes=ldap3.ALL_ATTRIBUTES, bh_attributes=False, start_tls=False, client_cert_file=None, client_key_file=None):
+                 no_password=False, query_config=None, import_mode=False, attributes=ldap3.ALL_ATTRIBUTES, bh_attributes=False, start_tls=False, client_cert_file=None, client_key_file=None, workers=1, sd_cache_size=SD_CACHE_SIZE, sd_parser='impacket', processes=1, process_chunksize=PROCESS_CHUNKSIZE, dedupe_sd=False, schema_cache=None, since=None, dirsync=None, partitions=1, partition_methods=PARTITION_METHODS, extra_targets=None, 
+                 adaptive_paging=False, page_target_seconds=ADAPTIVE_PAGE_SECONDS, page_target_bytes=ADAPTIVE_PAGE_BYTES, checkpoint=None, reconnect_attempts=RECONNECT_ATTEMPTS, fuse_queries=False, bh_processes=1, bh_zip=False):
         self.logger = logger
         self.host = host
         self.kerberos = kerberos
         self.target_ip = target_ip if target_ip else host
+        # additional domain controllers that collection steps and partitions are spread across
+        self.targets = list(OrderedDict.fromkeys([self.target_ip] + (extra_targets if extra_targets else [])))
+        self.failed_targets = set()
+        self.target_stats = {a: {'steps': {}, 'seconds': 0, 'failed': False} for a in self.targets}
+        self._partition_counter = 0
+        self._pool_targets = set()
         self.username = username 
         if kerberos:
             self.logger.debug('Kerberos option selected, will attempt to authenticate using configured Kerberos ccache')
@@ -570,6 +753,13 @@ class AdDumper:
         self.port = port if port else 636 if self.ssl else 389
         self.delay = delay
         self.jitter = jitter
+        # at least one connection per domain controller so every controller is used
+        self.workers = max(1, workers, len(self.targets) if len(self.targets) > 1 else 1)
+        self.partitions = max(1, partitions)
+        self.partition_methods = partition_methods
+        self.partition_stats = {}
+        self.fuse_queries = fuse_queries
+        self.fusion_stats = {}
         self.config = query_config
         if sslprotocol:
             spv = self.get_supported_tls()
@@ -589,12 +779,37 @@ class AdDumper:
         self.bh_cert_temp_map = {}
         self.bh_member_map = {}
         self.bh_computer_map = {}
+        # reverse lookup indexes built from the above maps and domainLT by bloodhound_convert
+        self.bh_domain_sid_map = {}
+        self.bh_host_map = {}
+        self.bh_sid_member_map = {}
         self.bh_core_domain = ''
+        self.bh_processes = max(1, bh_processes)
+        self.bh_zip = bh_zip
+        self.bh_acl_rules = {}
+        # lowercase form of each field name requested through _fp and whether it is a time field
+        self.bh_field_names = {}
         self.post_process_data = True
         self.multi_field = ['dSCorePropagationData', 'objectClass']
         self.datetime_format = '%Y-%m-%d %H:%M:%S.%f %Z %z'
         self.timestamp = False
         self.paged_size = paged_size
+        self.adaptive_paging = adaptive_paging
+        self.page_target_seconds = page_target_seconds
+        self.page_target_bytes = page_target_bytes
+        self.max_page_size = None
+        # page counts and sizes used for each category when the page size is adapted
+        self.page_stats = {}
+        self.checkpoint = checkpoint
+        self.reconnect_attempts = max(0, reconnect_attempts)
+        # connections are held per thread so collection methods can run in parallel over a pool of connections
+        self._local = threading.local()
+        self._connection = None
+        self._throttle_lock = threading.Lock()
+        self._page_counter = 0
+        # when set, records are passed to this callable as (category, record) as they are parsed instead of being returned
+        self._record_sink = None
+        self._forced_attributes = None
         # "Security descriptor flags" control 1.2.840.113556.1.4.801
         # LDAP_SERVER_SD_FLAGS_OID - 0x07 flag value, queries for all values in nTSecurityDescriptor apart from SACL
         self.controls = [('1.2.840.113556.1.4.801', True, "\x30\x03\x02\x01\x07")]  # SACL is 0x8, owner 0x1, group 0x2, DACL 0x4
@@ -602,6 +817,14 @@ class AdDumper:
         self.domainLT = {}
         self.domainLTNB = {}
         self.convert_binary = True
+        self.sd_cache = SecurityDescriptorCache(sd_cache_size)
+        self.sd_parser = sd_parser
+        self.sd_parser_checks = 0
+        self.sd_parser_mismatches = 0
+        self.processes = max(1, processes)
+        self.process_chunksize = max(1, process_chunksize)
+        self.post_process_stats = {}
+        self.dedupe_sd = dedupe_sd
 
         # impacket LDAP access mask structures have values for set (not read) operations for these masks, so we override
         # https://learn.microsoft.com/en-us/dotnet/api/system.directoryservices.activedirectoryrights?view=netframework-4.7.2
@@ -615,8 +838,21 @@ class AdDumper:
         self.ace_flags = self.get_ace_flag_constants()
         self.access_masks = self.get_access_mask_constants()
         self.ace_data_flags = self.get_ace_data_flag_constants()
+        # decoded names for each distinct flag or mask value, filled as values are seen while parsing security descriptors
+        self.ace_flag_table = {}
+        self.access_mask_table = {}
+        self.ace_data_flag_table = {}
         self.object_types = dict(OBJECT_TYPES)
         self.schema = {}
+        self.schema_index = SchemaIndex([])
+        self.schema_cache = schema_cache
+        self.schema_cache_status = None
+        self.since = since
+        self.usn_filter = None
+        self.highest_committed_usn = None
+        self.usn_dc = None
+        self.collection_checkpoint = None
+        self.dirsync = dirsync
         self.output_timestamp = None
         self.start_time = None 
 
@@ -709,6 +945,13 @@ class AdDumper:
 
     def get_ace_data_flag_constants(self):
         return {a:ACCESS_ALLOWED_OBJECT_ACE.__dict__[a] for a in ACCESS_ALLOWED_OBJECT_ACE.__dict__ if 'PRESENT' in a}
+
+
+    def decode_bits(self, value, constants, table):
+        '''Returns the names from constants with all bits set in value, memoized per distinct value in table'''
+        if value not in table:
+            table[value] = tuple(a for a in constants if value & constants[a] == constants[a])
+        return list(table[value])
         
 
     def get_supported_tls(self):
@@ -717,8 +960,10 @@ class AdDumper:
         except:
             return {'SSLv23': 2, 'TLSv1': 3, 'TLSv1_1': 4, 'TLSv1_2': 5}
 
-    def connect(self):
-        if not self.target_ip:
+    def _create_connection(self, target=None):
+        '''Creates a new authenticated connection to target or the configured LDAP server, returning the server and connection objects'''
+        target = target if target else self.target_ip
+        if not target:
             raise Exception('No host provided')
         
         if self.client_key_file and self.client_cert_file:
@@ -727,51 +972,69 @@ class AdDumper:
             tls_object = Tls(validate=0, version=self.sslprotocol)
 
         if self.ssl:
-            self.server = Server(self.target_ip, get_info=ALL, port=self.port, use_ssl=True, tls=tls_object)
+            server = Server(target, get_info=ALL, port=self.port, use_ssl=True, tls=tls_object)
         else:
             if self.start_tls or (self.client_key_file and self.client_cert_file):
-                self.server = Server(self.target_ip, get_info=ALL, port=self.port, tls=tls_object)
+                server = Server(target, get_info=ALL, port=self.port, tls=tls_object)
             else:
-                self.server = Server(self.target_ip, get_info=ALL, port=self.port)
+                server = Server(target, get_info=ALL, port=self.port)
         
         # host needs to be a domain name for kerberos
         # we ensure this is the case even if we connect to an IP via the sasl_credentials with the host specified as var 1 in Connection
+        # additional domain controllers are bound using their own name, as the service ticket is specific to each one
         if self.kerberos:
-            self.logger.debug(f'Attempting to perform Kerberos connection to LDAP server {self.server} with bind host name {self.host}')
-            self.connection = Connection(self.server, sasl_credentials=(self.host,), authentication=SASL, sasl_mechanism=KERBEROS) 
+            bind_host = self.host if target == self.target_ip else target
+            self.logger.debug(f'Attempting to perform Kerberos connection to LDAP server {server} with bind host name {bind_host}')
+            connection = Connection(server, sasl_credentials=(bind_host,), authentication=SASL, sasl_mechanism=KERBEROS) 
         elif self.client_key_file and self.client_cert_file and self.ssl:
-            self.logger.debug(f'Attempting to authenticate to LDAP server {self.server} using provided certificate with SSL bind')
-            self.connection = Connection(self.server) 
+            self.logger.debug(f'Attempting to authenticate to LDAP server {server} using provided certificate with SSL bind')
+            connection = Connection(server) 
         elif (self.client_key_file and self.client_cert_file):
-            self.logger.debug(f'Attempting to perform connection to LDAP server {self.server} with STARTTLS')
-            self.connection = Connection(self.server, authentication=SASL, sasl_mechanism=EXTERNAL, auto_bind=AUTO_BIND_TLS_BEFORE_BIND)
+            self.logger.debug(f'Attempting to perform connection to LDAP server {server} with STARTTLS')
+            connection = Connection(server, authentication=SASL, sasl_mechanism=EXTERNAL, auto_bind=AUTO_BIND_TLS_BEFORE_BIND)
         else:
-            self.logger.debug(f'Attempting to perform connection to LDAP server {self.server}')
-            self.connection = Connection(self.server, user=self.username, password=self.password, authentication=self.authentication)
+            self.logger.debug(f'Attempting to perform connection to LDAP server {server}')
+            connection = Connection(server, user=self.username, password=self.password, authentication=self.authentication)
 
         if self.start_tls and not (self.client_key_file and self.client_cert_file):
             self.logger.debug(f'Attempting to START_TLS on connection...')
             try:
-                self.connection.start_tls()
+                connection.start_tls()
             except Exception as e:
                 self.logger.debug(f'Exception during START_TLS operation: {str(e)}')
-                sys.exit(1)
+                raise LdapConnectionError('An error occurred when attempting to START_TLS on the connection to {}:\n{}'.format(target, e))
 
         # need to open and not rebind when relying on TLS connection for authentication
         if (self.client_key_file and self.client_cert_file) and self.ssl:
-            self.connection.open() 
+            connection.open() 
         # the connection auto binds when using certificate auth on the non SSL LDAP port
         elif not (self.client_key_file and self.client_cert_file):
             try:
-                bindresult = self.connection.bind()
+                bindresult = connection.bind()
             except Exception as e:
-                print('An error occurred when binding to the LDAP service:\n{}\n'.format(e))
-                print('For Kerberos errors try manually specifying the realm, ensuring that forged ccache tickets use upper case for the domain and removing conflicting hosts file entries.')
-                sys.exit(1)
+                raise LdapConnectionError('An error occurred when binding to the LDAP service:\n{}\n\n'
+                    'For Kerberos errors try manually specifying the realm, ensuring that forged ccache tickets use upper case for the domain and removing conflicting hosts file entries.'.format(e))
 
             if not bindresult:
-                raise Exception('An error occurred when attempting to bind to the LDAP server: {}'.format(', '.join(['{} : {}' .format(a, self.connection.result[a]) for a in  self.connection.result])))
+                raise Exception('An error occurred when attempting to bind to the LDAP server: {}'.format(', '.join(['{} : {}' .format(a, connection.result[a]) for a in  connection.result])))
         
+        return server, connection
+
+
+    @property
+    def connection(self):
+        '''LDAP connection for the current thread, a pooled connection when running in a parallel worker'''
+        connection = getattr(self._local, 'connection', None)
+        return connection if connection is not None else self._connection
+
+    @connection.setter
+    def connection(self, value):
+        self._connection = value
+
+
+    def connect(self):
+        self.server, self.connection = self._create_connection()
+
         # Check to see if server is a Global Catalog server
         if not 'TRUE' in self.server.info.other.get('isGlobalCatalogReady'):
             self.logger.warning('WARNING: Server is not a global catalog, results may be incomplete...')
@@ -788,28 +1051,126 @@ class AdDumper:
 
     #https://learn.microsoft.com/en-us/openspecs/windows_protocols/ms-dtyp/7d4dac05-9cef-4563-a058-f108abecce1d?redirectedfrom=MSDN
     #https://learn.microsoft.com/en-us/openspecs/windows_protocols/ms-adts/990fb975-ab31-4bc1-8b75-5da132cd4584
-    def parseSecurityDescriptor(self, nTSecurityDescriptor):
-        out = {}
+    def _decode_sd_impacket(self, nTSecurityDescriptor):
+        '''Decodes a self relative security descriptor into a dict of its fields using the impacket structures'''
         sd = SR_SECURITY_DESCRIPTOR()
         sd.fromString(nTSecurityDescriptor)
+        out = {'Control': sd['Control'], 'OwnerSid': None, 'GroupSid': None, 'Dacl': None}
+        if sd['OwnerSid']:
+            out['OwnerSid'] = sd['OwnerSid'].formatCanonical()
+        if sd['GroupSid']:
+            out['GroupSid'] = sd['GroupSid'].formatCanonical()
+        if sd['Dacl']:
+            out['Dacl'] = []
+            for ace in sd['Dacl']['Data']:
+                decoded = {'TypeName': ace['TypeName'], 'AceFlags': ace['AceFlags'], 'Mask': ace['Ace']['Mask']['Mask'], 'Flags': None, 
+                           'ObjectType': None, 'InheritedObjectType': None, 'Sid': ace['Ace']['Sid'].formatCanonical()}
+                if 'Flags' in ace['Ace'].fields:
+                    decoded['Flags'] = ace['Ace']['Flags']
+                for field in ['ObjectType', 'InheritedObjectType']:
+                    if field in ace['Ace'].fields and len(ace['Ace'][field]) > 0:
+                        decoded[field] = bin_to_string(ace['Ace'][field]).lower()
+                out['Dacl'].append(decoded)
+        return out
+
+
+    def _decode_sid_native(self, data, offset, end):
+        revision, count = struct.unpack_from('<BB', data, offset)
+        if offset + 8 + count * 4 > end:
+            raise Exception('SID at offset {} extends past the end of its containing structure'.format(offset))
+        return 'S-{}-{}'.format(revision, data[offset + 7]) + ''.join('-{}'.format(a) for a in struct.unpack_from('<{}L'.format(count), data, offset + 8))
+
+
+    def _decode_acl_native(self, data, offset):
+        acl = []
+        acl_size, ace_count = struct.unpack_from('<2xHH', data, offset)
+        acl_end = min(offset + acl_size, len(data))
+        position = offset + 8
+        for _ in range(ace_count):
+            if position + 4 > acl_end:
+                raise Exception('ACL header indicated there are more ACEs to unpack, but there is no more data')
+            ace_type, ace_flags, ace_size = struct.unpack_from('<BBH', data, position)
+            ace_end = min(position + ace_size, acl_end)
+            decoded = {'TypeName': ACE_TYPE_NAMES[ace_type], 'AceFlags': ace_flags, 'Mask': struct.unpack_from('<L', data, position + 4)[0], 'Flags': None,
+                       'ObjectType': None, 'InheritedObjectType': None}
+            sid_offset = position + 8
+            if ace_type in OBJECT_ACE_TYPES:
+                decoded['Flags'] = struct.unpack_from('<L', data, position + 8)[0]
+                sid_offset += 4
+                for flag, field in [(ACCESS_ALLOWED_OBJECT_ACE.ACE_OBJECT_TYPE_PRESENT, 'ObjectType'), (ACCESS_ALLOWED_OBJECT_ACE.ACE_INHERITED_OBJECT_TYPE_PRESENT, 'InheritedObjectType')]:
+                    if decoded['Flags'] & flag:
+                        if sid_offset + 16 > ace_end:
+                            raise Exception('ACE {} extends past the end of the ACE'.format(field))
+                        decoded[field] = '{:08x}-{:04x}-{:04x}-{:02x}{:02x}-{:02x}{:02x}{:02x}{:02x}{:02x}{:02x}'.format(*struct.unpack_from('<LHH8B', data, sid_offset))
+                        sid_offset += 16
+            decoded['Sid'] = self._decode_sid_native(data, sid_offset, ace_end)
+            acl.append(decoded)
+            position += ace_size
+        return acl
+
+
+    def _decode_sd_native(self, nTSecurityDescriptor):
+        '''Decodes a self relative security descriptor into a dict of its fields, reading directly from the raw bytes'''
+        data = memoryview(nTSecurityDescriptor)
+        control, owner, group, sacl, dacl = struct.unpack_from('<2xHLLLL', data, 0)
+        out = {'Control': control, 'OwnerSid': None, 'GroupSid': None, 'Dacl': None}
+        if owner:
+            out['OwnerSid'] = self._decode_sid_native(data, owner, len(data))
+        if group:
+            out['GroupSid'] = self._decode_sid_native(data, group, len(data))
+        if sacl:
+            # not returned, but decoded so malformed descriptors are rejected the same way as the impacket parser
+            self._decode_acl_native(data, sacl)
+        if dacl:
+            out['Dacl'] = self._decode_acl_native(data, dacl)
+        return out
+
+
+    def decode_security_descriptor(self, nTSecurityDescriptor):
+        '''Decodes a security descriptor with the configured parser, in check mode decoding with both parsers and logging any difference'''
+        if self.sd_parser == 'native':
+            return self._decode_sd_native(nTSecurityDescriptor)
+        decoded = self._decode_sd_impacket(nTSecurityDescriptor)
+        if self.sd_parser == 'check':
+            self.sd_parser_checks += 1
+            try:
+                native = self._decode_sd_native(nTSecurityDescriptor)
+            except Exception as e:
+                native = str(e)
+            if native != decoded:
+                self.sd_parser_mismatches += 1
+                self.logger.warning('Native security descriptor parser output differs from impacket for descriptor {}'.format(hexlify(nTSecurityDescriptor).decode()))
+        return decoded
+
+
+    def sd_parser_stats(self):
+        out = {'parser': self.sd_parser}
+        if self.sd_parser == 'check':
+            out.update({'checked': self.sd_parser_checks, 'mismatches': self.sd_parser_mismatches})
+        return out
+
+
+    def parseSecurityDescriptor(self, nTSecurityDescriptor):
+        sd = self.decode_security_descriptor(nTSecurityDescriptor)
+        out = {}
         out['IsACLProtected'] = int(bin(sd['Control'])[2:][3]) == 1 # 3 PD DACL Protected from inherit operations
         # Get-ADUser -Filter * -Properties nTSecurityDescriptor | ?{ $_.nTSecurityDescriptor.AreAccessRulesProtected -eq "True" }
         # sd['Sacl'] is masked in the LDAP query because of permissions, so wont be available here
         if sd['Control']:
             out['Control'] = sd['Control']
         if sd['OwnerSid']:
-            out['OwnerSid'] = sd['OwnerSid'].formatCanonical()
+            out['OwnerSid'] = sd['OwnerSid']
             if out['OwnerSid'] in self.sidLT:
                 out['OwnerName'] = self.sidLT[out['OwnerSid']][0]
         if sd['GroupSid']:
-            out['GroupSid'] = sd['GroupSid'].formatCanonical()
+            out['GroupSid'] = sd['GroupSid']
             if out['GroupSid'] in self.sidLT:
                 out['GroupName'] = self.sidLT[out['GroupSid']][0]
-        if sd['Dacl']:
+        if sd['Dacl'] is not None:
             out['Dacls'] = []
-            for ace in sd['Dacl']['Data']:
+            for ace in sd['Dacl']:
                 dacl = {'Type' : ace['TypeName']}
-                dacl['Sid'] = ace['Ace']['Sid'].formatCanonical()
+                dacl['Sid'] = ace['Sid']
                 if dacl['Sid'] in self.sidLT:
                     d = [self.sidLT[dacl['Sid']][0]]
                     domainsid = self.get_domain_sid(dacl['Sid'])
@@ -822,34 +1183,17 @@ class AdDumper:
                 #elif dacl['Sid'].count('-') > 6: # this is wrong...
                 #    dacl['Foreign'] = True
 
-                dacl['Flags'] = []
-                for flag in self.ace_flags:
-                    if ace.hasFlag(self.ace_flags[flag]):
-                        dacl['Flags'].append(flag)
+                dacl['Flags'] = self.decode_bits(ace['AceFlags'], self.ace_flags, self.ace_flag_table)
                 if dacl['Type'] == 'ACCESS_ALLOWED_OBJECT_ACE':
-                    dacl['Ace_Data_Flags'] = []
-                    for dataflag in self.ace_data_flags:
-                        if ace['Ace'].hasFlag(self.ace_data_flags[dataflag]):
-                            dacl['Ace_Data_Flags'].append(dataflag)
-
-                dacl['Mask'] = ace['Ace']['Mask']['Mask']
-
-                dacl['Privs'] = []
-                for priv in self.access_masks:
-                    if ace['Ace']['Mask'].hasPriv(self.access_masks[priv]):
-                        dacl['Privs'].append(priv)
-                if 'ObjectType' in ace['Ace'].fields and len(ace['Ace']['ObjectType']) > 0:
-                    type_guid = bin_to_string(ace['Ace']['ObjectType']).lower()
-                    if type_guid in self.object_types:
-                        dacl['ControlObjectType'] = self.object_types[type_guid]
-                    else:
-                        dacl['ControlObjectType'] = type_guid
-                if 'InheritedObjectType' in ace['Ace'].fields and len(ace['Ace']['InheritedObjectType']) > 0:
-                    type_guid = bin_to_string(ace['Ace']['InheritedObjectType']).lower()
-                    if type_guid in self.object_types:
-                        dacl['InheritableObjectType'] = self.object_types[type_guid]
-                    else:
-                        dacl['InheritableObjectType'] = type_guid
+                    dacl['Ace_Data_Flags'] = self.decode_bits(ace['Flags'], self.ace_data_flags, self.ace_data_flag_table)
+
+                dacl['Mask'] = ace['Mask']
+
+                dacl['Privs'] = self.decode_bits(dacl['Mask'], self.access_masks, self.access_mask_table)
+                if ace['ObjectType']:
+                    dacl['ControlObjectType'] = self.object_types.get(ace['ObjectType'], ace['ObjectType'])
+                if ace['InheritedObjectType']:
+                    dacl['InheritableObjectType'] = self.object_types.get(ace['InheritedObjectType'], ace['InheritedObjectType'])
                 out['Dacls'].append(dacl)
 
         return out
@@ -869,9 +1213,36 @@ class AdDumper:
 
 
 
-    def parse_records(self, gen):
-        out = []
-        counter=0
+    def _sleep(self, message):
+        mydelay = self.delay
+        if self.jitter:
+            myjit = random.randint(1, self.jitter)
+            mydelay = self.delay + myjit
+            self.logger.debug('Adding {} seconds of jitter to delay'.format(myjit))
+        self.logger.info(message.format(mydelay))
+        time.sleep(mydelay)
+
+
+    def _query_delay(self):
+        '''Delay between queries, the lock is held while sleeping so the delay applies across all pooled connections'''
+        if self.delay:
+            with self._throttle_lock:
+                self._sleep('Sleeping for {} seconds between queries as per configured setting')
+
+
+    def _record_delay(self):
+        '''Delay after each page worth of records, counted across all pooled connections'''
+        if self.delay:
+            with self._throttle_lock:
+                self._page_counter += 1
+                if self._page_counter >= self.paged_size:
+                    self._page_counter = 0
+                    self._sleep('Sleeping for {} seconds during paging operation as per configured setting')
+
+
+    def iter_records(self, gen, method_name=None):
+        '''Converts search responses into records one at a time, applying any method specific record processing'''
+        processor = getattr(self, '_process_{}_record'.format(method_name), None) if method_name else None
         for record in gen:
             if 'type' in record and record['type'] == 'searchResEntry' and 'attributes' in record:
                 orecord = record['attributes']
@@ -893,29 +1264,40 @@ class AdDumper:
                             orecord['{}_raw'.format(entry)] = orecord[entry]
                         orecord[entry] = self._convert_pki_period(orecord[entry])
 
+                if processor:
+                    processor(orecord)
 
-                out.append(orecord)
+                yield orecord
 
                 # delay between each page of records if sleep is configured
-                if self.delay:
-                    counter+=1
-                    if counter==self.paged_size:
-                        mydelay = self.delay
-                        if self.jitter:
-                            myjit = random.randint(1, self.jitter)
-                            mydelay = self.delay + myjit
-                            self.logger.debug('Adding {} seconds of jitter to delay'.format(myjit))
-                        self.logger.info('Sleeping for {} seconds during paging operation as per configured setting'.format(mydelay))
-                        time.sleep(mydelay)
-                        counter=0
+                self._record_delay()
 
-        return out
+
+    def parse_records(self, gen, method_name=None):
+        '''Returns the list of converted records, or hands each record to the record sink when streaming'''
+        if self._record_sink:
+            for record in self.iter_records(gen, method_name):
+                self._record_sink(method_name, record)
+            return []
+        return list(self.iter_records(gen, method_name))
 
     def get_class(self, entry):
         return entry['objectCategory'].split(',')[0].split('=')[-1].replace('Person', 'User').replace('-DNS', '')
 
     def update_sidlt(self, data):
-        self.sidLT.update({a['objectSid']: [a['sAMAccountName'], self.get_class(a)] for a in data if 'objectSid' in a and 'sAMAccountName' in a and 'objectCategory' in a})
+        entries = {a['objectSid']: [a['sAMAccountName'], self.get_class(a)] for a in data if 'objectSid' in a and 'sAMAccountName' in a and 'objectCategory' in a}
+        # pooled collection steps gather their entries separately until the step completes
+        step_table = getattr(self._local, 'sid_table', None)
+        if step_table is not None:
+            step_table.update(entries)
+        else:
+            self._merge_sidlt(entries)
+
+    def _merge_sidlt(self, entries):
+        # cached security descriptors resolve names from this table, so are only invalidated on an actual change
+        if [a for a in entries if self.sidLT.get(a) != entries[a]]:
+            self.sidLT.update(entries)
+            self.sd_cache.clear()
 
     def get_domain_sid(self, sid):
         return '-'.join(sid.split('-')[:-1])
@@ -951,6 +1333,131 @@ class AdDumper:
         return data
 
 
+    def get_max_page_size(self):
+        '''Returns the MaxPageSize LDAP policy limit from the default query policy, or the AD default if it cannot be read'''
+        if self.max_page_size is None:
+            self.max_page_size = DEFAULT_MAX_PAGE_SIZE
+            try:
+                self.connection.search('CN=Default Query Policy,CN=Query-Policies,CN=Directory Service,CN=Windows NT,CN=Services,{}'.format(self.server.info.other['configurationNamingContext'][0]), '(objectClass=*)', search_scope=ldap3.BASE, attributes=['lDAPAdminLimits'])
+                limits = [str(b) for a in self.connection.response if 'attributes' in a for b in a['attributes'].get('lDAPAdminLimits', [])]
+                self.max_page_size = int([a.split('=')[1] for a in limits if a.lower().startswith('maxpagesize=')][0])
+            except Exception as e:
+                self.logger.debug('Unable to read MaxPageSize from the default query policy, using {}: {}'.format(DEFAULT_MAX_PAGE_SIZE, e))
+            self.logger.debug('Adaptive page sizes limited to server MaxPageSize of {}'.format(self.max_page_size))
+        return self.max_page_size
+
+
+    def _next_page_size(self, size, seconds, page_bytes, max_size):
+        '''Scales the page size towards the page latency and size targets, changing it by at most a factor of two per page'''
+        ratios = [self.page_target_seconds / seconds if seconds else 2, self.page_target_bytes / page_bytes if page_bytes else 2]
+        factor = min(2, max(0.5, min(ratios)))
+        return int(max(ADAPTIVE_PAGE_MIN, min(max_size, size * factor)))
+
+
+    def paged_search(self, search_base, search_filter, controls=None, attributes=ldap3.ALL_ATTRIBUTES, category=None):
+        '''Generator of paged search responses, adapting the page size, checkpointing each page and reconnecting on connection errors when enabled'''
+        if not self.adaptive_paging and not self.checkpoint and not self.reconnect_attempts:
+            yield from self.connection.extend.standard.paged_search(search_base, search_filter, controls=controls, attributes=attributes, paged_size=self.paged_size, generator=True)
+            return
+        max_size = self.get_max_page_size() if self.adaptive_paging else self.paged_size
+        size = max(ADAPTIVE_PAGE_MIN, min(self.paged_size, max_size)) if self.adaptive_paging else self.paged_size
+        stats = {'pages': 0, 'entries': 0, 'bytes': 0, 'seconds': 0, 'min_size': size, 'max_size': size}
+        cookie = None
+        collected = set()
+        checkpoint = None
+        if self.checkpoint:
+            checkpoint = SearchCheckpoint(self.checkpoint, hashlib.sha256(json.dumps([search_base, search_filter, attributes, category]).encode()).hexdigest())
+            # pages collected before the interruption are replayed before the search continues from the saved cookie
+            for page in checkpoint.read_pages():
+                for entry in page:
+                    collected.add(entry['dn'])
+                    yield entry
+            if checkpoint.state['complete']:
+                return
+            cookie = checkpoint.state['cookie']
+        resumed = cookie is not None
+        while True:
+            start = time.time()
+            connection = self._search_page(search_base, search_filter, controls, attributes, size, cookie)
+            seconds = time.time() - start
+            if resumed and connection.result['result'] != 0:
+                # paged search cookies are not always accepted on a new connection, so the search is restarted without the collected entries
+                self.logger.warning('Unable to resume paged search for {} from checkpoint, restarting it and skipping {} entries already collected'.format(category, len(collected)))
+                cookie = None
+                resumed = False
+                continue
+            resumed = False
+            response = [a for a in connection.response if a.get('dn') not in collected] if collected else list(connection.response)
+            # page sizes are only measured when they are adapted
+            page_bytes = sum([len(c) for a in response for b in a.get('raw_attributes', {}).values() for c in b or []]) if self.adaptive_paging else 0
+            stats['pages'] += 1
+            stats['entries'] += len(response)
+            stats['bytes'] += page_bytes
+            stats['seconds'] += seconds
+            stats['min_size'] = min(stats['min_size'], size)
+            stats['max_size'] = max(stats['max_size'], size)
+            cookie = (connection.result.get('controls') or {}).get(PAGED_RESULTS_CONTROL_OID, {}).get('value', {}).get('cookie')
+            # same order as the ldap3 paged search generator, which yields each page in reverse
+            response.reverse()
+            if checkpoint:
+                checkpoint.add_page([{'type': a.get('type'), 'dn': a.get('dn'), 'attributes': a.get('attributes')} for a in response], cookie)
+            for entry in response:
+                yield entry
+            if not cookie:
+                break
+            if self.adaptive_paging:
+                size = self._next_page_size(size, seconds, page_bytes, max_size)
+        if self.adaptive_paging:
+            stats['final_size'] = size
+            self._record_page_stats(category, stats)
+
+
+    def _search_page(self, search_base, search_filter, controls, attributes, size, cookie):
+        '''Requests a single page, reconnecting and retrying the page on connection errors, and returns the connection used'''
+        for attempt in range(1, self.reconnect_attempts + 2):
+            try:
+                self.connection.search(search_base, search_filter, attributes=attributes, controls=controls, paged_size=size, paged_cookie=cookie)
+                return self.connection
+            except LDAPCommunicationError as e:
+                if attempt > self.reconnect_attempts:
+                    raise
+                self.logger.warning('LDAP connection error during paged search, reconnecting (attempt {} of {}): {}'.format(attempt, self.reconnect_attempts, e))
+                time.sleep(RECONNECT_DELAY * attempt)
+                self.reconnect()
+
+
+    def reconnect(self):
+        '''Replaces the LDAP connection used by the current thread with a new connection bound to the same server'''
+        connection = self.connection
+        try:
+            connection.unbind()
+        except Exception as e:
+            self.logger.debug('Error closing failed connection: {}'.format(e))
+        try:
+            new_connection = self._create_connection(connection.server.host)[1]
+        except Exception as e:
+            # the next attempt on the failed connection will retry
+            self.logger.warning('Reconnection to {} failed: {}'.format(connection.server.host, e))
+            return
+        if getattr(self._local, 'connection', None) is not None:
+            self._local.connection = new_connection
+        else:
+            self._connection = new_connection
+
+
+    def _record_page_stats(self, category, stats):
+        with self._throttle_lock:
+            if category in self.page_stats:
+                # partitioned and repeated searches of a category are combined
+                previous = self.page_stats[category]
+                for key in ['pages', 'entries', 'bytes', 'seconds']:
+                    stats[key] += previous[key]
+                stats['min_size'] = min(stats['min_size'], previous['min_size'])
+                stats['max_size'] = max(stats['max_size'], previous['max_size'])
+            stats['seconds'] = round(stats['seconds'], 3)
+            self.page_stats[category] = stats
+
+
     def custom_query(self, query: str, attributes: str=ldap3.ALL_ATTRIBUTES, parse_records: bool=True, controls: bool=None) -> list:
         self.logger.info('Running custom query against LDAP')
         self.logger.debug('Query: {}'.format(query))
@@ -971,8 +1478,8 @@ class AdDumper:
                 query = '(|(objectClass=container)(objectClass=configuration))'
                 method_name = 'containers'
                 query, attributes = self._configure_query(method_name, query, attributes)
-                gen = self.connection.extend.standard.paged_search(self.server.info.other['configurationNamingContext'][0], query, controls=self.controls, attributes=attributes, paged_size=self.paged_size, generator=True)
-                data = self.parse_records(gen)
+                gen = self.paged_search(self.server.info.other['configurationNamingContext'][0], query, controls=self.controls, attributes=attributes, category=method_name)
+                data = self.parse_records(gen, method_name)
                 self.config_containers_collected = True
         return data
 
@@ -984,8 +1491,8 @@ class AdDumper:
         method_name = sys._getframe(0).f_code.co_name.split('_', 1)[1]
         query, attributes = self._configure_query(method_name, query, attributes)
         # forcing base to CN=Configuration is the only way Ive been able to get PKI related items to work, not sure if theres a betetr way
-        gen = self.connection.extend.standard.paged_search(self.server.info.other['configurationNamingContext'][0], query, controls=self.controls, attributes=attributes, paged_size=self.paged_size, generator=True)
-        data = self.parse_records(gen)
+        gen = self.paged_search(self.server.info.other['configurationNamingContext'][0], query, controls=self.controls, attributes=attributes, category=method_name)
+        data = self.parse_records(gen, method_name)
         return data
 
 
@@ -994,23 +1501,24 @@ class AdDumper:
         query = '(objectClass=pKIEnrollmentService)'
         method_name = sys._getframe(0).f_code.co_name.split('_', 1)[1]
         query, attributes = self._configure_query(method_name, query, attributes)
-        gen = self.connection.extend.standard.paged_search(self.server.info.other['configurationNamingContext'][0], query, controls=self.controls, attributes=attributes, paged_size=self.paged_size, generator=True)
-        data = self.parse_records(gen)
-        # post process flag field value - "flag" field is too generic to do this in shared routine so do it here
-        for record in data:
-            if 'flags' in record:
-                record['flags_raw'] = record['flags']
-                record['flags'] = [a for a in MANUAL_FLAGS['flags'] if self.hasFlag(MANUAL_FLAGS['flags'][a], record['flags'])]
+        gen = self.paged_search(self.server.info.other['configurationNamingContext'][0], query, controls=self.controls, attributes=attributes, category=method_name)
+        data = self.parse_records(gen, method_name)
         return data
 
+    def _process_certenrollservices_record(self, record):
+        # post process flag field value - "flag" field is too generic to do this in shared routine so do it here
+        if 'flags' in record:
+            record['flags_raw'] = record['flags']
+            record['flags'] = [a for a in MANUAL_FLAGS['flags'] if self.hasFlag(MANUAL_FLAGS['flags'][a], record['flags'])]
+
 
     def query_certtemplates(self, attributes: str=ldap3.ALL_ATTRIBUTES) -> list:
         self.logger.info('Querying certtemplate objects from LDAP')
         query = '(objectClass=pKICertificateTemplate)'
         method_name = sys._getframe(0).f_code.co_name.split('_', 1)[1]
         query, attributes = self._configure_query(method_name, query, attributes)
-        gen = self.connection.extend.standard.paged_search(self.server.info.other['configurationNamingContext'][0], query, controls=self.controls, attributes=attributes, paged_size=self.paged_size, generator=True)
-        data = self.parse_records(gen)
+        gen = self.paged_search(self.server.info.other['configurationNamingContext'][0], query, controls=self.controls, attributes=attributes, category=method_name)
+        data = self.parse_records(gen, method_name)
         return data
 
     def query_containers(self, attributes: str=ldap3.ALL_ATTRIBUTES) -> list:
@@ -1018,8 +1526,8 @@ class AdDumper:
         query = '(objectClass=container)'
         method_name = sys._getframe(0).f_code.co_name.split('_', 1)[1]
         query, attributes = self._configure_query(method_name, query, attributes)
-        gen = self.connection.extend.standard.paged_search(self.root, query, controls=self.controls, attributes=attributes, paged_size=self.paged_size, generator=True)
-        data = self.parse_records(gen)
+        gen = self.paged_search(self.root, query, controls=self.controls, attributes=attributes, category=method_name)
+        data = self.parse_records(gen, method_name)
         return data
 
     def query_computers(self, attributes: str=ldap3.ALL_ATTRIBUTES) -> list:
@@ -1027,9 +1535,8 @@ class AdDumper:
         query = '(objectCategory=computer)'
         method_name = sys._getframe(0).f_code.co_name.split('_', 1)[1]
         query, attributes = self._configure_query(method_name, query, attributes)
-        gen = self.connection.extend.standard.paged_search(self.root, query, controls=self.controls, attributes=attributes, paged_size=self.paged_size, generator=True)
-        data = self.parse_records(gen)
-        self.update_sidlt(data)
+        gen = self.paged_search(self.root, query, controls=self.controls, attributes=attributes, category=method_name)
+        data = self.parse_records(gen, method_name)
         return data
 
     def query_domains(self, attributes: str=ldap3.ALL_ATTRIBUTES) -> list:
@@ -1038,12 +1545,18 @@ class AdDumper:
         query = '(objectClass=domain)'
         method_name = sys._getframe(0).f_code.co_name.split('_', 1)[1]
         query, attributes = self._configure_query(method_name, query, attributes)
-        gen = self.connection.extend.standard.paged_search(self.root, query, controls=self.controls, attributes=attributes, paged_size=self.paged_size, generator=True)
-        data = self.parse_records(gen)
-        self.domainLT = {a['objectSid']: '.'.join([b.split('=')[1].upper() for b in a['distinguishedName'].split(',')]) for a in data}
-        self.domainLTNB = {a['objectSid']: a['name'].upper() for a in data}
+        gen = self.paged_search(self.root, query, controls=self.controls, attributes=attributes, category=method_name)
+        data = self.parse_records(gen, method_name)
         return data
 
+    def _process_domains_record(self, record):
+        # DirSync updates only contain changed attributes
+        if [a for a in ['objectSid', 'distinguishedName', 'name'] if a not in record]:
+            return
+        self.domainLT[record['objectSid']] = '.'.join([b.split('=')[1].upper() for b in record['distinguishedName'].split(',')])
+        self.domainLTNB[record['objectSid']] = record['name'].upper()
+        self.sd_cache.clear()
+
     def query_forests(self, attributes: str=ldap3.ALL_ATTRIBUTES) -> list:
         # FEATURE add a derived forest functional param from msDS-Behavior-Version ?
         # configurationNamingContext should be under cn=partitions,cn=configuration,dc=domain,dc=local
@@ -1051,8 +1564,8 @@ class AdDumper:
         query = '(objectClass=crossRefContainer)'
         method_name = sys._getframe(0).f_code.co_name.split('_', 1)[1]
         query, attributes = self._configure_query(method_name, query, attributes)
-        gen = self.connection.extend.standard.paged_search(self.server.info.other['configurationNamingContext'][0], query, controls=self.controls, attributes=attributes, paged_size=self.paged_size, generator=True)
-        data = self.parse_records(gen)
+        gen = self.paged_search(self.server.info.other['configurationNamingContext'][0], query, controls=self.controls, attributes=attributes, category=method_name)
+        data = self.parse_records(gen, method_name)
         return data
 
     def query_gpos(self, attributes: str=ldap3.ALL_ATTRIBUTES) -> list:
@@ -1060,8 +1573,8 @@ class AdDumper:
         query = '(objectClass=groupPolicyContainer)'
         method_name = sys._getframe(0).f_code.co_name.split('_', 1)[1]
         query, attributes = self._configure_query(method_name, query, attributes)
-        gen = self.connection.extend.standard.paged_search(self.root, query, controls=self.controls, attributes=attributes, paged_size=self.paged_size, generator=True) # domainPolicy
-        return self.parse_records(gen)
+        gen = self.paged_search(self.root, query, controls=self.controls, attributes=attributes, category=method_name) # domainPolicy
+        return self.parse_records(gen, method_name)
 
 
     # query for security groups only (|(sAMAccountType=268435456)(sAMAccountType=536870912)) 
@@ -1070,9 +1583,8 @@ class AdDumper:
         query = '(objectClass=group)' # if not self.alt_query else '(objectCategory=group)'
         method_name = sys._getframe(0).f_code.co_name.split('_', 1)[1]
         query, attributes = self._configure_query(method_name, query, attributes)     
-        gen = self.connection.extend.standard.paged_search(self.root, query, controls=self.controls, attributes=attributes, paged_size=self.paged_size, generator=True)
-        data = self.parse_records(gen)
-        self.update_sidlt(data)
+        gen = self.paged_search(self.root, query, controls=self.controls, attributes=attributes, category=method_name)
+        data = self.parse_records(gen, method_name)
         return data
 
     def query_ous(self, attributes: str=ldap3.ALL_ATTRIBUTES) -> list:
@@ -1080,35 +1592,43 @@ class AdDumper:
         query = '(objectClass=organizationalUnit)'
         method_name = sys._getframe(0).f_code.co_name.split('_', 1)[1]
         query, attributes = self._configure_query(method_name, query, attributes)
-        gen = self.connection.extend.standard.paged_search(self.root, query, controls=self.controls, attributes=attributes, paged_size=self.paged_size, generator=True)
-        return self.parse_records(gen)
+        gen = self.paged_search(self.root, query, controls=self.controls, attributes=attributes, category=method_name)
+        return self.parse_records(gen, method_name)
 
     def query_trusted_domains(self, attributes: str=ldap3.ALL_ATTRIBUTES) -> list:
         self.logger.info('Querying trusted domain objects from LDAP')
         query = '(objectClass=trustedDomain)' # if not self.alt_query else '(objectCategory=trustedDomain)'
         method_name = sys._getframe(0).f_code.co_name.split('_', 1)[1]
         query, attributes = self._configure_query(method_name, query, attributes)
-        gen = self.connection.extend.standard.paged_search(self.root, query, controls=self.controls, attributes=attributes, paged_size=self.paged_size, generator=True)
-        data = self.parse_records(gen)
-        for index in range(0, len(data)):            
-            if 'trustAttributesFlags' in data[index]:
-                fp = lambda x : x in data[index]['trustAttributesFlags']
-                #data[index]['sidFiltering'] = True if not fp('WITHIN_FOREST') else fp('QUARANTINED_DOMAIN')
-                data[index]['sidFiltering'] = bool(fp('QUARANTINED_DOMAIN'))
-                data[index]['transitive'] = True if not (fp('TREAT_AS_EXTERNAL') or fp('CROSS_ORGANIZATION')) else False
-
+        gen = self.paged_search(self.root, query, controls=self.controls, attributes=attributes, category=method_name)
+        data = self.parse_records(gen, method_name)
         return data
 
+    def _process_trusted_domains_record(self, record):
+        if 'trustAttributesFlags' in record:
+            fp = lambda x : x in record['trustAttributesFlags']
+            #record['sidFiltering'] = True if not fp('WITHIN_FOREST') else fp('QUARANTINED_DOMAIN')
+            record['sidFiltering'] = bool(fp('QUARANTINED_DOMAIN'))
+            record['transitive'] = True if not (fp('TREAT_AS_EXTERNAL') or fp('CROSS_ORGANIZATION')) else False
+
     def query_users(self, attributes: str=ldap3.ALL_ATTRIBUTES) -> list:
         self.logger.info('Querying user objects from LDAP')
         query = '(&(objectClass=user)(|(objectCategory=person)(objectCategory=msDS-GroupManagedServiceAccount)(objectCategory=msDS-ManagedServiceAccount)))' 
         method_name = sys._getframe(0).f_code.co_name.split('_', 1)[1]
         query, attributes = self._configure_query(method_name, query, attributes)
-        gen = self.connection.extend.standard.paged_search(self.root, query, controls=self.controls, attributes=attributes, paged_size=self.paged_size, generator=True)
-        data = self.parse_records(gen)
-        self.update_sidlt(data)
+        gen = self.paged_search(self.root, query, controls=self.controls, attributes=attributes, category=method_name)
+        data = self.parse_records(gen, method_name)
         return data
-        
+
+    def _process_users_record(self, record):
+        self.update_sidlt([record])
+
+    def _process_computers_record(self, record):
+        self.update_sidlt([record])
+
+    def _process_groups_record(self, record):
+        self.update_sidlt([record])
+
     def query_info(self, attributes: str=ldap3.ALL_ATTRIBUTES) -> dict:
         '''This one runs on anonymous binds'''
         self.logger.info('Querying server information from LDAP')
@@ -1135,30 +1655,86 @@ class AdDumper:
             if 'attributes' in self.config[method_name]:
                 attributes = self.config[method_name]['attributes']
                 self.logger.debug('Attributes override for method "{}" from config file: {}'.format(method_name, ','.join(attributes)))
-                attributes += [a for a in MINIMUM_ATTRIBUTES if a.lower() not in [b.lower() for b in attributes]]
+                requested = set([a.lower() for a in attributes])
+                attributes += [a for a in MINIMUM_ATTRIBUTES if a.lower() not in requested]
         if self.schema and not isinstance(attributes, str):
-            present_attributes = [b for b in attributes if b.lower() in [a['lDAPDisplayName'].lower() for a in self.schema]]
-            if len(attributes) != (present_attributes):
-                removed_attributes = [a for a in attributes if a.lower() not in [b.lower() for b in present_attributes]]
+            present_attributes = [a for a in attributes if a in self.schema_index]
+            if len(attributes) != len(present_attributes):
+                removed_attributes = [a for a in attributes if a not in self.schema_index]
                 self.logger.debug('Removing the following attributes from {} query that were not present in schema: {}'.format(method_name, ', '.join(removed_attributes)))
             attributes = present_attributes
+        if self.usn_filter is not None:
+            query = '(&{}(uSNChanged>={}))'.format(query, self.usn_filter)
+        partition = getattr(self._local, 'partition', None)
+        if partition:
+            query = '(&{}{})'.format(query, partition)
+        if self.usn_filter is not None or partition:
+            # changed records are merged into the previous dump and partitions are merged together by objectGUID
+            if not isinstance(attributes, str) and 'objectguid' not in [a.lower() for a in attributes]:
+                attributes = attributes + ['objectGUID']
+        if partition:
+            # merged partitions are sorted by uSNCreated
+            if not isinstance(attributes, str) and 'usncreated' not in [a.lower() for a in attributes]:
+                attributes = attributes + ['uSNCreated']
+        if self._forced_attributes:
+            attributes = self._forced_attributes
         return query, attributes
 
 
+    def get_schema_version(self):
+        '''Returns a key identifying the forest and the version of its schema, read from the head of the schema naming context'''
+        self.connection.search(self.server.info.other['schemaNamingContext'][0], '(objectClass=*)', search_scope=ldap3.BASE, attributes=SCHEMA_VERSION_ATTRIBUTES)
+        entries = [a['attributes'] for a in self.connection.response if 'attributes' in a]
+        if not entries or not [a for a in SCHEMA_VERSION_ATTRIBUTES if entries[0].get(a)]:
+            raise Exception('Schema version attributes {} could not be read'.format(', '.join(SCHEMA_VERSION_ATTRIBUTES)))
+        # the collected schema attributes are included so cached schemas are refreshed when they change
+        version = [self.server.info.other['rootDomainNamingContext'][0]] + [str(entries[0].get(a)) for a in SCHEMA_VERSION_ATTRIBUTES] + SCHEMA_ATTRIBUTES
+        return hashlib.sha256('|'.join(version).encode()).hexdigest()
+
+
+    def _load_schema(self, parsed):
+        additional = {a['schemaIDGUID']: a['name'] for a in parsed if 'schemaIDGUID' in a and a['schemaIDGUID']}
+        if additional:
+            self.object_types.update(additional)
+            self.sd_cache.clear()
+        self.schema = parsed
+        self.schema_index = SchemaIndex(parsed)
+
+
     #classSchema is object type of defined objects, fields mayContain mustContain systemMayContain systemMustContain have the associated attributes
     # subClassOf in classSchema defines class inheritance, which is from class type top
     def retrieve_schema(self):
+        cache_file = None
+        if self.schema_cache:
+            try:
+                cache_file = os.path.join(self.schema_cache, 'schema_{}.json'.format(self.get_schema_version()))
+            except Exception as e:
+                self.logger.debug('Unable to determine schema version, schema will not be cached: {}'.format(e))
+                self.schema_cache_status = 'unversioned'
+            if cache_file and os.path.isfile(cache_file):
+                self.logger.info('Loading schema from cache file {}'.format(cache_file))
+                self._load_schema([CaseInsensitiveDict(a) for a in json.load(open(cache_file))])
+                self.schema_cache_status = 'hit'
+                return
+
         self.logger.info('Querying schema from LDAP')
-        gen = self.connection.extend.standard.paged_search(self.server.info.other['schemaNamingContext'][0], '(|(objectClass=classSchema)(objectClass=attributeSchema))', attributes=SCHEMA_ATTRIBUTES, paged_size=self.paged_size, generator=True)
+        gen = self.paged_search(self.server.info.other['schemaNamingContext'][0], '(|(objectClass=classSchema)(objectClass=attributeSchema))', attributes=SCHEMA_ATTRIBUTES, category='schema')
         parsed = [a['attributes'] for a in gen if 'attributes' in a]
         for entry in parsed:
             if 'schemaIDGUID' in entry:
                 entry['schemaIDGUID'] = bin_to_string(entry['schemaIDGUID']).lower()
             entry = self.jsonify(entry)
-        additional = {a['schemaIDGUID']: a['name'] for a in parsed if 'schemaIDGUID' in a and a['schemaIDGUID']}
-        if additional:
-            self.object_types.update(additional)
-        self.schema = parsed
+        self._load_schema(parsed)
+
+        if cache_file:
+            self.logger.debug('Writing schema to cache file {}'.format(cache_file))
+            os.makedirs(self.schema_cache, exist_ok=True)
+            # written to a temporary file first so concurrent runs never read a partial cache file
+            fd, temp_file = tempfile.mkstemp(dir=self.schema_cache, suffix='.tmp')
+            with os.fdopen(fd, 'w') as fileobj:
+                json.dump(self.jsonify(parsed), fileobj)
+            os.replace(temp_file, cache_file)
+            self.schema_cache_status = 'miss'
 
     def hasFlag(self, flag, value):
         return True if flag & value == flag else False
@@ -1167,6 +1743,290 @@ class AdDumper:
         return [a.split('_', 1)[1] for a in self.__dir__() if a.startswith('query_')]
 
 
+    def _validate_methods(self, methods):
+        valid_methods = self.get_valid_methods()
+
+        if not methods:
+            methods = valid_methods
+        else:
+            for method in methods:
+                if method not in valid_methods:
+                    raise Exception('Invalid query method of {} supplied.\nValid methods are: '.format(method, ', '.join(valid_methods)))
+        return methods
+
+
+    def get_highest_committed_usn(self):
+        '''Returns the highestCommittedUSN and dsServiceName of the connected DC from the rootDSE, USNs are only comparable on the same DC'''
+        try:
+            self.connection.search('', '(objectClass=*)', search_scope=ldap3.BASE, attributes=['highestCommittedUSN', 'dsServiceName'])
+            entries = [a['attributes'] for a in self.connection.response if 'attributes' in a]
+            return int(entries[0]['highestCommittedUSN']), str(entries[0]['dsServiceName'])
+        except Exception as e:
+            self.logger.debug('Unable to read highestCommittedUSN from rootDSE: {}'.format(e))
+            return None, None
+
+
+    def _resume_collection_state(self):
+        '''Reuses the highestCommittedUSN an interrupted checkpointed collection started with, or records the current one for a new collection'''
+        self.collection_checkpoint = CollectionCheckpoint(self.checkpoint)
+        state = self.collection_checkpoint.state
+        if self.collection_checkpoint.resumed:
+            self.logger.info('Resuming collection started at highestCommittedUSN {} on {}'.format(state['highest_committed_usn'], state['usn_dc']))
+            self.highest_committed_usn, self.usn_dc = state['highest_committed_usn'], state['usn_dc']
+        else:
+            state.update({'highest_committed_usn': self.highest_committed_usn, 'usn_dc': self.usn_dc})
+            self.collection_checkpoint.save()
+
+
+    def _load_previous_dump(self):
+        '''Imports the previous dump for delta collection and sets the uSNChanged filter, returns None if a full collection is needed'''
+        previous = self.import_dump(self.since)
+        previous_usn = previous.get('meta', {}).get('highest_committed_usn')
+        if previous_usn is None:
+            self.logger.warning('Previous dump {} has no highestCommittedUSN recorded, performing full collection'.format(self.since))
+            return None
+        if self.usn_dc is None or previous.get('meta', {}).get('usn_dc') != self.usn_dc:
+            self.logger.warning('Previous dump {} was collected from a different DC, USNs are DC specific so performing full collection'.format(self.since))
+            return None
+        self.usn_filter = previous_usn
+        self.logger.info('Collecting objects changed since USN {} from previous dump {}'.format(previous_usn, self.since))
+        return previous
+
+
+    def _collect_deleted_guids(self):
+        '''Returns the objectGUIDs of objects deleted since the delta USN, from the readable Deleted Objects containers'''
+        deleted = set()
+        for base in [self.root, self.server.info.other['configurationNamingContext'][0]]:
+            query = '(&(isDeleted=TRUE)(uSNChanged>={}))'.format(self.usn_filter)
+            try:
+                self._query_delay()
+                gen = self.paged_search('CN=Deleted Objects,{}'.format(base), query, controls=self.controls + [SHOW_DELETED_CONTROL], attributes=['objectGUID'], category='deleted')
+                deleted.update([a['objectGUID'] for a in self.jsonify(self.parse_records(gen)) if 'objectGUID' in a])
+            except Exception as e:
+                self.logger.warning('Unable to read Deleted Objects container under {}, deleted objects will remain in the output: {}'.format(base, e))
+        return deleted
+
+
+    def merge_delta(self, previous, data, deleted):
+        '''Merges changed records from a delta collection into the matching categories of the previous dump by objectGUID, or by distinguishedName for records without one'''
+        stats = {'since_usn': self.usn_filter, 'changed': 0, 'added': 0, 'deleted': 0}
+        for key in [a for a in data.keys() if a not in ['info', 'schema', 'meta']]:
+            if not isinstance(data[key], list) or not isinstance(previous.get(key), list):
+                continue
+            merged = list(previous[key])
+            index = {a.get('objectGUID'): i for i, a in enumerate(merged) if a.get('objectGUID')}
+            dn_index = {a['distinguishedName'].lower(): i for i, a in enumerate(merged) if isinstance(a.get('distinguishedName'), str)}
+            for record in data[key]:
+                if record.get('objectGUID'):
+                    position = index.get(record['objectGUID'])
+                else:
+                    position = dn_index.get(record['distinguishedName'].lower()) if isinstance(record.get('distinguishedName'), str) else None
+                if position is not None:
+                    merged[position] = record
+                    stats['changed'] += 1
+                else:
+                    merged.append(record)
+                    stats['added'] += 1
+            data[key] = [a for a in merged if a.get('objectGUID') not in deleted]
+            stats['deleted'] += len(merged) - len(data[key])
+        stats['memberof_updated'] = self._rebuild_member_of(data, previous)
+        return stats
+
+
+    def _rebuild_member_of(self, data, previous):
+        '''Updates the memberOf back links of merged records from the member values of the merged groups, returning the number of records changed'''
+        # a membership change only changes the uSNChanged of the group, so unchanged members keep memberOf values from the previous dump
+        if not isinstance(data.get('groups'), list):
+            return 0
+        # groups of the previous dump are included, so links to deleted groups are removed
+        known = set([a['distinguishedName'].lower() for a in previous.get('groups', []) if isinstance(a.get('distinguishedName'), str)])
+        member_of = {}
+        for group in data['groups']:
+            if not isinstance(group.get('distinguishedName'), str):
+                continue
+            known.add(group['distinguishedName'].lower())
+            members = group.get('member', [])
+            for member in members if isinstance(members, list) else [members]:
+                member_of.setdefault(str(member).lower(), []).append(group['distinguishedName'])
+        updated = 0
+        for key in [a for a in data.keys() if a not in ['info', 'schema', 'meta']]:
+            # only categories collected with memberOf are rebuilt
+            if not isinstance(data[key], list) or not [a for a in data[key] if 'memberOf' in a]:
+                continue
+            for record in data[key]:
+                if not isinstance(record.get('distinguishedName'), str):
+                    continue
+                groups = member_of.get(record['distinguishedName'].lower(), [])
+                current = record.get('memberOf', [])
+                current = current if isinstance(current, list) else [current]
+                lowered = set([a.lower() for a in groups])
+                present = set([a.lower() for a in current])
+                # links to groups outside the dump are kept, as their membership is unknown
+                rebuilt = [a for a in current if a.lower() not in known or a.lower() in lowered]
+                rebuilt += [a for a in groups if a.lower() not in present]
+                if rebuilt == current:
+                    continue
+                if rebuilt:
+                    record['memberOf'] = rebuilt
+                else:
+                    record.pop('memberOf', None)
+                updated += 1
+        return updated
+
+
+    def dirsync_search(self, base, query, attributes=ldap3.ALL_ATTRIBUTES, cookie=None):
+        '''Runs DirSync requests against naming context base until the server has no more changes, returning the changed entries and the new cookie'''
+        entries = []
+        while True:
+            self._query_delay()
+            # DirSync does its own paging through the cookie and cannot be combined with the paged results control
+            control = dir_sync_control(criticality=True, object_security=True, ancestors_first=True, public_data_only=False, incremental_values=False, max_length=DIRSYNC_MAX_BYTES, cookie=cookie)
+            self.connection.search(base, query, search_scope=ldap3.SUBTREE, attributes=attributes, controls=self.controls + [control])
+            controls = self.connection.result.get('controls') or {}
+            if DIRSYNC_CONTROL_OID not in controls:
+                raise Exception('DirSync request for {} failed: {}'.format(base, self.connection.result.get('description')))
+            entries += [a for a in self.connection.response if a.get('type') == 'searchResEntry']
+            cookie = controls[DIRSYNC_CONTROL_OID]['value']['cookie']
+            if not controls[DIRSYNC_CONTROL_OID]['value']['more_results']:
+                return entries, cookie
+
+
+    def _naming_contexts(self):
+        return {'root': self.root, 'config': self.server.info.other['configurationNamingContext'][0]}
+
+
+    def _dirsync_filter(self, nc, categories):
+        '''Returns the DirSync filter for naming context nc matching the objects of categories, or None if no categories are in it'''
+        classes = [c for a, b, d in CATEGORY_CLASSES if a in categories and b == nc for c in d['objectClass']]
+        if nc == 'config' and 'containers' in categories:
+            # configuration containers are collected alongside certificate data
+            classes += ['container', 'configuration']
+        if not classes:
+            return None
+        return '(|{})'.format(''.join(['(objectClass={})'.format(a) for a in sorted(set(classes))]))
+
+
+    def _match_categories(self, record, nc, categories):
+        '''Returns the categories from categories that an object from naming context nc belongs in'''
+        found = []
+        for category, category_nc, match in CATEGORY_CLASSES:
+            if category not in categories or category_nc != nc:
+                continue
+            for attribute in match:
+                values = record.get(attribute, [])
+                # objectCategory values are distinguished names, compared by their CN
+                values = [str(a).split(',')[0].split('=')[-1].lower() for a in (values if isinstance(values, list) else [values])]
+                if not [a for a in match[attribute] if a.lower() in values]:
+                    break
+            else:
+                found.append(category)
+        return found
+
+
+    def apply_dirsync_changes(self, data, changes):
+        '''Applies the changed attributes of entries returned by DirSync, as (naming context, entries) pairs, to the matching records in data by objectGUID'''
+        stats = {'changed': 0, 'added': 0, 'deleted': 0, 'ignored': 0}
+        categories = [a for a in data.keys() if a not in ['info', 'schema', 'meta'] and isinstance(data[a], list)]
+        index = {}
+        for category in categories:
+            for record in data[category]:
+                if record.get('objectGUID'):
+                    index.setdefault(record['objectGUID'], []).append((category, record))
+        deleted = set()
+        for nc, entries in changes:
+            for entry in entries:
+                attributes = entry['attributes']
+                guid = self.jsonify(attributes.get('objectGUID'))
+                if attributes.get('isDeleted') in [True, 'TRUE']:
+                    if guid in index:
+                        deleted.add(guid)
+                    continue
+                # distinguishedName is not replicated, the entry dn reflects any rename or move
+                if 'dn' in entry and entry['dn']:
+                    attributes['distinguishedName'] = entry['dn']
+                targets = [a[0] for a in index.get(guid, [])] or self._match_categories(attributes, nc, categories)
+                if not targets:
+                    stats['ignored'] += 1
+                    continue
+                requested = self._configure_query(targets[0], '(objectClass=*)', self.attributes)[1]
+                if not isinstance(requested, str):
+                    requested = set([a.lower() for a in requested] + ['objectguid', 'distinguishedname'])
+                    entry['attributes'] = {a: attributes[a] for a in attributes if a.lower() in requested}
+                record = next(self.iter_records([entry], targets[0]))
+                if self.post_process_data:
+                    record = self.post_process_record(targets[0], record)
+                record = self.jsonify(record)
+                if guid in index:
+                    for category, stored in index[guid]:
+                        for key in record:
+                            # attributes returned without values have been cleared
+                            if record[key] in [[], None, '']:
+                                stored.pop(key, None)
+                            else:
+                                stored[key] = record[key]
+                        if category in ['users', 'computers', 'groups']:
+                            self.update_sidlt([stored])
+                    stats['changed'] += 1
+                else:
+                    for category in targets:
+                        data[category].append(dict(record))
+                        index.setdefault(guid, []).append((category, data[category][-1]))
+                    stats['added'] += 1
+        for category in categories:
+            count = len(data[category])
+            data[category] = [a for a in data[category] if a.get('objectGUID') not in deleted]
+            stats['deleted'] += count - len(data[category])
+        return stats
+
+
+    def dirsync_query(self, methods=None):
+        '''Brings the dump in the DirSync store file up to date, performing a full collection when the store does not exist yet'''
+        naming_contexts = self._naming_contexts()
+        if not os.path.isfile(self.dirsync):
+            self.logger.info('DirSync store {} does not exist, performing full collection'.format(self.dirsync))
+            # cookies are taken first so changes made during collection are applied by the next sync, using the filter later
+            # syncs use as a cookie is only valid for the filter it was issued for, and only requesting objectGUID to limit the transfer
+            methods = self._validate_methods(methods)
+            cookies = {}
+            filters = {}
+            for nc in naming_contexts:
+                query = self._dirsync_filter(nc, methods)
+                if not query:
+                    continue
+                cookies[naming_contexts[nc]] = base64.b64encode(self.dirsync_search(naming_contexts[nc], query, ['objectGUID'])[1]).decode()
+                filters[naming_contexts[nc]] = query
+            data = self.query(methods)
+            data['meta']['dirsync'] = {'cookies': cookies, 'filters': filters, 'last_sync': data['meta']['end_time']}
+            return data
+
+        data = self.import_dump(self.dirsync)
+        meta = data.setdefault('meta', {})
+        cookies = meta.get('dirsync', {}).get('cookies')
+        if not cookies:
+            raise Exception('Dump file {} has no DirSync cookies, it was not created using DirSync'.format(self.dirsync))
+        filters = meta['dirsync'].get('filters', {})
+        categories = [a for a in data.keys() if a not in ['info', 'schema', 'meta'] and isinstance(data[a], list)]
+        changes = []
+        for nc in naming_contexts:
+            # each cookie is used with the filter it was issued for
+            query = filters.get(naming_contexts[nc]) or self._dirsync_filter(nc, categories)
+            if not query or naming_contexts[nc] not in cookies:
+                continue
+            self.logger.info('Querying DirSync changes for {}'.format(naming_contexts[nc]))
+            entries, cookie = self.dirsync_search(naming_contexts[nc], query, cookie=base64.b64decode(cookies[naming_contexts[nc]]))
+            changes.append((nc, entries))
+            cookies[naming_contexts[nc]] = base64.b64encode(cookie).decode()
+
+        stats = self.apply_dirsync_changes(data, changes)
+        self.logger.info('DirSync changes applied, {} changed, {} added, {} deleted objects'.format(stats['changed'], stats['added'], stats['deleted']))
+        meta['end_time'] = self.generate_timestamp()
+        meta['sid_lookup'] = self.sidLT
+        meta['dirsync'] = {'cookies': cookies, 'filters': filters, 'last_sync': meta['end_time'], 'stats': stats}
+        if self.post_process_data and self.dedupe_sd:
+            data = self.dedupe_security_descriptors(data)
+        return data
+
+
     def query(self, methods=None, only_schema=False, no_schema=False):
         self.start_time = self.generate_timestamp()
         out = {}
@@ -1174,50 +2034,501 @@ class AdDumper:
             self.retrieve_schema()
             out['schema'] = self.schema
         
-        if not only_schema:
-            valid_methods = self.get_valid_methods()
-
-            if not methods:
-                methods = valid_methods
-            else:
-                for method in methods:
-                    if method not in valid_methods:
-                        raise Exception('Invalid query method of {} supplied.\nValid methods are: '.format(method, ', '.join(valid_methods)))
+        self.highest_committed_usn, self.usn_dc = self.get_highest_committed_usn()
+        if self.checkpoint:
+            self._resume_collection_state()
+        previous = None
+        deleted = set()
+        if self.since and not only_schema:
+            previous = self._load_previous_dump()
+            if previous is not None:
+                deleted = self._collect_deleted_guids()
 
+        if not only_schema:
+            methods = self._validate_methods(methods)
             self.methods = methods
+            partitioned = [a for a in methods if a in self.partition_methods] if self.partitions > 1 else []
+            results = self._query_fused([a for a in methods if a not in partitioned]) if self.fuse_queries else {}
+            parallel = [a for a in methods if a not in partitioned and a not in results]
+            sid_tables = {}
+            if self.workers > 1 and parallel:
+                parallel_results, sid_tables = self._query_parallel(parallel)
+                results.update(parallel_results)
             for method in methods:
-                if self.delay:
-                    mydelay = self.delay
-                    if self.jitter:
-                        myjit = random.randint(1, self.jitter)
-                        mydelay = self.delay + myjit
-                        self.logger.debug('Adding {} seconds of jitter to delay'.format(myjit))
-                    self.logger.info('Sleeping for {} seconds between queries as per configured setting'.format(mydelay))
-                    time.sleep(mydelay)
                 method_call = getattr(self, 'query_{}'.format(method))
+                if method in results:
+                    method_data = results[method]
+                    # sid table entries from parallel steps are merged in method order, so the sid_lookup matches a serial collection
+                    self._merge_sidlt(sid_tables.get(method, {}))
+                elif method in partitioned:
+                    method_data = self._query_partitioned(method)
+                else:
+                    self._query_delay()
+                    method_data = method_call(attributes=self.attributes)
                 method_return = typing.get_type_hints(method_call).get('return')
                 if method_return == list:
                     if not method in out:
                         out[method] = []
-                    out[method] += method_call(attributes=self.attributes)
+                    out[method] += method_data
                 elif method_return == dict:
                     if not method in out:
                         out[method] = {}
-                    out[method].update(method_call(attributes=self.attributes))
+                    out[method].update(method_data)
                 else:
-                    out[method] = method_call(attributes=self.attributes)
+                    out[method] = method_data
                 if method.startswith('cert') and len(out[method]) > 0:
                     if not 'containers' in out:
                         out['containers'] = []
-                    out['containers'] += self._query_certcontainers()
+                    out['containers'] += results.pop('_certcontainers') if '_certcontainers' in results else self._query_certcontainers()
 
         out['meta'] = {'start_time': self.start_time, 'end_time' : self.generate_timestamp(), 'username': self.username, 'whoami': self.whoami(), 'server': self.host, 'methods' : list([a for a in out.keys() if a != 'schema']), 'sid_lookup' : self.sidLT}
+        if self.schema_cache_status:
+            out['meta']['schema_cache'] = self.schema_cache_status
+        out['meta']['highest_committed_usn'] = self.highest_committed_usn
+        out['meta']['usn_dc'] = self.usn_dc
+        if self.partition_stats:
+            out['meta']['partitions'] = self.partition_stats
+        if len(self.targets) > 1:
+            out['meta']['servers'] = self.target_stats
+        if self.page_stats:
+            out['meta']['page_sizes'] = self.page_stats
+        if self.fusion_stats:
+            out['meta']['query_fusion'] = self.fusion_stats
         self.logger.info('Data collection complete, processing...')
 
         if self.post_process_data:
-            return self.jsonify(self.post_process(out))
+            out = self.post_process(out)
+            out['meta']['sd_cache'] = self.sd_cache.stats()
+            out['meta']['sd_parser'] = self.sd_parser_stats()
+            out['meta']['post_process'] = self.post_process_stats
+        out = self.jsonify(out)
+        if previous is not None:
+            out['meta']['delta'] = self.merge_delta(previous, out, deleted)
+            if no_schema and 'schema' in previous:
+                # the schema was not collected this time, so the merged dump keeps the previous one
+                out = dict([('schema', previous['schema'])] + list(out.items()))
+            self.usn_filter = None
+        if self.post_process_data and self.dedupe_sd:
+            out = self.dedupe_security_descriptors(out)
+        return out
+
+
+    def _stream_prepass(self, methods, bloodhound=False):
+        '''Populates the domain and sid lookup tables needed for post processing before records are streamed, and the bloodhound lookup maps if bloodhound is set'''
+        domains = []
+        if 'domains' in methods:
+            self._query_delay()
+            domains = self.query_domains(attributes=self.attributes)
+        elif self.post_process_data:
+            self.logger.info('Domain data not collected and "auto_query_domains" enabled - collecting domain info...')
+            self._query_delay()
+            self.query_domains()
+
+        light = {}
+        if bloodhound:
+            prepass_methods = [a for a in methods if a in BH_MAP_METHODS]
+            self._record_sink = lambda category, record: light.setdefault(category, []).append(EntryView(self.jsonify(record)))
+            self._forced_attributes = SID_LOOKUP_ATTRIBUTES + BH_MAP_ATTRIBUTES
         else:
-            return self.jsonify(out)
+            prepass_methods = [a for a in methods if a in ['users', 'computers', 'groups']]
+            self._record_sink = lambda category, record: None
+            self._forced_attributes = SID_LOOKUP_ATTRIBUTES
+        try:
+            for method in prepass_methods:
+                self.logger.info('Running {} pre-pass for {}'.format('Bloodhound map' if bloodhound else 'sid lookup', method))
+                self._query_delay()
+                getattr(self, 'query_{}'.format(method))(attributes=self.attributes)
+            if bloodhound and 'containers' in methods and [a for a in methods if a.startswith('cert')]:
+                self._query_delay()
+                self._query_certcontainers()
+                # collected again in full if certificate data is found while streaming
+                self.config_containers_collected = False
+        finally:
+            self._record_sink = None
+            self._forced_attributes = None
+
+        if bloodhound:
+            # domain records are copied as they are streamed again after the pre-pass
+            light['domains'] = [EntryView(self.jsonify(dict(a))) for a in domains]
+            self.build_bh_maps({a: light.get(a, []) for a in BH_MAP_METHODS + ['domains'] if a in methods})
+        return domains
+
+
+    def stream_query(self, writer, methods=None, only_schema=False, no_schema=False, meta=None, bloodhound=None):
+        '''Collects data and streams each record through post processing to writer without holding complete categories in memory, 
+        and maps each record straight to the bloodhound output files if a BloodhoundPipeline is provided. writer can be None when only bloodhound output is wanted'''
+        self.start_time = self.generate_timestamp()
+        written = []
+        if not no_schema:
+            self.retrieve_schema()
+            if writer:
+                writer.write_value('schema', self.jsonify(self.schema))
+        self.highest_committed_usn, self.usn_dc = self.get_highest_committed_usn()
+        if self.checkpoint:
+            self._resume_collection_state()
+
+        if not only_schema:
+            methods = self._validate_methods(methods)
+            self.methods = methods
+            domains = self._stream_prepass(methods, bloodhound=bloodhound is not None)
+            pending = {}
+            fused = {}
+            current = None
+            count = 0
+            cert_data = False
+            sd_table = {}
+
+            def write_record(category, record):
+                nonlocal count
+                if self.post_process_data:
+                    record = self.post_process_record(category, record)
+                record = self.jsonify(record)
+                # mapped before security descriptors are replaced by references
+                if bloodhound:
+                    bloodhound.write_item(category, record)
+                if writer:
+                    if self.post_process_data and self.dedupe_sd:
+                        self.dedupe_record_sds(record, sd_table)
+                    writer.write_item(record)
+                count += 1
+
+            def sink(category, record):
+                if category == current:
+                    write_record(category, record)
+                else:
+                    pending.setdefault(category, []).append(record)
+
+            try:
+                queried = set()
+                if self.fuse_queries:
+                    # fused categories are held until their turn, domains are already collected by the pre-pass
+                    self._record_sink = lambda category, record: fused.setdefault(category, []).append(record)
+                    queried.update(self._query_fused([a for a in methods if a != 'domains']))
+                self._record_sink = sink
+                for method in methods:
+                    method_call = getattr(self, 'query_{}'.format(method))
+                    if typing.get_type_hints(method_call).get('return') != list:
+                        self._query_delay()
+                        value = self.jsonify(method_call(attributes=self.attributes))
+                        if writer:
+                            writer.write_value(method, value)
+                        written.append(method)
+                        continue
+                    current = method
+                    count = 0
+                    if writer:
+                        writer.start_list(method)
+                    if bloodhound:
+                        bloodhound.start_list(method)
+                    written.append(method)
+                    for record in pending.pop(method, []) + fused.pop(method, []) + (domains if method == 'domains' else []):
+                        write_record(method, record)
+                    if method != 'domains' and method not in queried:
+                        self._query_delay()
+                        method_call(attributes=self.attributes)
+                    if method == 'containers':
+                        # certificate methods after containers are queried now with their records held until their turn, so any 
+                        # configuration containers are streamed with the containers category, which query() appends them to
+                        for cert_method in [a for a in methods[methods.index(method) + 1:] if a.startswith('cert')]:
+                            if cert_method not in queried:
+                                self._query_delay()
+                                getattr(self, 'query_{}'.format(cert_method))(attributes=self.attributes)
+                                queried.add(cert_method)
+                            if (pending.get(cert_method) or fused.get(cert_method)) and not cert_data:
+                                cert_data = True
+                                self._query_certcontainers()
+                    if writer:
+                        writer.end_list()
+                    if bloodhound:
+                        bloodhound.end_list(method)
+                    current = None
+                    if method.startswith('cert') and count > 0 and not cert_data:
+                        # held in pending until the containers category is written
+                        cert_data = True
+                        self._query_certcontainers()
+            finally:
+                self._record_sink = None
+
+            if writer and self.post_process_data and self.dedupe_sd:
+                writer.write_value('security_descriptors', sd_table)
+
+        out_meta = {'start_time': self.start_time, 'end_time' : self.generate_timestamp(), 'username': self.username, 'whoami': self.whoami(), 'server': self.host, 'methods' : written, 'sid_lookup' : self.sidLT}
+        if self.schema_cache_status:
+            out_meta['schema_cache'] = self.schema_cache_status
+        out_meta['highest_committed_usn'] = self.highest_committed_usn
+        out_meta['usn_dc'] = self.usn_dc
+        if self.page_stats:
+            out_meta['page_sizes'] = self.page_stats
+        if self.fusion_stats:
+            out_meta['query_fusion'] = self.fusion_stats
+        if self.post_process_data:
+            out_meta['sd_cache'] = self.sd_cache.stats()
+            out_meta['sd_parser'] = self.sd_parser_stats()
+        out_meta.update(meta if meta else {})
+        if writer:
+            writer.write_value('meta', self.jsonify(out_meta))
+        if bloodhound:
+            bloodhound.close()
+        self.logger.info('Data collection complete')
+
+
+    def _run_pooled_step(self, pool, step, results, sid_tables):
+        '''Runs a single collection step on a connection checked out of the pool, moving it to another domain controller if its controller fails'''
+        while True:
+            target, connection = pool.get()
+            if target in self.failed_targets:
+                # connections to failed controllers are dropped from the pool as they are checked out
+                continue
+            self._local.connection = connection
+            # a failed attempt is repeated on another controller, so its sid table entries are only kept once the step succeeds
+            self._local.sid_table = {}
+            start = time.time()
+            try:
+                if step == '_certcontainers':
+                    # only collected when a certificate query returned data, matching the serial behaviour
+                    if not [a for a in results if a.startswith('cert') and len(results[a]) > 0]:
+                        data = []
+                    else:
+                        self._query_delay()
+                        data = self._query_certcontainers()
+                else:
+                    self._query_delay()
+                    data = getattr(self, 'query_{}'.format(step))(attributes=self.attributes)
+            except Exception as e:
+                # the primary controller is never dropped, matching partitioned queries
+                if target == self.targets[0] or not [a for a in self._pool_targets if a != target and a not in self.failed_targets]:
+                    pool.put((target, connection))
+                    raise
+                self._target_failed(target, e)
+                if step == '_certcontainers':
+                    self.config_containers_collected = False
+                continue
+            finally:
+                # the connection is replaced if it was reconnected during the step
+                connection = self._local.connection
+                self._local.connection = None
+                sid_table = self._local.sid_table
+                self._local.sid_table = None
+            sid_tables[step] = sid_table
+            self._record_target_time(target, step, time.time() - start)
+            pool.put((target, connection))
+            return data
+
+
+    def _query_parallel(self, methods):
+        '''Runs query methods concurrently over a bounded pool of LDAP connections spread across the domain controllers, scheduling steps as their dependencies complete
+
+        Returns the results and the sid table entries gathered by each step, for merging in method order'''
+        steps = list(methods)
+        if 'containers' in methods and [a for a in methods if a.startswith('cert')]:
+            steps.append('_certcontainers')
+        pool_size = min(self.workers, len(steps))
+        self.logger.info('Running {} collection steps in parallel using {} LDAP connections to {} domain controllers'.format(len(steps), pool_size, len(self.targets)))
+        pool = queue.Queue()
+        pool.put((self.targets[0], self._connection))
+        self._pool_targets = set([self.targets[0]])
+        extra_connections = []
+        for index in range(1, pool_size):
+            target = self.targets[index % len(self.targets)]
+            if target in self.failed_targets:
+                continue
+            try:
+                extra_connections.append(self._create_connection(target)[1])
+            except Exception as e:
+                # a controller that cannot be connected to only ends the run when it is the primary
+                self._target_failed(target, e)
+                continue
+            pool.put((target, extra_connections[-1]))
+            self._pool_targets.add(target)
+
+        results = {}
+        sid_tables = {}
+        pending = list(steps)
+        running = {}
+        try:
+            with ThreadPoolExecutor(max_workers=pool_size) as executor:
+                while pending or running:
+                    for step in [a for a in pending if not [b for b in QUERY_DEPENDENCIES.get(a, []) if b in pending or b in running.values()]]:
+                        pending.remove(step)
+                        running[executor.submit(self._run_pooled_step, pool, step, results, sid_tables)] = step
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        step = running.pop(future)
+                        results[step] = future.result()
+                        self.logger.debug('Collection step {} complete'.format(step))
+        finally:
+            for connection in extra_connections:
+                try:
+                    connection.unbind()
+                except Exception as e:
+                    self.logger.debug('Error closing pooled connection: {}'.format(e))
+        return results, sid_tables
+
+
+    def _query_fused(self, methods):
+        '''Collects the methods that share a naming context with a single paged search of it, routing each object to its categories by class'''
+        naming_contexts = self._naming_contexts()
+        plans = {}
+        for category, nc, match in CATEGORY_CLASSES:
+            # objects returned by custom filters from the query config cannot be routed by class
+            if category not in methods or category not in FUSION_METHODS or 'query' in (self.config or {}).get(category, {}):
+                continue
+            query, attributes = self._configure_query(category, '(objectClass={})'.format(match['objectClass'][0]), self.attributes)
+            plans.setdefault(nc, []).append((category, query, attributes))
+
+        results = {}
+        for nc in plans:
+            if len(plans[nc]) < 2:
+                continue
+            categories = [a[0] for a in plans[nc]]
+            requested = {a[0]: None if isinstance(a[2], str) else set([b.lower() for b in a[2]]) for a in plans[nc]}
+            if [a for a in requested if requested[a] is None]:
+                attributes = ldap3.ALL_ATTRIBUTES
+            else:
+                attributes = list(OrderedDict.fromkeys([b for a in plans[nc] for b in a[2]] + ['objectClass', 'objectCategory']))
+            query = '(|{})'.format(''.join([a[1] for a in plans[nc]]))
+            self.logger.info('Querying {} objects from LDAP with a single search'.format(', '.join(categories)))
+            self._query_delay()
+            for category in categories:
+                results[category] = []
+            # counted as routed, as records are handed to the record sink rather than returned when streaming
+            counts = {a: 0 for a in categories}
+            for entry in self.paged_search(naming_contexts[nc], query, controls=self.controls, attributes=attributes, category='+'.join(categories)):
+                if entry.get('type') != 'searchResEntry' or 'attributes' not in entry:
+                    continue
+                matched = self._match_categories(entry['attributes'], nc, categories)
+                for category in matched:
+                    # objects in more than one category, such as group policy containers, are processed separately for each
+                    record = copy.deepcopy(entry['attributes']) if len(matched) > 1 else entry['attributes']
+                    if requested[category] is not None:
+                        record = {a: record[a] for a in record if a.lower() in requested[category]}
+                    results[category] += self.parse_records([{'type': 'searchResEntry', 'dn': entry['dn'], 'attributes': record}], category)
+                    counts[category] += 1
+            self.fusion_stats[naming_contexts[nc]] = counts
+        return results
+
+
+    def _partition_filters(self, highest_committed_usn):
+        '''Returns filters splitting objects into disjoint uSNCreated ranges up to highest_committed_usn, in ascending order'''
+        width = highest_committed_usn // self.partitions + 1
+        bounds = [width * a for a in range(1, self.partitions)]
+        filters = ['(uSNCreated<={})'.format(bounds[0] - 1)]
+        filters += ['(&(uSNCreated>={})(uSNCreated<={}))'.format(a, b - 1) for a, b in zip(bounds, bounds[1:])]
+        # objects created after the highestCommittedUSN was read fall into the open ended last partition
+        filters.append('(uSNCreated>={})'.format(bounds[-1]))
+        return filters
+
+
+    def _query_partitioned(self, method):
+        '''Runs a query method as disjoint partitions concurrently over separate LDAP connections to one domain controller, merging the results by objectGUID'''
+        method_call = getattr(self, 'query_{}'.format(method))
+        # USNs are local to each domain controller, so all partitions of a method are searched on the same one
+        targets = [a for a in self.targets if a not in self.failed_targets]
+        target = targets[self._partition_counter % len(targets)]
+        self._partition_counter += 1
+        # a resumed collection splits the method into the same partitions on the same controller, so the checkpointed searches match
+        recorded = self.collection_checkpoint.state['partitions'].get(method) if self.collection_checkpoint else None
+        if recorded and recorded['target'] in targets:
+            target = recorded['target']
+        start = time.time()
+        extra_connections = []
+        try:
+            # every partition has its own connection, so a reconnect in a partition never replaces the main connection
+            if target == self.targets[0]:
+                highest_committed_usn = self.highest_committed_usn
+            else:
+                extra_connections.append(self._create_connection(target)[1])
+                if recorded and recorded['target'] == target:
+                    highest_committed_usn = recorded['highest_committed_usn']
+                else:
+                    self._local.connection = extra_connections[0]
+                    try:
+                        highest_committed_usn = self.get_highest_committed_usn()[0]
+                    finally:
+                        self._local.connection = None
+            if not highest_committed_usn:
+                self.logger.warning('No highestCommittedUSN available to partition {} by, querying without partitions'.format(method))
+                self._query_delay()
+                return method_call(attributes=self.attributes)
+            if self.collection_checkpoint:
+                self.collection_checkpoint.state['partitions'][method] = {'target': target, 'highest_committed_usn': highest_committed_usn}
+                self.collection_checkpoint.save()
+            filters = self._partition_filters(highest_committed_usn)
+            self.logger.info('Querying {} in {} partitions using {} LDAP connections to {}'.format(method, len(filters), len(filters), target))
+            for _ in range(len(extra_connections), len(filters)):
+                extra_connections.append(self._create_connection(target)[1])
+
+            def run_partition(index):
+                self._local.connection = extra_connections[index]
+                self._local.partition = filters[index]
+                self._local.sid_table = {}
+                try:
+                    self._query_delay()
+                    return method_call(attributes=self.attributes), self._local.sid_table
+                finally:
+                    # a reconnect replaces the thread's connection, and the replacement is the one closed afterwards
+                    extra_connections[index] = self._local.connection
+                    self._local.connection = None
+                    self._local.partition = None
+                    self._local.sid_table = None
+
+            with ThreadPoolExecutor(max_workers=len(filters)) as executor:
+                results = list(executor.map(run_partition, range(len(filters))))
+        except Exception as e:
+            # the failed controller is dropped and the method repeated on another, the primary controller is never dropped
+            if target == self.targets[0]:
+                raise
+            self._target_failed(target, e)
+            return self._query_partitioned(method)
+        finally:
+            for connection in extra_connections:
+                try:
+                    connection.unbind()
+                except Exception as e:
+                    self.logger.debug('Error closing partition connection: {}'.format(e))
+        self._record_target_time(target, method, time.time() - start)
+        # sid table entries are merged in partition order rather than as each partition completes
+        for _, sid_table in results:
+            self._merge_sidlt(sid_table)
+        results = [a for a, _ in results]
+
+        # pages are returned in reverse, so the merged records are sorted by uSNCreated rather than left in partition order
+        data = []
+        seen = set()
+        duplicates = 0
+        for partition in results:
+            for record in partition:
+                if record.get('objectGUID') in seen:
+                    duplicates += 1
+                    continue
+                if record.get('objectGUID'):
+                    seen.add(record['objectGUID'])
+                data.append(record)
+        data.sort(key=self._usn_created)
+        self.partition_stats[method] = {'counts': [len(a) for a in results], 'duplicates': duplicates, 'server': target}
+        return data
+
+
+    @staticmethod
+    def _usn_created(record):
+        value = record.get('uSNCreated')
+        try:
+            return int(value[0] if isinstance(value, list) else value)
+        except (TypeError, ValueError, IndexError):
+            return 0
+
+
+    def _target_failed(self, target, error):
+        self.logger.warning('Domain controller {} failed and will not be used for further collection steps: {}'.format(target, error))
+        with self._throttle_lock:
+            self.failed_targets.add(target)
+            self.target_stats[target]['failed'] = True
+
+
+    def _record_target_time(self, target, step, seconds):
+        with self._throttle_lock:
+            self.target_stats[target]['steps'][step] = round(seconds, 3)
+            self.target_stats[target]['seconds'] = round(self.target_stats[target]['seconds'] + seconds, 3)
 
 
     def run_custom_query(self, query, attributes=ldap3.ALL_ATTRIBUTES, parse_records=True, controls=None):
@@ -1234,44 +2545,129 @@ class AdDumper:
             self.logger.info('Domain data not collected and "auto_query_domains" enabled - collecting domain info...')
             self.query_domains()
 
+        start = time.time()
+        keys = [a for a in data.keys() if a not in ['info', 'schema', 'meta']]
+        self.post_process_stats = {'processes': self.processes}
+        if self.processes > 1:
+            self._post_process_parallel(data, keys)
+        else:
+            for key in keys:
+                for index in range(0, len(data[key])):
+                    data[key][index] = self.post_process_record(key, data[key][index])
+        self.post_process_stats['seconds'] = round(time.time() - start, 3)
+        return data
+
+
+    def _post_process_parallel(self, data, keys):
+        '''Post processes records from categories keys across a pool of worker processes, replacing them in their original order'''
+        # workers get a read only copy of the lookups used by post_process_record, pickled once up front
+        snapshot = pickle.dumps({'sidLT': self.sidLT, 'domainLT': self.domainLT, 'domainLTNB': self.domainLTNB, 'object_types': self.object_types, 
+                                 'raw': self.raw, 'sd_parser': self.sd_parser, 'sd_cache_size': self.sd_cache.maxsize, 'logger': self.logger.name, 
+                                 'loglevel': self.logger.getEffectiveLevel()})
+        stats = {'chunksize': self.process_chunksize, 'snapshot_bytes': len(snapshot), 'chunks': 0, 'task_bytes': 0, 'result_bytes': 0, 
+                 'task_serialise_seconds': 0.0, 'result_deserialise_seconds': 0.0, 'worker_serialise_seconds': 0.0}
+        self.logger.debug('Post processing {} records using {} processes with chunk size {}'.format(sum([len(data[a]) for a in keys]), self.processes, self.process_chunksize))
+
+        # chunks are pickled explicitly on both sides so the cost of passing records between processes can be measured
+        def tasks():
+            for key in keys:
+                for start in range(0, len(data[key]), self.process_chunksize):
+                    serialise_start = time.time()
+                    task = pickle.dumps((key, data[key][start:start + self.process_chunksize]))
+                    stats['task_serialise_seconds'] += time.time() - serialise_start
+                    stats['chunks'] += 1
+                    stats['task_bytes'] += len(task)
+                    yield task
+
+        workers = {}
+        with multiprocessing.Pool(self.processes, initializer=_post_process_worker_init, initargs=(snapshot,)) as pool:
+            results = pool.imap(_post_process_worker, tasks())
+            for key in keys:
+                records = []
+                while len(records) < len(data[key]):
+                    result, worker_stats = next(results)
+                    deserialise_start = time.time()
+                    records += pickle.loads(result)
+                    stats['result_deserialise_seconds'] += time.time() - deserialise_start
+                    stats['result_bytes'] += len(result)
+                    stats['worker_serialise_seconds'] += worker_stats.pop('serialise_seconds')
+                    # worker counters are cumulative, so the latest from each worker is kept
+                    workers[worker_stats['pid']] = worker_stats
+                data[key] = records
+
+        # the descriptor cache and parser counters of the workers are added to this process's counters reported in the meta
+        for worker in workers.values():
+            self.sd_cache.merge_stats(worker['sd_cache'])
+        self.sd_parser_checks += sum([a['sd_parser_checks'] for a in workers.values()])
+        self.sd_parser_mismatches += sum([a['sd_parser_mismatches'] for a in workers.values()])
+        for key in [a for a in stats if a.endswith('_seconds')]:
+            stats[key] = round(stats[key], 3)
+        stats['workers'] = [{'records': a['records'], 'sd_cache': a['sd_cache']} for _, a in sorted(workers.items())]
+        self.post_process_stats.update(stats)
+
+
+    def dedupe_record_sds(self, record, table):
+        '''Replaces the parsed and raw security descriptors in a post processed record with a reference to a single copy in table'''
+        for sd in SD_FIELDS:
+            if sd in record and not isinstance(record[sd], str):
+                entry = {'parsed': record[sd]}
+                if '{}_raw'.format(sd) in record:
+                    entry['raw'] = record.pop('{}_raw'.format(sd))
+                # keyed on content, as the same parsed object can not be relied on for the same descriptor
+                key = hashlib.sha256(json.dumps(entry, sort_keys=True).encode()).hexdigest()
+                table.setdefault(key, entry)
+                record[sd] = key
+
+
+    def dedupe_security_descriptors(self, data):
+        '''Moves each distinct security descriptor in post processed data into a security_descriptors table referenced by hash'''
+        table = {}
         for key in [a for a in data.keys() if a not in ['info', 'schema', 'meta']]:
-            for index in range(0, len(data[key])):
-                for sd in ['nTSecurityDescriptor', 'msDS-GroupMSAMembership', 'msDS-AllowedToActOnBehalfOfOtherIdentity']:
-                    if sd in data[key][index]:
-                        if data[key][index][sd] and isinstance(data[key][index][sd], bytes):
-                            if self.raw:
-                                data[key][index]['{}_raw'.format(sd)] = data[key][index][sd]
-                            parsed = {}
-                            try: 
-                                parsed = self.parseSecurityDescriptor(data[key][index][sd])
-                            except Exception as e:
-                                self.logger.debug('Error in parsing security descriptor data in field {}: {}'.format(sd, str(e)))
-                            data[key][index][sd] = parsed
-                        else:
-                            # delete empty entries added by explicitly requesting attribute
-                            del data[key][index][sd]
-
-                if 'domains' not in key:
-                    if 'objectSid' in data[key][index] and data[key][index]['objectSid']:
-                        domainsid = self.get_domain_sid(data[key][index]['objectSid'])
-                        if domainsid in self.domainLT:
-                            data[key][index]['domain'] = self.domainLT[domainsid]
-                        if domainsid in self.domainLTNB:
-                            data[key][index]['domainShort'] = self.domainLTNB[domainsid]
-                for field in ['securityIdentifier', 'sIDHistory']:
-                    if field in data[key][index]:
-                        try:
-                            if isinstance(data[key][index][field], bytes):
-                                data[key][index][field] = LDAP_SID(data[key][index][field]).formatCanonical()
-                            elif isinstance(data[key][index][field], list): 
-                                items = []
-                                for sid in data[key][index][field]:
-                                    items += [LDAP_SID(sid).formatCanonical()]                                
-                                data[key][index][field] = items
-                        except Exception as e:
-                            self.logger.debug('Post processing of field {} in key {} failed with error {}' .format(field, key, e))
-                            pass
+            for record in data[key]:
+                self.dedupe_record_sds(record, table)
+        data['security_descriptors'] = table
+        self.logger.debug('Deduplicated security descriptors to {} distinct entries'.format(len(table)))
         return data
+
+
+    def post_process_record(self, key, record):
+        '''Parses security descriptors, tags domain details and canonicalises sids for a single record from category key'''
+        for sd in SD_FIELDS:
+            if sd in record:
+                if record[sd] and isinstance(record[sd], bytes):
+                    if self.raw:
+                        record['{}_raw'.format(sd)] = record[sd]
+                    parsed = {}
+                    try: 
+                        parsed = self.sd_cache.get(record[sd], self.parseSecurityDescriptor)
+                    except Exception as e:
+                        self.logger.debug('Error in parsing security descriptor data in field {}: {}'.format(sd, str(e)))
+                    record[sd] = parsed
+                else:
+                    # delete empty entries added by explicitly requesting attribute
+                    del record[sd]
+
+        if 'domains' not in key:
+            if 'objectSid' in record and record['objectSid']:
+                domainsid = self.get_domain_sid(record['objectSid'])
+                if domainsid in self.domainLT:
+                    record['domain'] = self.domainLT[domainsid]
+                if domainsid in self.domainLTNB:
+                    record['domainShort'] = self.domainLTNB[domainsid]
+        for field in ['securityIdentifier', 'sIDHistory']:
+            if field in record:
+                try:
+                    if isinstance(record[field], bytes):
+                        record[field] = LDAP_SID(record[field]).formatCanonical()
+                    elif isinstance(record[field], list): 
+                        items = []
+                        for sid in record[field]:
+                            items += [LDAP_SID(sid).formatCanonical()]                                
+                        record[field] = items
+                except Exception as e:
+                    self.logger.debug('Post processing of field {} in key {} failed with error {}' .format(field, key, e))
+                    pass
+        return record
     
 
     # convert PKI period format, based on bh code from below
@@ -1306,17 +2702,17 @@ class AdDumper:
 
     def _fp(self, obj, name, default=None):
         '''Internal case insensitive property fetcher'''
-        matching_keys = [a for a in obj.keys() if a.lower() == name.lower()]
-        if matching_keys:
-            if name.lower().startswith('when') or name.lower().startswith('last') or name.lower() in ['pwdlastset']:
-                if obj[matching_keys[0]]:
-                    return self._dtt(obj[matching_keys[0]])
-            else:
-                if obj[matching_keys[0]]:
-                    return obj[matching_keys[0]]
-            return default
+        if name not in self.bh_field_names:
+            lname = name.lower()
+            self.bh_field_names[name] = (lname, lname.startswith('when') or lname.startswith('last') or lname in ['pwdlastset'])
+        lname, time_field = self.bh_field_names[name]
+        if isinstance(obj, EntryView):
+            key = obj.keymap.get(lname)
         else:
-            return default
+            key = next((a for a in obj.keys() if a.lower() == lname), None)
+        if key is not None and obj[key]:
+            return self._dtt(obj[key]) if time_field else obj[key]
+        return default
 
 
     def _dtt(self, time):
@@ -1368,6 +2764,8 @@ class AdDumper:
         sd = entry['nTSecurityDescriptor']
         dacls = sd['Dacls']
         owner = sd['OwnerSid']
+        rules = self.get_bh_acl_rules(objectClass)
+        laps = 'ms-Mcs-AdmPwdExpirationTime' in entry
         
 
         ignore_conditions = [
@@ -1386,147 +2784,46 @@ class AdDumper:
             out.append(build_hb_acl(owner, self._ft(owner), 'Owns', False))
         
         for dacl in dacls:
-            GenericWrite = False 
-            WriteDacl = False 
-            WriteOwner = False 
-            AllExtendedRights = False
-
             # ignore conditions, skip dacl if any are true
             if [a for a in ignore_conditions if a(dacl)]:
                 continue
 
+            object_type = None
             if dacl['Type'] == 'ACCESS_ALLOWED_OBJECT_ACE':
                 # inherited ace with the InheritableObjectType not matching this object type
                 if 'INHERITED_ACE' in dacl['Flags'] and 'ACE_INHERITED_OBJECT_TYPE_PRESENT' in dacl.get('Ace_Data_Flags', []) and dacl.get('InheritableObjectType', '') != objectClass:
                     continue
+                if 'ACE_OBJECT_TYPE_PRESENT' in dacl.get('Ace_Data_Flags', []):
+                    object_type = dacl['ControlObjectType']
 
-                if 'GENERIC_ALL' in dacl['Privs']:
-                    # check for laps
-                    if (objectClass.lower() == 'computer' and 'ACE_OBJECT_TYPE_PRESENT' in dacl.get('Ace_Data_Flags', []) and 'ms-Mcs-AdmPwdExpirationTime' in entry 
-                    and dacl['ControlObjectType'].lower() in ['ms-mcs-admpwd', 'allproperties']):
-                        out.append(build_hb_acl(dacl['Sid'], self._ft(dacl['Sid']), 'ReadLAPSPassword', inherited(dacl)))
-                    else:
-                        out.append(build_hb_acl(dacl['Sid'], self._ft(dacl['Sid']), 'GenericAll', inherited(dacl)))
-                        continue # implies all other permissions
-
-                # GenericWrite
-                if 'GENERIC_WRITE' in dacl['Privs']:
-                     GenericWrite = True
-
-                if ('ADS_RIGHT_DS_WRITE_PROP' in dacl['Privs'] and objectClass.lower() in ['user', 'group', 'computer', 'gpo'] 
-                and 'ACE_OBJECT_TYPE_PRESENT' not in dacl.get('Ace_Data_Flags', [])):
-                    GenericWrite = True
-                
-                # WriteDacl
-                if 'WRITE_DACL' in dacl['Privs']:
-                    WriteDacl = True
-                
-                # WriteOwner
-                if 'WRITE_OWNER' in dacl['Privs']:
-                    WriteOwner = True
-                
-                # AllExtendedRights
-                if ('ADS_RIGHT_DS_CONTROL_ACCESS' in dacl['Privs'] and objectClass.lower() in ['user', 'domain', 'computer', 'pki-certificate-template']
-                and (('ACE_OBJECT_TYPE_PRESENT' not in dacl.get('Ace_Data_Flags', [])) or (dacl['ControlObjectType'] == 'AllProperties')) ):
-                    AllExtendedRights = True
-
-
-                if GenericWrite:
-                    out.append(build_hb_acl(dacl['Sid'], self._ft(dacl['Sid']), 'GenericWrite', inherited(dacl)))
-                if WriteDacl:
-                    out.append(build_hb_acl(dacl['Sid'], self._ft(dacl['Sid']), 'WriteDacl', inherited(dacl)))
-                if WriteOwner:
-                    out.append(build_hb_acl(dacl['Sid'], self._ft(dacl['Sid']), 'WriteOwner', inherited(dacl)))
-                if AllExtendedRights:
-                    out.append(build_hb_acl(dacl['Sid'], self._ft(dacl['Sid']), 'AllExtendedRights', inherited(dacl)))                
-
-                # https://github.com/BloodHoundAD/SharpHoundCommon/blob/1ccdb773d3af19718f410d9795ca9977019b5a85/src/CommonLib/Processors/ACLProcessor.cs 
-                    
-
-                if ('ADS_RIGHT_DS_WRITE_PROP' in dacl['Privs'] or GenericWrite) and 'ACE_OBJECT_TYPE_PRESENT' in dacl['Ace_Data_Flags']:
-                    if objectClass.lower() == 'group' and dacl['ControlObjectType'] in ['Member', 'AllProperties']:
-                        out.append(build_hb_acl(dacl['Sid'], self._ft(dacl['Sid']), 'AddMember', inherited(dacl)))
-                    elif objectClass.lower() == 'computer' and dacl['ControlObjectType'] in ['ms-DS-Allowed-To-Act-On-Behalf-Of-Other-Identity', 'AllProperties']:
-                        out.append(build_hb_acl(dacl['Sid'], self._ft(dacl['Sid']), 'AddAllowedToAct', inherited(dacl)))
-                    elif objectClass.lower() == 'computer' and dacl['ControlObjectType'] in ['User-Account-Restrictions', 'AllProperties']:
-                        out.append(build_hb_acl(dacl['Sid'], self._ft(dacl['Sid']), 'WriteAccountRestrictions', inherited(dacl)))
-                    elif objectClass.lower() in ['computer', 'user', 'ms-ds-group-managed-service-account'] and dacl['ControlObjectType'] in ['ms-DS-Key-Credential-Link', 'AllProperties']:
-                        out.append(build_hb_acl(dacl['Sid'], self._ft(dacl['Sid']), 'AddKeyCredentialLink', inherited(dacl)))
-                    elif objectClass.lower() == 'user' and dacl['ControlObjectType'] in ['Service-Principal-Name', 'AllProperties']:
-                        out.append(build_hb_acl(dacl['Sid'], self._ft(dacl['Sid']), 'WriteSPN', inherited(dacl)))
-                    elif objectClass.lower() == 'pki-certificate-template' and dacl['ControlObjectType'] in ['ms-PKI-Enrollment-Flag', 'AllProperties']:
-                        out.append(build_hb_acl(dacl['Sid'], self._ft(dacl['Sid']), 'WritePKIEnrollmentFlag', inherited(dacl)))
-                    elif objectClass.lower() == 'pki-certificate-template' and dacl['ControlObjectType'] in ['ms-PKI-Certificate-Name-Flag', 'AllProperties']:
-                        out.append(build_hb_acl(dacl['Sid'], self._ft(dacl['Sid']), 'WritePKINameFlag', inherited(dacl)))
-
-
-                if ('ADS_RIGHT_DS_SELF' in dacl['Privs'] and objectClass.lower() == 'group' and 'ACE_OBJECT_TYPE_PRESENT' in dacl.get('Ace_Data_Flags', [])
-                and dacl['ControlObjectType'] in ['Member', 'AllProperties']):
-                    out.append(build_hb_acl(dacl['Sid'], self._ft(dacl['Sid']), 'AddSelf', inherited(dacl)))
-                    
-                if ('ADS_RIGHT_DS_READ_PROP' in dacl['Privs'] and objectClass.lower() == 'computer' and 
-                'ACE_OBJECT_TYPE_PRESENT' in dacl.get('Ace_Data_Flags', []) and 'ms-Mcs-AdmPwdExpirationTime' in entry and 
-                dacl['ControlObjectType'].lower() in ['ms-mcs-admpwd', 'allproperties']):
-                    out.append(build_hb_acl(dacl['Sid'], self._ft(dacl['Sid']), 'ReadLAPSPassword', inherited(dacl)))
-
-                if 'ADS_RIGHT_DS_CONTROL_ACCESS' in dacl['Privs']:
-                    if objectClass.lower() == 'user' and 'ACE_OBJECT_TYPE_PRESENT' in dacl.get('Ace_Data_Flags', []) and dacl['ControlObjectType'] in ['User-Force-Change-Password', 'AllProperties']:
-                        out.append(build_hb_acl(dacl['Sid'], self._ft(dacl['Sid']), 'ForceChangePassword', inherited(dacl)))
-
-                    if objectClass.lower() == 'domain' and 'ACE_OBJECT_TYPE_PRESENT' in dacl.get('Ace_Data_Flags', []):
-                        if dacl['ControlObjectType'] in ['DS-Replication-Get-Changes', 'AllProperties']:
-                            out.append(build_hb_acl(dacl['Sid'], self._ft(dacl['Sid']), 'GetChanges', inherited(dacl)))
-                        if dacl['ControlObjectType'] in ['DS-Replication-Get-Changes-All', 'AllProperties']:
-                            out.append(build_hb_acl(dacl['Sid'], self._ft(dacl['Sid']), 'GetChangesAll', inherited(dacl)))
-                        if dacl['ControlObjectType'] in ['DS-Replication-Get-Changes-In-Filtered-Set', 'AllProperties']:
-                            out.append(build_hb_acl(dacl['Sid'], self._ft(dacl['Sid']), 'GetChangesInFilteredSet', inherited(dacl)))
-                    
-                    if objectClass.lower() == 'pki-enrollment-service' and 'ACE_OBJECT_TYPE_PRESENT' in dacl.get('Ace_Data_Flags', []) and dacl['ControlObjectType'] in ['Certificate-Enrollment', 'Certificate-AutoEnrollment', 'AllProperties']:
-                        out.append(build_hb_acl(dacl['Sid'], self._ft(dacl['Sid']), 'Enroll', inherited(dacl)))
-
-                    if objectClass.lower() == 'pki-certificate-template' and 'ACE_OBJECT_TYPE_PRESENT' in dacl.get('Ace_Data_Flags', []) and dacl['ControlObjectType'] in ['Certificate-Enrollment', 'Certificate-AutoEnrollment', 'AllProperties']:
-                        out.append(build_hb_acl(dacl['Sid'], self._ft(dacl['Sid']), 'Enroll', inherited(dacl)))
-                    
-
-                    
-
-
-            elif dacl['Type'] == 'ACCESS_ALLOWED_ACE':
-                if 'GENERIC_ALL' in dacl['Privs']:
-                    out.append(build_hb_acl(dacl['Sid'], self._ft(dacl['Sid']), 'GenericAll', inherited(dacl)))
-                    continue # this implies all other rights
-                
-                if 'ADS_RIGHT_DS_WRITE_PROP' in dacl['Privs'] and objectClass.lower() in ['user', 'group', 'computer', 'gpo', 'ms-ds-group-managed-service-account']:
-                    GenericWrite = True
-                
-                if 'WRITE_OWNER' in dacl['Privs']:
-                    WriteOwner = True
-                
-                if 'ADS_RIGHT_DS_CONTROL_ACCESS' in dacl['Privs'] and objectClass.lower() in ['user', 'domain', 'ms-ds-group-managed-service-account', 'computer']:
-                    AllExtendedRights = True
-
-                #if ('ADS_RIGHT_DS_CONTROL_ACCESS' in dacl['Privs'] and objectClass.lower() == 'computer'): 
-                #and not dacl['Sid'].endswith('-512')):
-                #dacl['Sid'] != 'S-1-5-32-544' and not dacl['Sid'].endswith('-512')):
-                    #AllExtendedRights = True
-
-                if 'WRITE_DACL' in dacl['Privs']:
-                    WriteDacl = True
-
-                if GenericWrite:
-                    out.append(build_hb_acl(dacl['Sid'], self._ft(dacl['Sid']), 'GenericWrite', inherited(dacl)))
-                if WriteDacl:
-                    out.append(build_hb_acl(dacl['Sid'], self._ft(dacl['Sid']), 'WriteDacl', inherited(dacl)))
-                if WriteOwner:
-                    out.append(build_hb_acl(dacl['Sid'], self._ft(dacl['Sid']), 'WriteOwner', inherited(dacl)))
-                if AllExtendedRights:
-                    out.append(build_hb_acl(dacl['Sid'], self._ft(dacl['Sid']), 'AllExtendedRights', inherited(dacl))) 
-                if objectClass.lower() == 'pki-enrollment-service' and 'GENERIC_WRITE' in dacl['Privs']:
-                    out.append(build_hb_acl(dacl['Sid'], self._ft(dacl['Sid']), 'ManageCA', inherited(dacl))) 
-                    if 'ADS_RIGHT_DS_DELETE_CHILD' in dacl['Privs']:
-                        out.append(build_hb_acl(dacl['Sid'], self._ft(dacl['Sid']), 'ManageCertificates', inherited(dacl))) 
+            matched_groups = set()
+            for right, mask, object_types, options in rules[dacl['Type']]:
+                if dacl['Mask'] & mask != mask or options.get('group') in matched_groups:
+                    continue
+                if options.get('laps') and not (laps and object_type and object_type.lower() in object_types):
+                    continue
+                if object_types is not None and not options.get('laps') and object_type not in object_types:
+                    continue
+                out.append(build_hb_acl(dacl['Sid'], self._ft(dacl['Sid']), right, inherited(dacl)))
+                if 'group' in options:
+                    matched_groups.add(options['group'])
+                if options.get('terminal'):
+                    break
 
         return out
+
+
+    def get_bh_acl_rules(self, objectClass):
+        '''Returns the BH_ACL_RULES that apply to objectClass by ace type, compiled to integer access masks and cached per object class'''
+        objectClass = objectClass.lower()
+        if objectClass not in self.bh_acl_rules:
+            rules = {'ACCESS_ALLOWED_OBJECT_ACE': [], 'ACCESS_ALLOWED_ACE': []}
+            for ace_type, right, rights, classes, object_types, options in BH_ACL_RULES:
+                if classes is None or objectClass in classes:
+                    mask = reduce(lambda x, y: x | y, [self.access_masks[a] for a in rights])
+                    rules[ace_type].append((right, mask, frozenset(object_types) if object_types is not None else None, options))
+            self.bh_acl_rules[objectClass] = rules
+        return self.bh_acl_rules[objectClass]
     
     def _get_entry_id(self, entry):        
         sid = self._fp(entry, 'objectSid')
@@ -1619,7 +2916,7 @@ class AdDumper:
         unique_properties = {
             'name' : '{}@{}'.format(self._fp(entry, 'name').upper(), domainName.upper()),
             'domain': domainName.upper(),
-            'domainsid': {self.domainLT[a]:a for a in self.domainLT}[domainName] if domainName in self.domainLT.values() else '',
+            'domainsid': self.bh_domain_sid_map.get(domainName, ''),
             'flags': ', '.join(self._fp(entry, 'flags', [])), 
             'caname' : self._fp(entry, 'name'),
             'dnshostname': self._fp(entry, 'dNSHostName'),
@@ -1646,7 +2943,7 @@ class AdDumper:
         unique_properties = {
             'name' : '{}@{}'.format(self._fp(entry, 'name').upper(), domainName.upper()),
             'domain': domainName.upper(),
-            'domainsid': {self.domainLT[a]:a for a in self.domainLT}[domainName] if domainName in self.domainLT.values() else '',
+            'domainsid': self.bh_domain_sid_map.get(domainName, ''),
             'certchain': [a.digest('sha1').decode('utf8').replace(':', '') for a in certs],
             'certthumbprint' : cert1['certthumbprint'],
             'certname': cert1['certname'],
@@ -1667,11 +2964,11 @@ class AdDumper:
         unique_properties = {
             'name' : '{}@{}'.format(self._fp(entry, 'name').upper(), domainName.upper()),
             'domain': domainName.upper(),
-            'domainsid': {self.domainLT[a]:a for a in self.domainLT}[domainName] if domainName in self.domainLT.values() else '',
+            'domainsid': self.bh_domain_sid_map.get(domainName, ''),
             'certthumbprints': [a.digest('sha1').decode('utf8').replace(':', '') for a in certs]
         }
         out['Properties'].update(unique_properties)
-        out['DomainSID'] = {self.domainLT[a]:a for a in self.domainLT}[domainName] if domainName in self.domainLT.values() else ''
+        out['DomainSID'] = self.bh_domain_sid_map.get(domainName, '')
         del out['Properties']['displayname']
         return out
 
@@ -1684,7 +2981,7 @@ class AdDumper:
         unique_properties = {
             'name' : '{}@{}'.format(self._fp(entry, 'name').upper(), domainName.upper()),
             'domain': domainName.upper(),
-            'domainsid': {self.domainLT[a]:a for a in self.domainLT}[domainName] if domainName in self.domainLT.values() else '',
+            'domainsid': self.bh_domain_sid_map.get(domainName, ''),
             'certchain': [a.digest('sha1').decode('utf8').replace(':', '') for a in certs],
             'certthumbprint' : cert1['certthumbprint'],
             'certname': cert1['certname'],
@@ -1692,7 +2989,7 @@ class AdDumper:
             'basicconstraintpathlength': cert1['basicconstraintpathlength']
         }
         out['Properties'].update(unique_properties)
-        out['DomainSID'] = {self.domainLT[a]:a for a in self.domainLT}[domainName] if domainName in self.domainLT.values() else '',
+        out['DomainSID'] = self.bh_domain_sid_map.get(domainName, ''),
         del out['Properties']['displayname']
         return out
 
@@ -1710,7 +3007,7 @@ class AdDumper:
         unique_properties = {
             'name' : '{}@{}'.format(self._fp(entry, 'name').upper(), domainName.upper()),
             'domain': domainName.upper(),
-            'domainsid': {self.domainLT[a]:a for a in self.domainLT}[domainName] if domainName in self.domainLT.values() else '',
+            'domainsid': self.bh_domain_sid_map.get(domainName, ''),
             'displayname': self._fp(entry, 'displayName', ''),
             'validityperiod' : self._fp(entry, 'pKIExpirationPeriod', ''), 
             'renewalperiod': self._fp(entry, 'pKIOverlapPeriod', ''), 
@@ -1742,12 +3039,12 @@ class AdDumper:
     def bloodhound_map_container(self, entry):
         domainName = '.'.join([a.split('=')[1] for a in self._fp(entry,'distinguishedName', '').upper().split(',') if a.startswith('DC=')])
         out = {**self.bloodhound_map_common(entry)}
-        out['DomainSID'] = {self.domainLT[a]:a for a in self.domainLT}[domainName] if domainName in self.domainLT.values() else '',
+        out['DomainSID'] = self.bh_domain_sid_map.get(domainName, ''),
         out['ChildObjects'] = []
         unique_properties = {
             'name' : '{}@{}'.format(str(self._fp(entry, 'name')).upper(), domainName.upper()),
             'domain': domainName.upper(),
-            'domainsid': {self.domainLT[a]:a for a in self.domainLT}[domainName] if domainName in self.domainLT.values() else ''
+            'domainsid': self.bh_domain_sid_map.get(domainName, '')
         }
         out['Properties'].update(unique_properties)
         del out['Properties']['displayname']
@@ -1759,9 +3056,8 @@ class AdDumper:
         out = []
         if 'msDS-AllowedToActOnBehalfOfOtherIdentity' in entry:
             for dacl in entry['msDS-AllowedToActOnBehalfOfOtherIdentity']['Dacls']:
-                matchsid = [a for a in self.bh_member_map.values() if a['ObjectIdentifier'] == dacl['Sid']]
-                if matchsid:
-                    out.append(matchsid[0])
+                if dacl['Sid'] in self.bh_sid_member_map:
+                    out.append(self.bh_sid_member_map[dacl['Sid']])
         return out
 
 
@@ -1855,7 +3151,7 @@ class AdDumper:
         out['ObjectIdentifier'] = self._tbs(self._fp(entry, 'objectSid'))
         unique_properties = {
             'admincount': bool(self._fp(entry, 'adminCount')),
-            'domainsid': {self.domainLT[a]:a for a in self.domainLT}[domainName] if domainName in self.domainLT.values() else '',
+            'domainsid': self.bh_domain_sid_map.get(domainName, ''),
             'samaccountname': self._fp(entry, 'SAMAccountName')
         }
         out['Properties'].update(unique_properties)
@@ -1869,7 +3165,7 @@ class AdDumper:
         unique_properties = {
             'name' : '{}@{}'.format(self._fp(entry, 'displayName').upper(), domainName),
             'gpcpath' : self._fp(entry, 'gPCFileSysPath').upper(),
-            'domainsid' : {self.domainLT[a]:a for a in self.domainLT}[domainName] if domainName in self.domainLT.values() else ''
+            'domainsid' : self.bh_domain_sid_map.get(domainName, '')
         }
         out['Properties'].update(unique_properties)
         return out
@@ -1881,7 +3177,7 @@ class AdDumper:
         out['GPOChanges'] = {'LocalAdmins': [], 'RemoteDesktopUsers': [], 'DcomUsers': [], 'PSRemoteUsers': [], 'AffectedComputers': []}
         out['Links'] = self._get_gplink(entry) # [{'IsEnforced': False, 'GUID': ''}] 
         unique_properties = {
-            'domainsid': {self.domainLT[a]:a for a in self.domainLT}[domainName] if domainName in self.domainLT.values() else '',
+            'domainsid': self.bh_domain_sid_map.get(domainName, ''),
             'blocksinheritance': int(self._fp(entry, 'gpoptions', 0)) == 1
         }
         out['Properties'].update(unique_properties)
@@ -1893,9 +3189,8 @@ class AdDumper:
         p = spnentry.split('/')[1].split(':')
         name = p[0].lower()
         port = int(p[1]) if len(p) > 1 and p[1].isdigit() else 1433
-        sids = [self.bh_computer_map[a] for a in self.bh_computer_map.keys() if name in a.split(',')]
-        if len(sids) > 0:
-            return {"ComputerSID": sids[0], "Port": port}
+        if name in self.bh_host_map:
+            return {"ComputerSID": self.bh_host_map[name], "Port": port}
         else:
             self.logger.debug('Could not resolve SPN {} to a computer SID'.format(spnentry))
             return {}
@@ -1993,17 +3288,69 @@ class AdDumper:
 
 
     def bloodhound_convert(self, dump, filename_base=''):
-        '''Takes in complete json dump and writes output to individual bloodhound files'''
+        '''Takes in complete json dump, or a DumpReader from a streaming import, and writes output to individual bloodhound files'''
         self.logger.info('Processing data into Bloodhound format')
+        reader = dump if isinstance(dump, DumpReader) else None
+        if reader:
+            # the lookup maps are built from the light records kept while indexing, and each category is read from the file as it is converted
+            dump = reader.light
+            categories = reader.categories
+            source = reader.records
+        else:
+            dump = resolve_security_descriptors(dump)
+            for key in dump:
+                if isinstance(dump[key], list):
+                    dump[key] = [EntryView(a) if isinstance(a, dict) else a for a in dump[key]]
+            categories = dump
+            source = dump.get
         timestamp = self.generate_timestamp()
+        methods = self.bloodhound_methods(categories)
+        self.build_bh_maps(dump)
+
+        jobs = []
+        for key in BH_PARSE_CATEGORIES: 
+            if key in categories:
+                if key =='certauthorities':
+                    records = list(source(key))
+                    for fieldname in BH_CA_CATEGORIES:
+                        # pre filter based on parent container
+                        data = [a for a in records if a['distinguishedName'].split(',', 1)[1].upper().startswith(BH_CA_CATEGORIES[fieldname])]
+                        jobs.append((fieldname, data))
+                else:
+                    fieldname = key if key != 'certenrollservices' else 'enterprisecas'
+                    jobs.append((fieldname, source(key)))
+
+        mapped = (None for _ in jobs)
+        if self.bh_processes > 1 and reader:
+            self.logger.info('Parallel Bloodhound conversion is not used with streaming imports, converting using a single process')
+        elif self.bh_processes > 1:
+            if 'fork' in multiprocessing.get_all_start_methods():
+                mapped = self._bh_map_parallel(jobs)
+            else:
+                self.logger.warning('Parallel Bloodhound conversion needs the fork start method, which is not available on this platform, converting using a single process')
+        archive = self.bh_open_archive(filename_base, timestamp)
+        try:
+            for records, (fieldname, data) in zip(mapped, jobs):
+                self._bh_parser_func(dump, data, fieldname, methods, filename_base, timestamp, records, archive)
+        finally:
+            if archive:
+                archive.close()
+
+
+    def bloodhound_methods(self, categories):
+        '''Returns the bloodhound collection methods flags for the given collected categories'''
         methods_included = ['ACL', 'ObjectProps', 'Trusts', 'UserRights'] 
         for key in ['containers', 'groups']:
-            if key in dump:
+            if key in categories:
                 methods_included.append(key.capitalize().rstrip('s'))
-        if [a for a in dump if a.startswith('cert')]:
+        if [a for a in categories if a.startswith('cert')]:
             methods_included.append('CertServices')
-        methods = reduce(lambda x, y: x | y,[MANUAL_FLAGS['collectionMethods'][a] for a in methods_included])
-        if 'domains' in dump:
+        return reduce(lambda x, y: x | y,[MANUAL_FLAGS['collectionMethods'][a] for a in methods_included])
+
+
+    def build_bh_maps(self, dump):
+        '''Builds the bloodhound lookup maps used to map objects to each other from the dump categories'''
+        if dump.get('domains'):
             self.bh_core_domain = '.'.join([a.replace('DC=', '').upper() for a in self._fp(dump['domains'][0], 'distinguishedName', '').split(',') if a.startswith('DC=')])
         else:
             self.logger.info('No domain info in dump file, this conversion is probably going to fail...')
@@ -2013,13 +3360,15 @@ class AdDumper:
 
         for key in ['users', 'groups', 'computers']:
             map_cat = lambda x: 'User' if x.split(',')[0].split('=')[-1] == 'Person' else x.split(',')[0].split('=')[-1]
-            mapentry = {self._fp(a, 'distinguishedName'): {'ObjectIdentifier': self._fp(a, 'objectSid'), 'ObjectType': map_cat(self._fp(a, 'objectCategory'))} for a  in dump[key]}
+            mapentry = {self._fp(a, 'distinguishedName'): {'ObjectIdentifier': self._fp(a, 'objectSid'), 'ObjectType': map_cat(self._fp(a, 'objectCategory'))} for a  in dump.get(key, [])}
             self.bh_member_map = {**self.bh_member_map, **mapentry}
         
         for key in ['domains', 'containers', 'ous']:
-            mapentry = {self._fp(a, 'distinguishedName'): self._get_containter_def(a) for a in dump[key]}
+            mapentry = {self._fp(a, 'distinguishedName'): self._get_containter_def(a) for a in dump.get(key, [])}
             self.bh_parent_map = {**self.bh_parent_map, **mapentry}
 
+        self.build_bh_indexes()
+
         if 'gpos' in dump:
             for entry in dump['gpos']:
                 self.bh_gpo_map[self._fp(entry, 'distinguishedName').upper()] = self._fp(entry, 'objectGUID').upper().translate({ord('{'):None,ord('}'):None})
@@ -2029,42 +3378,75 @@ class AdDumper:
                 self.bh_cert_temp_map[self._fp(entry, 'name')] = {'ObjectIdentifier': self._fp(entry, 'objectGUID').upper().translate({ord('{'):None,ord('}'):None}), 'ObjectType': 'CertTemplate'}
 
 
-        parse_categories = ['certauthorities', 'certenrollservices', 'certtemplates', 'containers', 'computers', 'domains', 'gpos', 'groups', 'ous', 'users']
-
-        ca_categories = {
-            'aiacas': 'CN=AIA,CN=PUBLIC KEY SERVICES,CN=SERVICES,CN=CONFIGURATION', 
-            'ntauthstores': 'CN=PUBLIC KEY SERVICES,CN=SERVICES,CN=CONFIGURATION', 
-            'rootcas': 'CN=CERTIFICATION AUTHORITIES,CN=PUBLIC KEY SERVICES,CN=SERVICES,CN=CONFIGURATION'
-        }
-
-        for key in parse_categories: 
-            if key in dump:
-                if key =='certauthorities':
-                    for fieldname in ca_categories:
-                        # pre filter based on parent container
-                        data = [a for a in dump[key] if a['distinguishedName'].split(',', 1)[1].upper().startswith(ca_categories[fieldname])]
-                        self._bh_parser_func(dump, data, fieldname, methods, filename_base, timestamp)
-                else:
-                    fieldname = key if key != 'certenrollservices' else 'enterprisecas'
-                    self._bh_parser_func(dump, dump[key], fieldname, methods, filename_base, timestamp)
+    def bh_open_archive(self, filename_base, timestamp):
+        '''Returns the zip archive to write the bloodhound output files to if enabled, otherwise None'''
+        if not self.bh_zip:
+            return None
+        zipname = '{}{}_BloodHound.zip'.format(filename_base + '_' if filename_base else '', timestamp)
+        self.logger.info('Writing Bloodhound output to archive: {}'.format(zipname))
+        return zipfile.ZipFile(zipname, 'w', zipfile.ZIP_DEFLATED)
 
 
-    def _bh_parser_func(self, dump, data, fieldname, methods, filename_base, timestamp):
-        self.logger.info('Generating Bloodhound {} file'.format(fieldname))
-        processed = {}
-        processed['data'] = [getattr(self, 'bloodhound_map_{}'.format(fieldname.rstrip('s')))(a) for a in data]
-        if fieldname == 'domains' and 'trusted_domains' in dump:
-            processed['data'][0]['Trusts'] = [self.bloodhound_map_trusted_domains(a) for a in dump['trusted_domains']]
-        processed['meta'] = {'methods' : methods, 'type' : fieldname, 'count': len(data), 'version' : 6} # methods
+    def bh_open_writer(self, fieldname, filename_base, timestamp, archive=None):
+        '''Returns a writer for the bloodhound output file for fieldname, as a member of archive if provided'''
+        if archive:
+            fn = '{}_{}.json'.format(timestamp, fieldname)
+            self.logger.debug('Writing Bloodhound {} output to archive member: {}'.format(fieldname, fn))
+            return BloodhoundWriter(io.TextIOWrapper(archive.open(fn, 'w', force_zip64=True), encoding='utf-8'), compact=True)
         fn = '{}{}_{}.json'.format(filename_base + '_' if filename_base else '', timestamp, fieldname)
         self.logger.debug('Writing Bloodhound {} output to: {}'.format(fieldname, fn))
-        open(fn, 'w').write(json.dumps(processed, indent=4))
+        return BloodhoundWriter(open(fn, 'w'))
 
 
-    def import_dump(self, dumpfile):
-        '''Import a previously completed AD dump from file to populate internal structures and return data'''
+    def _bh_map_parallel(self, jobs):
+        '''Maps the records for each bloodhound output file in shards across forked worker processes, which share the lookup maps copy on write, yielding an iterator over the mapped records of each file in turn'''
+        global _worker_dumper, _bh_worker_jobs
+        tasks = [(a, b, b + BH_SHARD_SIZE) for a in range(len(jobs)) for b in range(0, len(jobs[a][1]), BH_SHARD_SIZE)]
+        self.logger.info('Mapping {} Bloodhound records in {} shards using {} processes'.format(sum([len(a[1]) for a in jobs]), len(tasks), self.bh_processes))
+        # workers are forked with this dumper and the jobs in place, so neither is pickled
+        _worker_dumper = self
+        _bh_worker_jobs = jobs
+        try:
+            with multiprocessing.get_context('fork').Pool(self.bh_processes) as pool:
+                results = pool.imap(_bh_map_worker, tasks)
+                for fieldname, data in jobs:
+                    shards = (len(data) + BH_SHARD_SIZE - 1) // BH_SHARD_SIZE
+                    yield (record for _ in range(shards) for record in next(results))
+        finally:
+            _worker_dumper = None
+            _bh_worker_jobs = None
+
+
+    def build_bh_indexes(self):
+        '''Builds reverse lookup indexes for domain name to sid, computer host name to sid and sid to member from the bloodhound maps'''
+        self.bh_domain_sid_map = {self.domainLT[a]: a for a in self.domainLT}
+        self.bh_host_map = {}
+        for names in self.bh_computer_map:
+            for name in names.split(','):
+                self.bh_host_map.setdefault(name, self.bh_computer_map[names])
+        self.bh_sid_member_map = {}
+        for member in self.bh_member_map.values():
+            self.bh_sid_member_map.setdefault(member['ObjectIdentifier'], member)
+
+
+    def _bh_parser_func(self, dump, data, fieldname, methods, filename_base, timestamp, mapped=None, archive=None):
+        self.logger.info('Generating Bloodhound {} file'.format(fieldname))
+        records = mapped if mapped is not None else (getattr(self, 'bloodhound_map_{}'.format(fieldname.rstrip('s')))(a) for a in data)
+        writer = self.bh_open_writer(fieldname, filename_base, timestamp, archive)
+        for record in records:
+            if fieldname == 'domains' and 'trusted_domains' in dump and not writer.items:
+                record['Trusts'] = [self.bloodhound_map_trusted_domains(a) for a in dump['trusted_domains']]
+            writer.write_item(record)
+        writer.close({'methods' : methods, 'type' : fieldname, 'count': writer.items, 'version' : 6}) # methods
+
+
+    def import_dump(self, dumpfile, streaming=False):
+        '''Import a previously completed AD dump from file to populate internal structures and return data, 
+        or a DumpReader to read each category from lazily if streaming is set'''
+        if streaming:
+            return self._import_dump_streaming(dumpfile)
         self.logger.info('Importing dump from file {}'.format(dumpfile))
-        dump = json.load(open(dumpfile))
+        dump = resolve_security_descriptors(load_dump(dumpfile))
         if 'domains' in dump:
             self.domainLT = {a['objectSid']: '.'.join([b.split('=')[1].upper() for b in a['distinguishedName'].split(',')]) for a in dump['domains']}
             self.domainLTNB = {a['objectSid']: a['name'].upper() for a in dump['domains']}
@@ -2072,6 +3454,7 @@ class AdDumper:
             additional = {a['schemaIDGUID']: a['name'] for a in dump['schema'] if 'schemaIDGUID' in a and a['schemaIDGUID']}
             if additional:
                 self.object_types.update(additional)
+                self.sd_cache.clear()
         if 'meta' in dump:
             self.output_timestamp = dump['meta']['end_time']
         for object in ['users', 'groups', 'computers']:
@@ -2080,12 +3463,847 @@ class AdDumper:
         return dump
 
 
+    def _import_dump_streaming(self, dumpfile):
+        '''Indexes a dump file in a single light pass that populates internal structures, keeping only the fields of each record needed for the bloodhound lookup maps'''
+        self.logger.info('Indexing dump from file {}'.format(dumpfile))
+        reader = DumpReader(dumpfile)
+        fields = [a.lower() for a in SID_LOOKUP_ATTRIBUTES + BH_MAP_ATTRIBUTES]
+        additional = {}
+
+        def handler(category, record):
+            if category == 'schema':
+                if record.get('schemaIDGUID'):
+                    additional[record['schemaIDGUID']] = record['name']
+            elif category in ['domains', 'trusted_domains']:
+                reader.light.setdefault(category, []).append(EntryView(record))
+            elif category in BH_MAP_METHODS:
+                reader.light.setdefault(category, []).append(EntryView({a: record[a] for a in record if a.lower() in fields}))
+
+        reader.index(handler)
+        if 'domains' in reader.categories:
+            self.domainLT = {a['objectSid']: '.'.join([b.split('=')[1].upper() for b in a['distinguishedName'].split(',')]) for a in reader.light.get('domains', [])}
+            self.domainLTNB = {a['objectSid']: a['name'].upper() for a in reader.light.get('domains', [])}
+        if additional:
+            self.object_types.update(additional)
+            self.sd_cache.clear()
+        if 'meta' in reader.values:
+            self.output_timestamp = reader.values['meta']['end_time']
+        for object in ['users', 'groups', 'computers']:
+            self.update_sidlt(reader.light.get(object, []))
+        self.logger.info('Indexing complete')
+        return reader
+
+
     # allow building sid lookup table into already completed json dump files
     def export_dump(self, dumpfile):
         out = self.import_dump(dumpfile)
         out['meta'] = {'end_time' : self.output_timestamp, 'methods' : list([a for a in out.keys() if a not in ['schema', 'meta']]), 'sid_lookup' : self.sidLT}
         return out
-        
+
+
+    def check_sd_parsers(self, dumpfile):
+        '''Decodes every raw security descriptor from a dump file with both parsers, returning the number checked and the number that differ'''
+        self.sd_parser = 'check'
+        dump = resolve_security_descriptors(load_dump(dumpfile))
+        for category in dump:
+            if not isinstance(dump[category], list):
+                continue
+            for record in dump[category]:
+                for sd in SD_FIELDS:
+                    raw = record.get('{}_raw'.format(sd)) if isinstance(record, dict) else None
+                    if not raw or not isinstance(raw, str):
+                        continue
+                    # raw binary values are written hex encoded unless they happened to be valid utf-8
+                    try:
+                        raw = unhexlify(raw)
+                    except ValueError:
+                        raw = raw.encode('utf-8')
+                    try:
+                        self.decode_security_descriptor(raw)
+                    except Exception as e:
+                        self.logger.debug('Error in parsing security descriptor data in field {}: {}'.format(sd, str(e)))
+        self.logger.info('Checked {} security descriptors, {} native parser mismatches'.format(self.sd_parser_checks, self.sd_parser_mismatches))
+        return self.sd_parser_checks, self.sd_parser_mismatches
+
+
+
+class EntryView(dict):
+    '''Dump entry with an index of its keys by lowercase name, for repeated case insensitive field lookups'''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.keymap = {}
+        for key in self:
+            self.keymap.setdefault(key.lower(), key)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.keymap.setdefault(key.lower(), key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        if self.keymap.get(key.lower()) == key:
+            del self.keymap[key.lower()]
+            for other in self:
+                if other.lower() == key.lower():
+                    self.keymap[key.lower()] = other
+                    break
+
+
+
+# post processing worker process state, set once per process by _post_process_worker_init
+_worker_dumper = None
+_worker_records = 0
+# bloodhound output files and records to map, set before bloodhound worker processes are forked
+_bh_worker_jobs = None
+
+
+def _post_process_worker_init(snapshot):
+    global _worker_dumper, _worker_records
+    _worker_records = 0
+    state = pickle.loads(snapshot)
+    logger = logging.getLogger(state['logger'])
+    if not logger.handlers:
+        logger = create_logger(state['loglevel'], state['logger'])
+    _worker_dumper = AdDumper(logger=logger, raw=state['raw'], import_mode=True, sd_cache_size=state['sd_cache_size'], sd_parser=state['sd_parser'])
+    for table in ['sidLT', 'domainLT', 'domainLTNB', 'object_types']:
+        setattr(_worker_dumper, table, state[table])
+
+
+def _post_process_worker(task):
+    '''Post processes a pickled chunk of records, returning them pickled along with the cumulative counters of this worker'''
+    global _worker_records
+    serialise_start = time.time()
+    key, records = pickle.loads(task)
+    serialise_seconds = time.time() - serialise_start
+    records = [_worker_dumper.post_process_record(key, a) for a in records]
+    _worker_records += len(records)
+    serialise_start = time.time()
+    result = pickle.dumps(records)
+    serialise_seconds += time.time() - serialise_start
+    return result, {'pid': os.getpid(), 'records': _worker_records, 'sd_cache': _worker_dumper.sd_cache.stats(), 'sd_parser_checks': _worker_dumper.sd_parser_checks,
+                    'sd_parser_mismatches': _worker_dumper.sd_parser_mismatches, 'serialise_seconds': serialise_seconds}
+
+
+def _bh_map_worker(task):
+    index, start, end = task
+    fieldname, data = _bh_worker_jobs[index]
+    mapper = getattr(_worker_dumper, 'bloodhound_map_{}'.format(fieldname.rstrip('s')))
+    return [mapper(a) for a in data[start:end]]
+
+
+
+class SchemaIndex:
+    '''
+    Lookup index over retrieved schema entries, by lowercase lDAPDisplayName
+
+    names - set of all attribute and class names
+    attribute_classes - classes that may or must contain each attribute, not including inherited classes
+    attribute_syntax - attributeSyntax and oMSyntax of each attribute
+    '''
+    def __init__(self, schema):
+        self.names = set()
+        self.attribute_classes = {}
+        self.attribute_syntax = {}
+        for entry in schema:
+            if not entry.get('lDAPDisplayName'):
+                continue
+            name = entry['lDAPDisplayName'].lower()
+            self.names.add(name)
+            if entry.get('attributeSyntax') or entry.get('oMSyntax'):
+                self.attribute_syntax[name] = (entry.get('attributeSyntax') or None, entry.get('oMSyntax') or None)
+            for field in ['mayContain', 'mustContain', 'systemMayContain', 'systemMustContain']:
+                values = entry.get(field) or []
+                for attribute in [values] if isinstance(values, str) else values:
+                    self.attribute_classes.setdefault(attribute.lower(), []).append(entry['lDAPDisplayName'])
+
+    def __contains__(self, name):
+        return name.lower() in self.names
+
+    def get_classes(self, attribute):
+        return self.attribute_classes.get(attribute.lower(), [])
+
+    def get_syntax(self, attribute):
+        return self.attribute_syntax.get(attribute.lower(), (None, None))
+
+
+
+class SecurityDescriptorCache:
+    '''
+    LRU cache of parsed security descriptors keyed by a digest of the raw descriptor bytes
+
+    AD single instances security descriptors, so most objects share one of a small number of distinct descriptors.
+    Each caller is handed its own copy of the parsed descriptor, as records are modified in place by jsonify and the Bloodhound mappers.
+    '''
+    def __init__(self, maxsize=SD_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # entries held by the caches of worker processes, added by merge_stats
+        self.merged_size = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def digest(raw):
+        return hashlib.sha256(raw).hexdigest()
+
+    @classmethod
+    def copy(cls, parsed):
+        '''Copies the nested dicts and lists of a parsed descriptor, much faster than copy.deepcopy for these plain structures'''
+        if isinstance(parsed, dict):
+            return {a: cls.copy(parsed[a]) for a in parsed}
+        if isinstance(parsed, list):
+            return [cls.copy(a) for a in parsed]
+        return parsed
+
+    def get(self, raw, parser):
+        '''Returns the parsed form of raw, calling parser to parse it on a cache miss'''
+        if not self.maxsize:
+            with self.lock:
+                self.misses += 1
+            return parser(raw)
+        key = self.digest(raw)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.copy(self.entries[key])
+        parsed = parser(raw)
+        with self.lock:
+            self.misses += 1
+            self.entries[key] = parsed
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return self.copy(parsed)
+
+    def clear(self):
+        '''Drops cached entries, used when lookups that parsed descriptors depend on change'''
+        with self.lock:
+            self.entries.clear()
+
+    def merge_stats(self, stats):
+        '''Adds the counters from the stats of another cache, such as that of a worker process, to those of this one'''
+        with self.lock:
+            self.hits += stats['hits']
+            self.misses += stats['misses']
+            self.merged_size += stats['size']
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries) + self.merged_size, 'maxsize': self.maxsize}
+
+
+
+class DumpWriter:
+    '''
+    Writes a dump file incrementally, one top level key or category record at a time
+
+    indent - same layout as json.dumps(data, indent=4)
+    json - compact JSON document
+    ndjson - one JSON object per line, tagged with its category
+    '''
+    def __init__(self, fileobj, output_format='indent'):
+        if output_format not in JSON_DUMP_FORMATS:
+            raise Exception('Invalid dump output format {}, choose one from: {}'.format(output_format, ', '.join(JSON_DUMP_FORMATS)))
+        self.fileobj = fileobj
+        self.output_format = output_format
+        self.keys = 0
+        self.items = None
+        self.category = None
+        if self.output_format != 'ndjson':
+            self.fileobj.write('{')
+
+    def _dumps(self, value):
+        if self.output_format == 'indent':
+            return json.dumps(value, indent=4)
+        return json.dumps(value, separators=(',', ':'))
+
+    def _write_key(self, key):
+        if self.output_format == 'indent':
+            self.fileobj.write('{}\n    {}: '.format(',' if self.keys else '', json.dumps(key)))
+        else:
+            self.fileobj.write('{}{}:'.format(',' if self.keys else '', json.dumps(key)))
+        self.keys += 1
+
+    def write_value(self, key, value):
+        if self.output_format == 'ndjson':
+            self.fileobj.write(self._dumps({'category': key, 'value': value}) + '\n')
+        else:
+            self._write_key(key)
+            self.fileobj.write(self._dumps(value).replace('\n', '\n    '))
+
+    def start_list(self, key):
+        if self.output_format == 'ndjson':
+            # written so empty categories are still present when the dump is read back
+            self.fileobj.write(self._dumps({'category': key, 'value': []}) + '\n')
+        else:
+            self._write_key(key)
+            self.fileobj.write('[')
+        self.category = key
+        self.items = 0
+
+    def write_item(self, item):
+        if self.output_format == 'ndjson':
+            self.fileobj.write(self._dumps({'category': self.category, 'object': item}) + '\n')
+        elif self.output_format == 'indent':
+            self.fileobj.write('{}\n        {}'.format(',' if self.items else '', self._dumps(item).replace('\n', '\n        ')))
+        else:
+            self.fileobj.write('{}{}'.format(',' if self.items else '', self._dumps(item)))
+        self.items += 1
+
+    def end_list(self):
+        if self.output_format == 'indent':
+            self.fileobj.write('\n    ]' if self.items else ']')
+        elif self.output_format == 'json':
+            self.fileobj.write(']')
+        self.category = None
+        self.items = None
+
+    def write_dump(self, data):
+        for key in data:
+            if isinstance(data[key], list):
+                self.start_list(key)
+                for item in data[key]:
+                    self.write_item(item)
+                self.end_list()
+            else:
+                self.write_value(key, data[key])
+
+    def close(self):
+        if self.output_format == 'indent':
+            self.fileobj.write('\n}' if self.keys else '}')
+        elif self.output_format == 'json':
+            self.fileobj.write('}')
+        self.fileobj.close()
+
+
+class SqliteDumpWriter:
+    '''
+    Writes a dump to a sqlite database, with the same interface as DumpWriter
+
+    dump_keys - each top level key in order, with the JSON value of keys that are not category lists
+    <category> - a table for each category list, holding each record as a JSON document in data, with indexed 
+                 columns for the SQLITE_INDEXED_FIELDS and the parent DN of the record
+    aces - an indexed row for the owner and each ACE of every parsed security descriptor, referencing the record by category and id
+    '''
+    def __init__(self, dumpfile):
+        if os.path.exists(dumpfile):
+            os.remove(dumpfile)
+        self.connection = sqlite3.connect(dumpfile)
+        self.connection.execute('PRAGMA journal_mode = OFF')
+        self.connection.execute('PRAGMA synchronous = OFF')
+        self.connection.execute('CREATE TABLE dump_keys (position INTEGER PRIMARY KEY, name TEXT UNIQUE, value TEXT)')
+        self.connection.execute('CREATE TABLE aces (category TEXT, object_id INTEGER, object_dn TEXT, object_sid TEXT, field TEXT, principal_sid TEXT, principal_name TEXT, '
+                                'ace_type TEXT, mask INTEGER, rights TEXT, object_type TEXT, inherited INTEGER)')
+        # security descriptor references written with -dedupe-sd, converted to aces rows once the security_descriptors table is written
+        self.connection.execute('CREATE TEMP TABLE sd_refs (category TEXT, object_id INTEGER, object_dn TEXT, object_sid TEXT, field TEXT, sd TEXT)')
+        self.keys = 0
+        self.items = None
+        self.category = None
+        self.rows = []
+        self.ace_rows = []
+        self.ref_rows = []
+
+    def _dumps(self, value):
+        return json.dumps(value, separators=(',', ':'))
+
+    def _write_key(self, key, value=None):
+        self.connection.execute('INSERT INTO dump_keys VALUES (?, ?, ?)', (self.keys, key, value))
+        self.keys += 1
+
+    def _flush(self):
+        if self.rows:
+            self.connection.executemany('INSERT INTO "{}" VALUES ({})'.format(self.category, ', '.join(['?'] * (len(SQLITE_INDEXED_FIELDS) + 3))), self.rows)
+        if self.ace_rows:
+            self.connection.executemany('INSERT INTO aces VALUES ({})'.format(', '.join(['?'] * 12)), self.ace_rows)
+        if self.ref_rows:
+            self.connection.executemany('INSERT INTO sd_refs VALUES (?, ?, ?, ?, ?, ?)', self.ref_rows)
+        self.connection.commit()
+        self.rows = []
+        self.ace_rows = []
+        self.ref_rows = []
+
+    def _ace_rows(self, category, object_id, object_dn, object_sid, field, sd):
+        rows = []
+        if sd.get('OwnerSid'):
+            rows.append((category, object_id, object_dn, object_sid, field, sd['OwnerSid'], sd.get('OwnerName'), 'OWNER', None, None, None, 0))
+        for ace in sd.get('Dacls', []):
+            rows.append((category, object_id, object_dn, object_sid, field, ace.get('Sid'), ace.get('ResolvedSidName'), ace.get('Type'), ace.get('Mask'), 
+                         self._dumps(ace.get('Privs', [])), ace.get('ControlObjectType'), int('INHERITED_ACE' in ace.get('Flags', []))))
+        return rows
+
+    def write_value(self, key, value):
+        if isinstance(value, list):
+            self.start_list(key)
+            for item in value:
+                self.write_item(item)
+            self.end_list()
+        elif key == 'security_descriptors':
+            self._write_key(key, self._dumps(value))
+            self._write_ref_aces(value)
+        else:
+            self._write_key(key, self._dumps(value))
+
+    def _write_ref_aces(self, table):
+        self._flush()
+        cursor = self.connection.execute('SELECT * FROM sd_refs')
+        while True:
+            refs = cursor.fetchmany(SQLITE_BATCH_SIZE)
+            if not refs:
+                break
+            for category, object_id, object_dn, object_sid, field, sd in refs:
+                if sd in table:
+                    self.ace_rows += self._ace_rows(category, object_id, object_dn, object_sid, field, table[sd]['parsed'])
+            self._flush()
+        self.connection.execute('DELETE FROM sd_refs')
+        self.connection.commit()
+
+    def start_list(self, key):
+        self._write_key(key)
+        self.connection.execute('CREATE TABLE "{}" (id INTEGER PRIMARY KEY, {}, parentDN TEXT, data TEXT)'.format(key, ', '.join(['"{}" TEXT'.format(a) for a in SQLITE_INDEXED_FIELDS])))
+        self.category = key
+        self.items = 0
+
+    @staticmethod
+    def _parent_dn(dn):
+        '''Returns the DN of the parent of dn, splitting on the first comma not escaped with a backslash'''
+        escaped = False
+        for index, char in enumerate(dn):
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == ',':
+                return dn[index + 1:]
+        return ''
+
+    def write_item(self, item):
+        fields = [None for _ in SQLITE_INDEXED_FIELDS]
+        parent = None
+        if isinstance(item, dict):
+            fields = [str(item[a]) if item.get(a) is not None else None for a in SQLITE_INDEXED_FIELDS]
+            dn = item.get('distinguishedName')
+            if isinstance(dn, str):
+                parent = self._parent_dn(dn)
+            for sd in SD_FIELDS:
+                if isinstance(item.get(sd), dict):
+                    self.ace_rows += self._ace_rows(self.category, self.items, fields[2], fields[0], sd, item[sd])
+                elif isinstance(item.get(sd), str):
+                    self.ref_rows.append((self.category, self.items, fields[2], fields[0], sd, item[sd]))
+        self.rows.append(tuple([self.items] + fields + [parent, self._dumps(item)]))
+        self.items += 1
+        if len(self.rows) >= SQLITE_BATCH_SIZE or len(self.ace_rows) >= SQLITE_BATCH_SIZE:
+            self._flush()
+
+    def end_list(self):
+        self._flush()
+        for column in SQLITE_INDEXED_FIELDS + ['parentDN']:
+            self.connection.execute('CREATE INDEX "{0}_{1}" ON "{0}" ("{1}")'.format(self.category, column))
+        self.connection.commit()
+        self.category = None
+        self.items = None
+
+    def write_dump(self, data):
+        for key in data:
+            self.write_value(key, data[key])
+
+    def close(self):
+        for column in ['object_dn', 'object_sid', 'principal_sid']:
+            self.connection.execute('CREATE INDEX "aces_{0}" ON aces ("{0}")'.format(column))
+        self.connection.commit()
+        self.connection.close()
+
+
+class DumpScanner:
+    '''
+    Parses the JSON values of an indent or json format dump file incrementally from a binary file object
+
+    The file is decoded as latin-1 so offsets in the buffer match offsets in the file, and any value 
+    containing non ascii characters is decoded again from its utf-8 bytes
+    '''
+    def __init__(self, fileobj, offset=0):
+        self.fileobj = fileobj
+        self.fileobj.seek(offset)
+        self.base = offset
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def offset(self):
+        return self.base + self.pos
+
+    def _read(self):
+        self.base += self.pos
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+        # reads at least as much again as is buffered, so values larger than DUMP_READ_SIZE are not parsed too many times
+        data = self.fileobj.read(max(DUMP_READ_SIZE, len(self.buf)))
+        self.eof = not data
+        self.buf += data.decode('latin-1')
+        return not self.eof
+
+    def peek(self):
+        '''Returns the next non whitespace character without consuming it, or an empty string at the end of the file'''
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._read():
+                return ''
+
+    def consume(self, char):
+        if self.peek() != char:
+            raise ValueError('Expected "{}" at offset {} of dump file'.format(char, self.offset()))
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number ending at the end of the buffer may continue in the next read
+                if end < len(self.buf) or self.eof:
+                    break
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._read()
+        text = self.buf[self.pos:end]
+        self.pos = end
+        if not text.isascii():
+            value = json.loads(text.encode('latin-1').decode('utf-8'))
+        return value
+
+    def items(self):
+        '''Yields each item of the list starting at the current position'''
+        self.consume('[')
+        first = True
+        while self.peek() != ']':
+            if not first:
+                self.consume(',')
+            first = False
+            yield self.value()
+        self.consume(']')
+
+
+class DumpReader:
+    '''
+    Reads a dump file written in any of the DUMP_FORMATS one top level value or category record at a time, without loading the complete document
+
+    index - scans the file once, parsing the top level values that are not lists into values, recording the file offsets of each 
+            list category in categories, and passing each category record to an optional handler
+    records - yields the records of a single category, seeking straight to it
+    '''
+    def __init__(self, dumpfile):
+        self.dumpfile = dumpfile
+        self.values = {}
+        self.categories = OrderedDict()
+        self.sd_table = {}
+        # records kept by the handler during indexing
+        self.light = {}
+        with open(dumpfile, 'rb') as fileobj:
+            header = fileobj.read(len(SQLITE_HEADER))
+        self.sqlite = header == SQLITE_HEADER
+        self.ndjson = header.startswith(NDJSON_PREFIX.encode())
+
+    def index(self, handler=None):
+        if self.sqlite:
+            connection = sqlite3.connect(self.dumpfile)
+            for name, value in connection.execute('SELECT name, value FROM dump_keys ORDER BY position').fetchall():
+                if value is not None:
+                    self.values[name] = json.loads(value)
+                    continue
+                self.categories[name] = (None, None)
+                if handler:
+                    for (data,) in connection.execute('SELECT data FROM "{}" ORDER BY id'.format(name)):
+                        handler(name, json.loads(data))
+            connection.close()
+            self.sd_table = self.values.pop('security_descriptors', {})
+            return
+        with open(self.dumpfile, 'rb') as fileobj:
+            if self.ndjson:
+                offset = 0
+                for line in fileobj:
+                    if line.strip():
+                        entry = json.loads(line)
+                        category = entry['category']
+                        if 'object' in entry or isinstance(entry['value'], list):
+                            self.categories[category] = (self.categories.get(category, (offset, None))[0], offset + len(line))
+                            if handler:
+                                for record in [entry['object']] if 'object' in entry else entry['value']:
+                                    handler(category, record)
+                        else:
+                            self.values[category] = entry['value']
+                    offset += len(line)
+            else:
+                scanner = DumpScanner(fileobj)
+                scanner.consume('{')
+                first = True
+                while scanner.peek() != '}':
+                    if not first:
+                        scanner.consume(',')
+                    first = False
+                    key = scanner.value()
+                    scanner.consume(':')
+                    if scanner.peek() == '[':
+                        start = scanner.offset()
+                        for record in scanner.items():
+                            if handler:
+                                handler(key, record)
+                        self.categories[key] = (start, scanner.offset())
+                    else:
+                        self.values[key] = scanner.value()
+        self.sd_table = self.values.pop('security_descriptors', {})
+
+    def records(self, category):
+        start, end = self.categories[category]
+        if self.sqlite:
+            connection = sqlite3.connect(self.dumpfile)
+            try:
+                for (data,) in connection.execute('SELECT data FROM "{}" ORDER BY id'.format(category)):
+                    record = json.loads(data)
+                    yield EntryView(resolve_record_security_descriptors(record, self.sd_table)) if isinstance(record, dict) else record
+            finally:
+                connection.close()
+            return
+        with open(self.dumpfile, 'rb') as fileobj:
+            if self.ndjson:
+                fileobj.seek(start)
+                offset = start
+                for line in fileobj:
+                    if offset >= end:
+                        break
+                    offset += len(line)
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    if entry['category'] != category:
+                        continue
+                    for record in [entry['object']] if 'object' in entry else entry['value']:
+                        yield EntryView(resolve_record_security_descriptors(record, self.sd_table)) if isinstance(record, dict) else record
+            else:
+                for record in DumpScanner(fileobj, start).items():
+                    yield EntryView(resolve_record_security_descriptors(record, self.sd_table)) if isinstance(record, dict) else record
+
+
+class BloodhoundWriter(DumpWriter):
+    '''
+    Writes a Bloodhound output file incrementally, one data item at a time, followed by the meta section once the item count is known
+
+    Output has the same layout as json.dumps(processed, indent=4), or is compact JSON when compact is set
+    '''
+    def __init__(self, fileobj, compact=False):
+        super().__init__(fileobj, output_format='json' if compact else 'indent')
+        self.start_list('data')
+
+    def close(self, meta):
+        self.end_list()
+        self.write_value('meta', meta)
+        super().close()
+
+
+class BloodhoundPipeline:
+    '''
+    Maps records to Bloodhound objects as they are streamed from collection by AdDumper.stream_query, and writes them straight to the Bloodhound output files
+
+    The bloodhound lookup maps must already be built by the stream pre-pass. The small domains and certificate authority files are 
+    held until their category, or for domains the whole collection including trusts, is complete
+    '''
+    def __init__(self, dumper, methods, filename_base=''):
+        self.dumper = dumper
+        self.filename_base = filename_base
+        self.timestamp = dumper.generate_timestamp()
+        self.methods = dumper.bloodhound_methods(methods)
+        self.archive = dumper.bh_open_archive(filename_base, self.timestamp)
+        self.writer = None
+        self.fieldname = None
+        self.held = {}
+        self.trusts = []
+
+    def _map(self, fieldname, record):
+        return getattr(self.dumper, 'bloodhound_map_{}'.format(fieldname.rstrip('s')))(record)
+
+    def start_list(self, category):
+        if category == 'certauthorities':
+            self.held.update({a: [] for a in BH_CA_CATEGORIES})
+        elif category == 'domains':
+            self.held['domains'] = []
+        elif category in BH_PARSE_CATEGORIES:
+            self.fieldname = category if category != 'certenrollservices' else 'enterprisecas'
+            self.dumper.logger.info('Generating Bloodhound {} file'.format(self.fieldname))
+            self.writer = self.dumper.bh_open_writer(self.fieldname, self.filename_base, self.timestamp, self.archive)
+
+    def write_item(self, category, record):
+        record = EntryView(record)
+        if category == 'trusted_domains':
+            self.trusts.append(self.dumper.bloodhound_map_trusted_domains(record))
+        elif category == 'certauthorities':
+            parent = record['distinguishedName'].split(',', 1)[1].upper()
+            for fieldname in [a for a in BH_CA_CATEGORIES if parent.startswith(BH_CA_CATEGORIES[a])]:
+                self.held[fieldname].append(self._map(fieldname, record))
+        elif category == 'domains':
+            self.held['domains'].append(self._map(category, record))
+        elif self.writer:
+            self.writer.write_item(self._map(self.fieldname, record))
+
+    def end_list(self, category):
+        if category == 'certauthorities':
+            for fieldname in BH_CA_CATEGORIES:
+                self.dumper._bh_parser_func({}, [], fieldname, self.methods, self.filename_base, self.timestamp, self.held.pop(fieldname), self.archive)
+        elif self.writer:
+            self.writer.close({'methods' : self.methods, 'type' : self.fieldname, 'count': self.writer.items, 'version' : 6})
+            self.writer = None
+            self.fieldname = None
+
+    def close(self):
+        if 'domains' in self.held:
+            domains = self.held.pop('domains')
+            if domains:
+                domains[0]['Trusts'] = self.trusts
+            self.dumper._bh_parser_func({}, [], 'domains', self.methods, self.filename_base, self.timestamp, domains, self.archive)
+        if self.archive:
+            self.archive.close()
+            self.archive = None
+
+
+class CollectionCheckpoint:
+    '''
+    Records the collection wide state of a checkpointed collection, which a resumed collection reuses so its searches match the recorded ones
+
+    collection.state - the highestCommittedUSN and DC the collection started with, and the target and highestCommittedUSN each partitioned method was split by
+    '''
+    def __init__(self, directory):
+        self.state_file = os.path.join(directory, 'collection.state')
+        self.state = {'highest_committed_usn': None, 'usn_dc': None, 'partitions': {}}
+        self.resumed = os.path.isfile(self.state_file)
+        if self.resumed:
+            with open(self.state_file, 'rb') as fileobj:
+                self.state = pickle.load(fileobj)
+
+    def save(self):
+        temp_file = '{}.tmp'.format(self.state_file)
+        with open(temp_file, 'wb') as fileobj:
+            pickle.dump(self.state, fileobj)
+        os.replace(temp_file, self.state_file)
+
+
+class SearchCheckpoint:
+    '''
+    Records the pages of a single paged search in a checkpoint directory so an interrupted collection can be resumed
+
+    <key>.pages - the pickled entries of each page, appended as each page is received
+    <key>.state - the paged results cookie to continue from, the number and length of the recorded pages and whether the search completed
+    '''
+    def __init__(self, directory, key):
+        self.pages_file = os.path.join(directory, '{}.pages'.format(key))
+        self.state_file = os.path.join(directory, '{}.state'.format(key))
+        self.state = {'cookie': None, 'pages': 0, 'offset': 0, 'complete': False}
+        if os.path.isfile(self.state_file):
+            with open(self.state_file, 'rb') as fileobj:
+                self.state = pickle.load(fileobj)
+
+    def read_pages(self):
+        if not self.state['pages']:
+            return
+        with open(self.pages_file, 'rb') as fileobj:
+            for _ in range(self.state['pages']):
+                yield pickle.load(fileobj)
+
+    def add_page(self, entries, cookie):
+        with open(self.pages_file, 'ab') as fileobj:
+            # drops any partial page written after the last recorded state
+            fileobj.truncate(self.state['offset'])
+            pickle.dump(entries, fileobj)
+            self.state['offset'] = fileobj.tell()
+        self.state.update({'cookie': cookie, 'pages': self.state['pages'] + 1, 'complete': not cookie})
+        temp_file = '{}.tmp'.format(self.state_file)
+        with open(temp_file, 'wb') as fileobj:
+            pickle.dump(self.state, fileobj)
+        os.replace(temp_file, self.state_file)
+
+
+def clear_checkpoint(directory):
+    '''Removes the search checkpoint files from directory'''
+    for filename in os.listdir(directory):
+        if filename.endswith('.pages') or filename.endswith('.state'):
+            os.remove(os.path.join(directory, filename))
+
+
+def open_dump_writer(dumpfile, output_format='indent'):
+    '''Returns a writer for a dump file in any of the DUMP_FORMATS'''
+    if output_format == 'sqlite':
+        return SqliteDumpWriter(dumpfile)
+    return DumpWriter(open(dumpfile, 'w'), output_format)
+
+
+def write_dump_file(data, dumpfile, output_format='indent'):
+    '''Writes data to dumpfile, replacing any existing file only once the new one is complete'''
+    fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dumpfile)), suffix='.tmp')
+    os.close(fd)
+    writer = open_dump_writer(temp_file, output_format)
+    writer.write_dump(data)
+    writer.close()
+    os.replace(temp_file, dumpfile)
+
+
+def load_sqlite_dump(dumpfile):
+    '''Loads a dump file written by SqliteDumpWriter'''
+    connection = sqlite3.connect(dumpfile)
+    dump = {}
+    for name, value in connection.execute('SELECT name, value FROM dump_keys ORDER BY position').fetchall():
+        if value is None:
+            dump[name] = [json.loads(a) for (a,) in connection.execute('SELECT data FROM "{}" ORDER BY id'.format(name))]
+        else:
+            dump[name] = json.loads(value)
+    connection.close()
+    return dump
+
+
+def load_dump(dumpfile):
+    '''Loads a dump file written in any of the DUMP_FORMATS'''
+    with open(dumpfile, 'rb') as fileobj:
+        if fileobj.read(len(SQLITE_HEADER)) == SQLITE_HEADER:
+            return load_sqlite_dump(dumpfile)
+    fileobj = open(dumpfile)
+    if fileobj.read(len(NDJSON_PREFIX)) != NDJSON_PREFIX:
+        fileobj.seek(0)
+        return json.load(fileobj)
+    fileobj.seek(0)
+    dump = {}
+    for line in fileobj:
+        if line.strip():
+            entry = json.loads(line)
+            if 'object' in entry:
+                dump.setdefault(entry['category'], []).append(entry['object'])
+            else:
+                dump[entry['category']] = entry['value']
+    return dump
+
+
+def resolve_security_descriptors(dump):
+    '''Replaces security descriptor references in a dump with a deduplicated security_descriptors table with their values'''
+    table = dump.pop('security_descriptors', None)
+    if not table:
+        return dump
+    for key in [a for a in dump.keys() if a not in ['info', 'schema', 'meta']]:
+        if not isinstance(dump[key], list):
+            continue
+        for record in dump[key]:
+            resolve_record_security_descriptors(record, table)
+    return dump
+
+
+def resolve_record_security_descriptors(record, table):
+    '''Replaces the security descriptor references in a single record with their values from a deduplicated security_descriptors table'''
+    for sd in SD_FIELDS:
+        if isinstance(record.get(sd), str) and record[sd] in table:
+            entry = table[record[sd]]
+            record[sd] = entry['parsed']
+            if 'raw' in entry:
+                record['{}_raw'.format(sd)] = entry['raw']
+    return record
+
 
 
 def check_ipython():
@@ -2181,11 +4399,12 @@ def command_line():
     parser = MyParser()
     input_arg_group = parser.add_argument_group('Operation')
     mgroup = input_arg_group.add_mutually_exclusive_group(required=True)
-    mgroup.add_argument('-d', '--domain-controller', type=str, help='Domain controller address to connect to if performing a fresh collection. If using Kerberos auth, provide a domain name')
+    mgroup.add_argument('-d', '--domain-controller', type=str, help='Domain controller address to connect to if performing a fresh collection, or a comma seperated list of domain controllers to spread collection across. If using Kerberos auth, provide a domain name')
     mgroup.add_argument('-i', '--input-file', type=str, help='Filename of a previous output file to export into Bloodhound format')
     
     
     input_arg_group.add_argument('-target-ip', type=str, default=None, help='IP Address of the target machine. If omitted it will use whatever was specified as target')
+    input_arg_group.add_argument('-targets-file', type=str, default=None, help='File listing additional domain controllers to spread collection across, one per line')
     input_arg_group.add_argument('-ssl', action='store_true', help='Force use of SSL for LDAP connection')
     input_arg_group.add_argument('-ssl_protocol', type=str, default=None, help='Use a specific SSL/TLS protocol version')
     input_arg_group.add_argument('-start_tls', action='store_true', help='Attempt to upgrade the plain text LDAP port/connection to SSL (post authentication)')
@@ -2193,6 +4412,24 @@ def command_line():
     input_arg_group.add_argument('-sleep', type=int, default=0, help='Time in seconds to sleep between each paged LDAP request and each enumeration method')
     input_arg_group.add_argument('-jitter', type=int, default=0, help='Set to a positive integer to add a random value of up to that many seconds to the sleep delay')
     input_arg_group.add_argument('-pagesize', type=int, default=500, help='Page size for LDAP requests')
+    input_arg_group.add_argument('-adaptive-pagesize', action='store_true', help='Adjust the page size of each paged search between pages to meet page latency and size targets, starting from -pagesize and limited by the server MaxPageSize')
+    input_arg_group.add_argument('-page-target-seconds', type=float, default=ADAPTIVE_PAGE_SECONDS, help='Target time to retrieve each page when using -adaptive-pagesize')
+    input_arg_group.add_argument('-page-target-bytes', type=int, default=ADAPTIVE_PAGE_BYTES, help='Target size in bytes of each page when using -adaptive-pagesize')
+    input_arg_group.add_argument('-checkpoint', type=str, default=None, help='Directory to record each page of every paged search in as it is received, so an interrupted collection can be continued using -resume')
+    input_arg_group.add_argument('-resume', type=str, default=None, help='Checkpoint directory of an interrupted collection to continue, run with the same options as the interrupted collection')
+    input_arg_group.add_argument('-reconnect-attempts', type=int, default=RECONNECT_ATTEMPTS, help='Number of times to reconnect and retry a paged search request after a connection error, 0 to disable')
+    input_arg_group.add_argument('-since', type=str, default=None, help='Previous dump file, only objects changed since it was collected are queried and merged into it to produce a complete new dump')
+    input_arg_group.add_argument('-dirsync', type=str, default=None, help='Dump file to keep up to date using the DirSync control. A full collection is written to it on first use, later runs only query and apply changed attributes')
+    input_arg_group.add_argument('-dirsync-interval', type=int, default=0, help='Keep running and update the -dirsync dump file every this many seconds')
+    input_arg_group.add_argument('-schema-cache', type=str, default=None, help='Directory in which to cache the schema between runs, the cached schema is reused until the forest schema version changes')
+    input_arg_group.add_argument('-sd-parser', type=str, choices=SD_PARSERS, default='impacket', help='Security descriptor parser, check parses with both and logs any differences. Use check with -i to check the raw security descriptors in an existing dump file')
+    input_arg_group.add_argument('-sd-cache-size', type=int, default=SD_CACHE_SIZE, help='Maximum number of distinct parsed security descriptors to cache, 0 disables the cache')
+    input_arg_group.add_argument('-processes', type=int, default=1, help='Number of worker processes to use to post process collected data')
+    input_arg_group.add_argument('-process-chunksize', type=int, default=PROCESS_CHUNKSIZE, help='Number of records sent to a post processing worker process at a time, larger values reduce pickling overhead')
+    input_arg_group.add_argument('-fuse-queries', action='store_true', help='Collect the small categories that share a naming context, such as containers, ous, domains, gpos and trusted domains, with a single search instead of one search each')
+    input_arg_group.add_argument('-partitions', type=int, default=1, help='Split each search of the -partition-methods into this many uSNCreated ranges, searched concurrently over separate LDAP connections')
+    input_arg_group.add_argument('-partition-methods', type=str, default=','.join(PARTITION_METHODS), help='Comma seperated list of collection methods to partition when -partitions is set')
+    input_arg_group.add_argument('-workers', type=int, default=1, help='Number of LDAP connections to use to run collection methods in parallel')
     input_arg_group.add_argument('-custom-query', type=str, default=None, help='Perform custom LDAP query provided as string instead of normal enumeration')
     input_arg_group.add_argument('-port', type=int, default=None, help='Port to connect to. Determined automatically if not specified.')
     input_arg_group.add_argument('-query-config', type=str, default=None, help='Provide JSON config file that defines custom LDAP queries and attribute lists for each query category, overriding other settings')
@@ -2220,7 +4457,14 @@ def command_line():
     output_arg_group = parser.add_argument_group('Output')
     output_arg_group.add_argument('-output', type=str,  help='Output filename. An automatically generated name will be used if not provided.')
     output_arg_group.add_argument('-bh-output', action='store_true',  help='Also output Bloodhound compatible files (EXPERIMENTAL and UNFINISHED functionality)')
+    output_arg_group.add_argument('-bh-processes', type=int, default=1, help='Number of worker processes to use to generate Bloodhound output files')
+    output_arg_group.add_argument('-bh-zip', action='store_true', help='Write the Bloodhound output files into a single zip archive using compact JSON, like SharpHound does')
+    output_arg_group.add_argument('-bh-pipeline', action='store_true', help='Map records straight to Bloodhound output files as they are collected, after a light pre-pass to build the Bloodhound lookup maps, instead of converting the complete dump afterwards')
+    output_arg_group.add_argument('-bh-only', action='store_true', help='Only write the Bloodhound output files and not the AD dump file, requires -bh-pipeline')
     output_arg_group.add_argument('-loglevel', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], default='WARNING', help='Set logging level')
+    output_arg_group.add_argument('-output-format', choices=DUMP_FORMATS, default='indent', help='Format of the dump output file: indented JSON, compact JSON, newline delimited JSON objects tagged with their category or an indexed sqlite database')
+    output_arg_group.add_argument('-dedupe-sd', action='store_true', help='Write each distinct security descriptor once to a security_descriptors table in the output, with objects referencing it by hash')
+    output_arg_group.add_argument('-stream', action='store_true', help='Stream each record through processing straight to the output file as it is collected instead of holding the complete dump in memory. With -i, read the input file one category at a time instead of loading it completely')
     output_arg_group.add_argument('-exclude-raw', action='store_true', help='Exclude raw binary field data from output')
 
     args = parser.parse_args()
@@ -2228,12 +4472,55 @@ def command_line():
     logger = create_logger(args.loglevel, 'AdDumper')
     k_temp_file = None
 
-    if args.input_file:
+    if args.since and args.stream:
+        print('Delta collection using -since cannot be combined with -stream, as changes are merged into the complete previous dump')
+        sys.exit(2)
+
+    extra_targets = []
+    if args.domain_controller:
+        args.domain_controller, *extra_targets = [a.strip() for a in args.domain_controller.split(',')]
+    if args.targets_file:
+        extra_targets += [a.strip() for a in open(args.targets_file) if a.strip()]
+
+    if args.since and extra_targets:
+        print('Delta collection using -since cannot be used with multiple domain controllers, as USNs are specific to each domain controller')
+        sys.exit(2)
+
+    if args.checkpoint and os.path.isdir(args.checkpoint) and [a for a in os.listdir(args.checkpoint) if a.endswith('.state')]:
+        print('Checkpoint directory {} contains an interrupted collection, use -resume to continue it'.format(args.checkpoint))
+        sys.exit(2)
+    if args.resume and not os.path.isdir(args.resume):
+        print('Checkpoint directory {} does not exist'.format(args.resume))
+        sys.exit(2)
+    checkpoint = args.resume if args.resume else args.checkpoint
+    if checkpoint:
+        os.makedirs(checkpoint, exist_ok=True)
+
+    if args.stream and args.custom_query:
+        print('Streaming collection using -stream cannot be combined with -custom-query')
+        sys.exit(2)
+    if args.dirsync and (args.since or args.stream or args.custom_query):
+        print('DirSync collection using -dirsync cannot be combined with -since, -stream or -custom-query')
+        sys.exit(2)
+
+    if args.bh_pipeline and (args.input_file or args.since or args.dirsync or args.custom_query):
+        print('Bloodhound pipeline collection using -bh-pipeline cannot be combined with -i, -since, -dirsync or -custom-query')
+        sys.exit(2)
+    if args.bh_only and not args.bh_pipeline:
+        print('The -bh-only option requires -bh-pipeline')
+        sys.exit(2)
+
+    if args.input_file and args.sd_parser == 'check':
+        dumper = AdDumper(logger=logger, import_mode=True)
+        checked, mismatches = dumper.check_sd_parsers(args.input_file)
+        print('Checked {} security descriptors, {} mismatches between the native and impacket parsers'.format(checked, mismatches))
+        sys.exit(1 if mismatches else 0)
+    elif args.input_file:
         if not args.bh_output:
             print('The bloodhound export must be enabled in import mode, use -b option')
             sys.exit(2)
-        dumper = AdDumper(logger=logger, raw=raw, import_mode=True)
-        data = dumper.import_dump(args.input_file)
+        dumper = AdDumper(logger=logger, raw=raw, import_mode=True, bh_processes=args.bh_processes, bh_zip=args.bh_zip)
+        data = dumper.import_dump(args.input_file, streaming=args.stream)
     else:
         if args.realm:
             dc = args.dc_ip if args.dc_ip else args.target_ip if args.target_ip else args.domain_controller
@@ -2291,8 +4578,12 @@ def command_line():
             
         dumper = AdDumper(args.domain_controller, target_ip=args.target_ip, username=args.username, password=password, ssl=args.ssl, port=args.port, delay=args.sleep, 
                           jitter=args.jitter, paged_size=args.pagesize, logger=logger, raw=raw, kerberos=args.kerberos, no_password=args.no_password, query_config=query_config,
-                          attributes=attributes, bh_attributes=args.bh_attributes, sslprotocol=args.ssl_protocol, start_tls=args.start_tls, client_cert_file=client_cert, client_key_file=client_key)
-        outputfile = args.output if args.output else '{}_{}_AD_Dump.json'.format(dumper.generate_timestamp(), args.domain_controller)
+                          attributes=attributes, bh_attributes=args.bh_attributes, sslprotocol=args.ssl_protocol, start_tls=args.start_tls, client_cert_file=client_cert, client_key_file=client_key,
+                          workers=args.workers, sd_cache_size=args.sd_cache_size, sd_parser=args.sd_parser, processes=args.processes, process_chunksize=args.process_chunksize, dedupe_sd=args.dedupe_sd, schema_cache=args.schema_cache, since=args.since, dirsync=args.dirsync, 
+                          partitions=args.partitions, partition_methods=[a.strip() for a in args.partition_methods.split(',')], extra_targets=extra_targets, 
+                          adaptive_paging=args.adaptive_pagesize, page_target_seconds=args.page_target_seconds, page_target_bytes=args.page_target_bytes, 
+                          checkpoint=checkpoint, reconnect_attempts=args.reconnect_attempts, fuse_queries=args.fuse_queries, bh_processes=args.bh_processes, bh_zip=args.bh_zip)
+        outputfile = args.output if args.output else '{}_{}_AD_Dump.{}'.format(dumper.generate_timestamp(), args.domain_controller, args.output_format if args.output_format in ['ndjson', 'sqlite'] else 'json')
         valid_methods = dumper.get_valid_methods()
         
         if args.methods:
@@ -2305,20 +4596,58 @@ def command_line():
         else:
             requested_methods = valid_methods
 
+        invalid_methods = [a for a in dumper.partition_methods if a not in valid_methods]
+        if invalid_methods:
+            print('Invalid partition methods were requested! The invalid methods requested were: {}'.format(', '.join(invalid_methods)))
+            sys.exit(1)
 
-        dumper.connect()
-        if args.custom_query:
-            data = dumper.run_custom_query(args.custom_query, attributes=attributes)
-        else:
-            data = dumper.query(methods=requested_methods, only_schema=args.only_schema, no_schema=args.no_schema)
-        if 'meta' in data:
-            data['meta']['launch_arguments'] = " ".join(sys.argv[:]) # this is imperfect in terms of quoting, but good enough
-            if query_config:
-                data['meta']['query_config'] = query_config
-        open(outputfile, 'w').write(json.dumps(data, indent=4))
-        logger.info('Wrote output to {}'.format(outputfile))
 
-    if args.bh_output:
+        try:
+            dumper.connect()
+        except LdapConnectionError as e:
+            print(e)
+            if k_temp_file:
+                os.remove(k_temp_file)
+            sys.exit(1)
+        if args.dirsync:
+            while True:
+                data = dumper.dirsync_query(methods=requested_methods)
+                data['meta']['launch_arguments'] = " ".join(sys.argv[:])
+                write_dump_file(data, args.dirsync, args.output_format)
+                logger.info('Wrote output to {}'.format(args.dirsync))
+                if not args.dirsync_interval:
+                    break
+                time.sleep(args.dirsync_interval)
+        elif args.stream or args.bh_pipeline:
+            meta = {'launch_arguments': " ".join(sys.argv[:])}
+            if query_config:
+                meta['query_config'] = query_config
+            writer = open_dump_writer(outputfile, args.output_format) if not args.bh_only else None
+            bloodhound = BloodhoundPipeline(dumper, requested_methods, (args.output if args.output else '').split('.')[0]) if args.bh_pipeline else None
+            dumper.stream_query(writer, methods=requested_methods, only_schema=args.only_schema, no_schema=args.no_schema, meta=meta, bloodhound=bloodhound)
+            if writer:
+                writer.close()
+                logger.info('Wrote output to {}'.format(outputfile))
+            if args.bh_output and not args.bh_pipeline:
+                # read back lazily, as loading the whole streamed dump would defeat streaming it
+                data = dumper.import_dump(outputfile, streaming=True)
+        else:
+            if args.custom_query:
+                data = dumper.run_custom_query(args.custom_query, attributes=attributes)
+            else:
+                data = dumper.query(methods=requested_methods, only_schema=args.only_schema, no_schema=args.no_schema)
+            if 'meta' in data:
+                data['meta']['launch_arguments'] = " ".join(sys.argv[:]) # this is imperfect in terms of quoting, but good enough
+                if query_config:
+                    data['meta']['query_config'] = query_config
+            writer = open_dump_writer(outputfile, args.output_format)
+            writer.write_dump(data)
+            writer.close()
+            logger.info('Wrote output to {}'.format(outputfile))
+        if checkpoint:
+            clear_checkpoint(checkpoint)
+
+    if args.bh_output and not args.bh_pipeline:
         fn = args.output if args.output else ''
         dumper.bloodhound_convert(data, fn.split('.')[0])
 
@@ -0,0 +1,65 @@
+'''
+Golden output test for the ACL edges of the Bloodhound files converted from a small fixture dump
+
+data/bloodhound_dump.json - a dump of a generated directory, collected with -exclude-raw and -dedupe-sd
+data/bloodhound_aces.json - the Aces of each object in each Bloodhound file, keyed by file type and ObjectIdentifier
+
+Run with: python -m unittest discover -s tests
+Set UPDATE_GOLDEN=1 to rewrite the golden file after an intended change to the ACL mapping.
+'''
+import glob
+import json
+import logging
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ad_ldap_dumper import AdDumper
+
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+DUMP_FILE = os.path.join(DATA, 'bloodhound_dump.json')
+GOLDEN_FILE = os.path.join(DATA, 'bloodhound_aces.json')
+
+
+def convert_aces(streaming=False):
+    '''Converts the fixture dump to Bloodhound files, returning the Aces of each object by file type and ObjectIdentifier'''
+    dumper = AdDumper(logger=logging.getLogger('test_bloodhound_acl'), import_mode=True)
+    with tempfile.TemporaryDirectory() as directory:
+        dumper.bloodhound_convert(dumper.import_dump(DUMP_FILE, streaming=streaming), os.path.join(directory, 'test'))
+        aces = {}
+        for filename in sorted(glob.glob(os.path.join(directory, '*.json'))):
+            with open(filename) as fileobj:
+                data = json.load(fileobj)['data']
+            aces[os.path.splitext(filename)[0].split('_')[-1]] = {a['ObjectIdentifier']: a['Aces'] for a in data if 'Aces' in a}
+    return aces
+
+
+class BloodhoundAclTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        if os.environ.get('UPDATE_GOLDEN'):
+            with open(GOLDEN_FILE, 'w') as fileobj:
+                json.dump(convert_aces(), fileobj, indent=4, sort_keys=True)
+        with open(GOLDEN_FILE) as fileobj:
+            cls.golden = json.load(fileobj)
+
+    def assertAcesEqual(self, aces):
+        self.assertEqual(sorted(aces), sorted(self.golden))
+        for filetype in self.golden:
+            for identifier in self.golden[filetype]:
+                self.assertEqual(aces[filetype].get(identifier), self.golden[filetype][identifier], '{} {}'.format(filetype, identifier))
+            self.assertEqual(sorted(aces[filetype]), sorted(self.golden[filetype]), filetype)
+
+    def test_acl_edges_match_golden(self):
+        self.assertAcesEqual(convert_aces())
+
+    def test_streamed_acl_edges_match_golden(self):
+        self.assertAcesEqual(convert_aces(streaming=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
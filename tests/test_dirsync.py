@@ -0,0 +1,122 @@
+'''
+DirSync collection against a local LDAP stand-in that scripts the DirSync control responses
+
+Run with: python -m unittest discover -s tests
+'''
+import base64
+import json
+import logging
+import os
+import sys
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from pyasn1.codec.ber import decoder
+from ldap3.protocol.microsoft import DirSyncControlRequestValue
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ad_ldap_dumper import AdDumper, DIRSYNC_CONTROL_OID, write_dump_file
+
+
+ROOT = 'DC=corp,DC=local'
+CONFIG = 'CN=Configuration,{}'.format(ROOT)
+USER_CATEGORY = 'CN=Person,CN=Schema,{}'.format(CONFIG)
+
+
+class DirSyncStandIn:
+    '''
+    Stands in for an ldap3 connection to a DC, answering each DirSync request for a naming context with the next scripted page
+
+    script - {naming context: [(entries, more_results), ...]}, cookies are issued as cookie1, cookie2... in request order
+    '''
+    def __init__(self, script):
+        self.script = script
+        self.requests = []
+        self.response = []
+        self.result = {}
+
+    def search(self, search_base, search_filter, search_scope=None, attributes=None, controls=None, **kwargs):
+        control = [a for a in controls if str(a['controlType']) == DIRSYNC_CONTROL_OID][0]
+        cookie = bytes(decoder.decode(bytes(control['controlValue']), asn1Spec=DirSyncControlRequestValue())[0]['Cookie'])
+        self.requests.append({'base': search_base, 'filter': search_filter, 'attributes': attributes, 'cookie': cookie})
+        pages = self.script.get(search_base, [])
+        entries, more_results = pages.pop(0) if pages else ([], False)
+        self.response = [{'type': 'searchResEntry', 'dn': dn, 'attributes': dict(attributes)} for dn, attributes in entries]
+        self.result = {'description': 'success', 'controls': {DIRSYNC_CONTROL_OID: {'value': {'more_results': more_results, 'cookie': 'cookie{}'.format(len(self.requests)).encode()}}}}
+        return True
+
+
+def user(name, guid, **attributes):
+    record = {'objectGUID': guid, 'sAMAccountName': name, 'objectClass': ['top', 'person', 'organizationalPerson', 'user'], 'objectCategory': USER_CATEGORY}
+    record.update(attributes)
+    return ('CN={},CN=Users,{}'.format(name, ROOT), record)
+
+
+class DirSyncTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = os.path.join(self.directory.name, 'store.json')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def make_dumper(self, script):
+        dumper = AdDumper('dc.corp.local', username='CORP\\admin', password='x', logger=logging.getLogger('test_dirsync'), dirsync=self.store)
+        dumper.server = SimpleNamespace(info=SimpleNamespace(other={'configurationNamingContext': [CONFIG]}))
+        dumper.connection = DirSyncStandIn(script)
+        dumper.root = ROOT
+        dumper.controls = []
+        return dumper
+
+    def test_initial_cookies_use_sync_filter(self):
+        dumper = self.make_dumper({})
+        dumper.query = lambda methods: {'users': [], 'meta': {'end_time': 1}}
+        data = dumper.dirsync_query(methods=['users', 'certtemplates'])
+        requests = dumper.connection.requests
+        self.assertEqual([a['base'] for a in requests], [ROOT, CONFIG])
+        self.assertEqual(requests[0]['filter'], dumper._dirsync_filter('root', ['users', 'certtemplates']))
+        self.assertEqual(requests[1]['filter'], dumper._dirsync_filter('config', ['users', 'certtemplates']))
+        self.assertEqual(data['meta']['dirsync']['filters'], {ROOT: requests[0]['filter'], CONFIG: requests[1]['filter']})
+        self.assertEqual(data['meta']['dirsync']['cookies'], {ROOT: base64.b64encode(b'cookie1').decode(), CONFIG: base64.b64encode(b'cookie2').decode()})
+
+    def test_initial_cookies_skip_unqueried_naming_context(self):
+        dumper = self.make_dumper({})
+        dumper.query = lambda methods: {'users': [], 'meta': {'end_time': 1}}
+        data = dumper.dirsync_query(methods=['users'])
+        self.assertEqual([a['base'] for a in dumper.connection.requests], [ROOT])
+        self.assertEqual(list(data['meta']['dirsync']['cookies']), [ROOT])
+
+    def test_changes_applied_across_pages(self):
+        root_filter = '(|(objectClass=user))'
+        write_dump_file({
+            'users': [
+                {'objectGUID': '{00000000-0000-0000-0000-000000000001}', 'sAMAccountName': 'alice', 'description': ['old'], 'distinguishedName': 'CN=alice,CN=Users,{}'.format(ROOT)},
+                {'objectGUID': '{00000000-0000-0000-0000-000000000002}', 'sAMAccountName': 'bob', 'distinguishedName': 'CN=bob,CN=Users,{}'.format(ROOT)}
+            ],
+            'groups': [],
+            'computers': [],
+            'meta': {'end_time': 1, 'dirsync': {'cookies': {ROOT: base64.b64encode(b'stored').decode()}, 'filters': {ROOT: root_filter}}}
+        }, self.store)
+        script = {ROOT: [
+            ([user('alice', '{00000000-0000-0000-0000-000000000001}', description=['new'])], True),
+            ([user('carol', '{00000000-0000-0000-0000-000000000003}'),
+              ('CN=bob\\0ADEL:2,CN=Deleted Objects,{}'.format(ROOT), {'objectGUID': '{00000000-0000-0000-0000-000000000002}', 'isDeleted': 'TRUE'})], False)
+        ]}
+        dumper = self.make_dumper(script)
+        data = dumper.dirsync_query()
+        requests = dumper.connection.requests
+        # the stored cookie is sent with the filter it was issued for, then each page continues from the cookie of the last
+        self.assertEqual([(a['base'], a['filter'], a['cookie']) for a in requests], [(ROOT, root_filter, b'stored'), (ROOT, root_filter, b'cookie1')])
+        self.assertEqual(data['meta']['dirsync']['stats'], {'changed': 1, 'added': 1, 'deleted': 1, 'ignored': 0})
+        self.assertEqual(data['meta']['dirsync']['cookies'], {ROOT: base64.b64encode(b'cookie2').decode()})
+        users = {a['sAMAccountName']: a for a in data['users']}
+        self.assertEqual(sorted(users), ['alice', 'carol'])
+        self.assertEqual(users['alice']['description'], ['new'])
+        self.assertEqual(users['carol']['distinguishedName'], 'CN=carol,CN=Users,{}'.format(ROOT))
+        json.dumps(data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,6 +13,7 @@ def command_line():
     input_arg_group = parser.add_argument_group('Operation')
     mgroup = input_arg_group.add_mutually_exclusive_group(required=True)
     mgroup.add_argument('-d', '--domain-controller', type=str, help='Domain controller address to connect to')
+    mgroup.add_argument('-i', '--input-file', type=str, help='Read users from a previous ad_ldap_dumper output file, in any of its output formats including sqlite, instead of querying a domain controller')
     input_arg_group.add_argument('-ssl', action='store_true', default=True, help='Force use of SSL for LDAP connection')
     input_arg_group.add_argument('-port', type=int, default=None, help='Port to connect to. Determined automatically if not specified')
     input_arg_group.add_argument('-query-config', type=str, default=None, help='Provide JSON config file that defines custom LDAP queries and attribute lists for each query category, overriding other settings')
@@ -33,7 +34,7 @@ def command_line():
     args = parser.parse_args()
     logger = create_logger(args.loglevel, 'UserDumper')
     password = args.password
-    if not args.password:
+    if not args.password and not args.input_file:
         print('Please enter the password for {}:'.format(args.username))
         password = getpass.getpass()
 
@@ -47,11 +48,22 @@ def command_line():
         attributes = ldap3.ALL_ATTRIBUTES
 
     
-    dumper = AdDumper(args.domain_controller, username=args.username, password=password, ssl=args.ssl, port=args.port, attributes=attributes, logger=logger, query_config=args.query_config) 
-    outputfile = args.output if args.output else f'{dumper.generate_timestamp()}_{args.domain_controller}_User_Dump.{args.output_type}'
-
-    dumper.connect()
-    data = dumper.query(methods=['users'])
+    if args.input_file:
+        # only the users category is read, straight from its table for sqlite dumps
+        reader = DumpReader(args.input_file)
+        reader.index()
+        data = {'users': [dict(a) for a in reader.records('users')] if 'users' in reader.categories else []}
+        outputfile = args.output if args.output else f'{os.path.splitext(os.path.basename(args.input_file))[0]}_User_Dump.{args.output_type}'
+    else:
+        dumper = AdDumper(args.domain_controller, username=args.username, password=password, ssl=args.ssl, port=args.port, attributes=attributes, logger=logger, query_config=args.query_config) 
+        outputfile = args.output if args.output else f'{dumper.generate_timestamp()}_{args.domain_controller}_User_Dump.{args.output_type}'
+
+        try:
+            dumper.connect()
+        except LdapConnectionError as e:
+            print(e)
+            sys.exit(1)
+        data = dumper.query(methods=['users'])
 
     if args.attributes and args.attributes not in ['+', '*']:
         out_attributes = [a.strip() for a in args.attributes.split(',')]